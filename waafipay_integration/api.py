@@ -1,8 +1,6 @@
 import json
 import frappe
 import requests
-import datetime
-import uuid
 from frappe import _
 from frappe.utils import flt
 from erpnext.setup.utils import get_exchange_rate
@@ -12,38 +10,206 @@ from posawesome.posawesome.api.posapp import (
     get_new_payment_request,
 )
 
+from waafipay_integration.waafipay.circuit_breaker import CircuitOpenError
+from waafipay_integration.waafipay.log_sink import make_log, update_log
+from waafipay_integration.waafipay.metrics import span, traced
+from waafipay_integration.waafipay.payment_status import get_payment_queue, get_payment_status, set_payment_status
+from waafipay_integration.waafipay.single_flight import get_payment_flight_key, single_flight
+from waafipay_integration.waafipay.split_tender import process_split_tender
+from waafipay_integration.waafipay.waafipay_client import WaafiPayClient, get_credentials
+
 
 @frappe.whitelist(allow_guest=True)
 def create_payment_request(doc):
     doc = json.loads(doc)
-    for pay in doc.get("payments"):
-        if pay.get("type") == "Phone":
-            if pay.get("amount") <= 0:
-                frappe.throw(_("Payment amount cannot be less than or equal to 0"))
-
-            if not doc.get("contact_mobile"):
-                frappe.throw(_("Please enter the phone number first"))
-
-            pay_req = get_existing_payment_request(doc, pay)
-            if not pay_req:
-                pay_req = get_new_payment_request(doc, pay)
-                pay_req.submit()
-            else:
-                pay_req.request_phone_payment()
-
-            preauthorize_payment(
-                pay_req.payment_gateway_account,
-                pay.get("contact_mobile") or doc.get("contact_mobile"),
-                pay.get("amount"),
-                doc.get("currency"),
-                pay.get("mode_of_payment"),
-                doc.get("name"),
-            )
+    phone_payments = [pay for pay in doc.get("payments") if pay.get("type") == "Phone"]
+    if not phone_payments:
+        return
+
+    # wallets the invoice is not split across are sent along with a zero amount
+    payments = [pay for pay in phone_payments if flt(pay.get("amount")) > 0]
+    if not payments:
+        frappe.throw(_("Payment amount cannot be less than or equal to 0"))
+
+    if not doc.get("contact_mobile"):
+        frappe.throw(_("Please enter the phone number first"))
+
+    # a double-tapped "Request" attaches to the payment already in flight instead of prompting twice
+    if len(payments) == 1:
+        pay = payments[0]
+        phone_number = pay.get("contact_mobile") or doc.get("contact_mobile")
+        return single_flight(
+            get_payment_flight_key(doc.get("name"), pay.get("amount"), phone_number),
+            lambda: request_phone_payment(doc, pay, phone_number),
+        )
+
+    return single_flight(
+        get_payment_flight_key(
+            doc.get("name"),
+            sum(flt(pay.get("amount")) for pay in payments),
+            "|".join(f"{pay.get('mode_of_payment')}:{pay.get('contact_mobile') or doc.get('contact_mobile')}" for pay in payments),
+        ),
+        lambda: request_split_phone_payments(doc, payments),
+    )
+
+
+def request_phone_payment(doc, pay, phone_number):
+    pay_req = get_phone_payment_request(doc, pay)
+
+    payment_args = {
+        "payment_gateway_account": pay_req.payment_gateway_account,
+        "phone_number": phone_number,
+        "amount": pay.get("amount"),
+        "currency": doc.get("currency"),
+        "mode_of_payment": pay.get("mode_of_payment"),
+        "invoice_id": doc.get("name"),
+    }
+
+    if process_in_background(pay_req.payment_gateway_account):
+        return enqueue_phone_payment(pay_req.name, **payment_args)
+
+    process_phone_payment(pay_req.name, **payment_args)
+
+    return pay_req
+
+
+def get_phone_payment_request(doc, pay):
+    pay_req = get_existing_payment_request(doc, pay)
+    if not pay_req:
+        pay_req = get_new_payment_request(doc, pay)
+        pay_req.submit()
+    else:
+        pay_req.request_phone_payment()
+
+    return pay_req
+
+
+def request_split_phone_payments(doc, payments):
+    """
+    Request every phone payment line of an invoice split across several wallets at once.
+
+    The lines are preauthorized concurrently and committed all or nothing (see
+    `process_split_tender`); the POS gets one result covering all of them.
+    """
+    lines = []
+    for pay in payments:
+        pay_req = get_phone_payment_request(doc, pay)
+        lines.append({
+            "payment_request": pay_req.name,
+            "payment_gateway_account": pay_req.payment_gateway_account,
+            "phone_number": str(pay.get("contact_mobile") or doc.get("contact_mobile")),
+            "amount": pay.get("amount"),
+            "currency": doc.get("currency"),
+            "mode_of_payment": pay.get("mode_of_payment"),
+        })
+
+    invoice = frappe._dict(name=doc.get("name"), doctype=pay_req.reference_doctype)
+
+    if any(process_in_background(line["payment_gateway_account"]) for line in lines):
+        for line in lines:
+            set_payment_status(line["payment_request"], "Queued", invoice=invoice.name, invoice_doctype=invoice.doctype)
+
+        frappe.enqueue(
+            "waafipay_integration.api.process_split_phone_payments",
+            queue=get_payment_queue(),
+            job_id=f"waafipay_split_tender::{invoice.name}",
+            deduplicate=True,
+            enqueue_after_commit=True,
+            invoice_id=invoice.name,
+            invoice_doctype=invoice.doctype,
+            lines=lines,
+        )
+        return get_split_tender_result(invoice, "Queued", [frappe._dict(line, status="Queued") for line in lines])
+
+    return process_split_phone_payments(invoice.name, lines, invoice_doctype=invoice.doctype)
+
+
+def process_split_phone_payments(invoice_id, lines, invoice_doctype="Sales Invoice"):
+    try:
+        status, lines = process_split_tender(lines, invoice_id)
+    except Exception as e:
+        for line in lines:
+            set_payment_status(line["payment_request"], "Failed", message=str(e))
+        raise
+
+    # money was captured for every committed line, even when the invoice as a whole failed
+    for line in lines:
+        if line.status == "Committed":
+            mark_payment_request_paid(payment_request=line.payment_request)
+
+    return get_split_tender_result(frappe._dict(name=invoice_id, doctype=invoice_doctype), status, lines)
+
+
+def get_split_tender_result(invoice, status, lines):
+    fields = ("payment_request", "mode_of_payment", "phone_number", "amount", "status", "transaction_id", "message")
+
+    return {
+        "status": status,
+        "invoice": invoice.name,
+        "invoice_doctype": invoice.doctype,
+        "amount": sum(flt(line.amount) for line in lines),
+        "message": next((line.message for line in lines if line.status == "Failed"), None),
+        "payments": [{field: line.get(field) for field in fields} for line in lines],
+    }
+
+
+def process_in_background(payment_gateway_account):
+    credentials = get_credentials(payment_gateway_account)
+    return bool(credentials and credentials.process_in_background)
+
+
+def enqueue_phone_payment(payment_request, **payment_args):
+    """Run the preauthorize/commit pipeline in a worker; its progress is pushed to the invoice's realtime room."""
+    job_id = f"waafipay_phone_payment::{payment_request}"
+
+    set_payment_status(payment_request, "Queued", job_id=job_id, invoice=payment_args.get("invoice_id"))
+
+    frappe.enqueue(
+        "waafipay_integration.api.process_phone_payment",
+        queue=get_payment_queue(),
+        job_id=job_id,
+        deduplicate=True,
+        enqueue_after_commit=True,
+        payment_request=payment_request,
+        **payment_args,
+    )
+
+    return get_payment_status(payment_request)
+
+
+def process_phone_payment(payment_request, **payment_args):
+    set_payment_status(payment_request, "Processing")
+
+    try:
+        preauthorize_payment(payment_request=payment_request, **payment_args)
+    except Exception as e:
+        set_payment_status(payment_request, "Failed", message=str(e))
+        raise
+
 
-            return pay_req
+@frappe.whitelist()
+def get_phone_payment_status(payment_request):
+    """
+    Current state of a phone payment; falls back to the Payment Request status.
 
+    The POS is pushed every state change, so this is only needed to catch up after a reconnect.
+    """
+    state = get_payment_status(payment_request)
 
-def preauthorize_payment(payment_gateway_account, phone_number, amount, currency, mode_of_payment, invoice_id=None):
+    if not state:
+        status = frappe.db.get_value("Payment Request", payment_request, "status")
+        if not status:
+            frappe.throw(_("Payment Request {0} not found").format(payment_request))
+
+        state = {"payment_request": payment_request, "status": status}
+
+    return state
+
+
+@traced("preauthorize_payment")
+def preauthorize_payment(
+    payment_gateway_account, phone_number, amount, currency, mode_of_payment, invoice_id=None, payment_request=None
+):
     # convert values to string
     phone_number = str(phone_number)
     amount = flt(amount, 2)
@@ -51,173 +217,123 @@ def preauthorize_payment(payment_gateway_account, phone_number, amount, currency
     invoice_id = str(invoice_id)
     mode_of_payment = str(mode_of_payment)
 
-    payment_gateway_value = frappe.get_value("Payment Gateway Account", payment_gateway_account, "payment_gateway")
-    payment_gateway = frappe.get_doc("Payment Gateway", payment_gateway_value)
-
-    credentials = frappe.get_doc(payment_gateway.gateway_settings, payment_gateway.gateway_controller)
+    credentials = get_credentials(payment_gateway_account)
 
     if not credentials:
         frappe.throw(_(f"Credentials not found for {payment_gateway_account}"))
 
-    allowed_currencies = [c.currency for c in credentials.supported_currencies]
-
-    if currency not in allowed_currencies:
+    if currency not in credentials.currencies:
         frappe.throw(f"Currency <b>{currency}</b> is not supported by this gateway <b>{payment_gateway_account}</b>.")
 
-    payload = {
-        "schemaVersion": "1.0",
-        "requestId": str(uuid.uuid4()),
-        "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-        "channelName": "WEB",
-        "serviceName": "API_PREAUTHORIZE",
-        "serviceParams": {
-            "merchantUid": credentials.merchant_uid,
-            "apiUserId": credentials.api_user_id,
-            "apiKey": credentials.get_password("api_key"),
-            "paymentMethod": "MWALLET_ACCOUNT",
-            "payerInfo": {
-                "accountNo": phone_number
-            },
-            "transactionInfo": {
-                "invoiceId": invoice_id or f"INV-{str(uuid.uuid4())[:8]}",
-                "referenceId": invoice_id or str(uuid.uuid4()),
-                "amount": f"{amount:.2f}",
-                "currency": currency,
-                "description": f"Payment for Sales Invoice {invoice_id}",
-            }
-        }
-    }
-
-    if invoice_id:
-        payload["serviceParams"]["transactionInfo"]["invoiceId"] = invoice_id
+    # "Purchase" captures in a single round-trip, "Preauthorize and Commit" defers the capture to a commit
+    purchase = credentials.capture_mode == "Purchase"
 
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    
-    try:
-        response = requests.post(f"{credentials.api_base_url}/asm", json=payload, headers=headers)
-        response.raise_for_status()
-        response_data = response.json()
-
-        # create log
-        log = frappe.get_doc({
-            "doctype": "WaafiPay Log",
-            "reference_id": response_data.get("referenceId"),
-            "status": "Success" if response_data.get("responseCode") == "2001" else "Failed",
-            "request_payload": json.dumps(payload),
-            "response_data": json.dumps(response_data),
-        })
-        log.flags.ignore_permissions = True
-        log.save()
+    client = WaafiPayClient(credentials)
+    if purchase:
+        payload = client.build_purchase_payload(phone_number, amount, currency, invoice_id)
+    else:
+        payload = client.build_preauthorize_payload(phone_number, amount, currency, invoice_id)
 
+    log = make_log(
+        status="Initiated",
+        mode_of_payment=mode_of_payment,
+        reference_id=invoice_id,
+        request_payload=payload,
+    )
 
+    try:
+        response_data = client.send_request(payload, log=log)
+    except CircuitOpenError as e:
+        update_log(log, status="Failed", error_message=str(e))
+        frappe.throw(str(e), title=_("WaafiPay Unavailable"))
     except requests.RequestException as e:
+        update_log(log, status="Failed", error_message=str(e))
         frappe.throw(_("Error during payment request: {0}").format(str(e)))
 
-    finally:
-        log = frappe.get_doc({
-            "doctype": "WaafiPay Log",
-            "reference_id": response_data.get("referenceId"),
-            "status": "Success" if response_data.get("responseCode") == "2001" else "Failed",
-            "request_payload": json.dumps(payload),
-            "response_data": json.dumps(response_data),
-        })
-        log.flags.ignore_permissions = True
-        log.save()
+    update_log(
+        log,
+        reference_id=response_data.get("referenceId") or invoice_id,
+        status="Success" if response_data.get("responseCode") == "2001" else "Failed",
+        response_data=response_data,
+    )
 
     if response_data.get("responseCode") == "2001" and response_data.get("errorCode") == "0":
         state = response_data.get("params", {}).get("state")
         if state in ("APPROVED", "RCS_SUCCESS"):
+            if purchase:
+                return mark_payment_request_paid(invoice_id, payment_request=payment_request)
+
+            if payment_request:
+                set_payment_status(payment_request, "Preauthorized", transaction_id=response_data.get("params", {}).get("transactionId"))
+
             commit_status, commit_response = make_preauthorize_commit(
                 payment_gateway_account,
                 response_data.get("params", {}).get("transactionId")
             )
             if commit_response.get("responseCode") == "2001" or commit_response.get('responseMsg') == "RCS_SUCCESS":
-                payment_request = get_payment_request(invoice_id)
-                payment_request.status = "Paid"
-                payment_request.db_update()
-                return payment_request
+                if payment_request:
+                    set_payment_status(payment_request, "Committed")
+                return mark_payment_request_paid(invoice_id, payment_request=payment_request)
             else:
                 frappe.log_error("Error during commit payment", f"Commit payment failed: {response_data.get('responseMsg')}")
-                log.status = "Failed"
-                log.response_data = json.dumps(response_data)
-                log.flags.ignore_permissions = True
-                log.save()
-    
+                update_log(log, status="Failed", error_message=commit_response.get("responseMsg"))
+
                 frappe.throw(f"Commit payment failed: {commit_response.get('responseMsg')}")
         else:
-            log.status = "Failed"
-            log.response_data = json.dumps(response_data)
-            log.flags.ignore_permissions = True
-            log.save()
+            update_log(log, status="Failed")
 
             frappe.throw(_("Payment not approved: {0}").format(state or "No state info"))
     else:
-        log.status = "Failed"
-        log.response_data = json.dumps(response_data)
-        log.flags.ignore_permissions = True
-        log.save()
+        update_log(log, status="Failed", error_message=response_data.get("responseMsg"))
         frappe.throw(_("Payment gateway error: {0}").format(response_data.get("responseMsg") or "Unknown error"))
 
 
 
+@traced("preauthorize_commit")
 def make_preauthorize_commit(payment_gateway_account, invoice_id):
-    payment_gateway_value = frappe.get_value("Payment Gateway Account", payment_gateway_account, "payment_gateway")
-    payment_gateway = frappe.get_doc("Payment Gateway", payment_gateway_value)
-
-    credentials = frappe.get_doc(payment_gateway.gateway_settings, payment_gateway.gateway_controller)
+    credentials = get_credentials(payment_gateway_account)
 
     if not credentials:
         frappe.throw(_(f"Credentials not found for {payment_gateway_account}"))
 
-    payload = {
-        "schemaVersion": "1.0",
-        "requestId": str(uuid.uuid4()),
-        "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-        "channelName": "WEB",
-        "serviceName": "API_PREAUTHORIZE_COMMIT",
-        "serviceParams": {
-            "merchantUid": credentials.merchant_uid,
-            "apiUserId": credentials.api_user_id,
-            "apiKey": credentials.get_password("api_key"),
-            "transactionId": invoice_id,
-            "description": f"Order #{invoice_id} committed"
-        }
-    }
+    client = WaafiPayClient(credentials)
+    payload = client.build_commit_payload(invoice_id)
 
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-    
-    try:
-        response = requests.post(f"{credentials.api_base_url}/asm", json=payload, headers=headers)
-        response.raise_for_status()
-        response_data = response.json()
-
-        # create log
-        log = frappe.get_doc({
-            "doctype": "WaafiPay Log",
-            "reference_id": response_data.get("referenceId"),
-            "status": "Success" if response_data.get("responseCode") == "2001" else "Failed",
-            "request_payload": json.dumps(payload),
-            "response_data": json.dumps(response_data),
-        })
-        log.flags.ignore_permissions = True
-        log.save()
+    log = make_log(status="Initiated", request_payload=payload)
 
+    try:
+        response_data = client.send_request(payload, log=log)
+    except CircuitOpenError as e:
+        update_log(log, status="Failed", error_message=str(e))
+        frappe.throw(str(e), title=_("WaafiPay Unavailable"))
     except requests.RequestException as e:
-        log.status = "Failed"
-        log.response_data = json.dumps(response_data)
-        log.save()
+        update_log(log, status="Failed", error_message=str(e))
         frappe.throw(_("Error during payment request: {0}").format(str(e)))
 
+    update_log(
+        log,
+        reference_id=response_data.get("referenceId"),
+        status="Success" if response_data.get("responseCode") == "2001" else "Failed",
+        response_data=response_data,
+    )
+
     return response_data.get("responseCode") in ["2001"], response_data
 
 
 
+def mark_payment_request_paid(invoice_id=None, payment_request=None):
+    with span("payment_request"):
+        if payment_request:
+            payment_request = frappe.get_doc("Payment Request", payment_request)
+        else:
+            payment_request = get_payment_request(invoice_id)
+        payment_request.status = "Paid"
+        payment_request.db_update()
+
+    set_payment_status(payment_request.name, "Paid", after_commit=True)
+    return payment_request
+
+
 def get_sales_invoice(invoice_name):
     doctype = "Sales Invoice"
 
@@ -0,0 +1,74 @@
+import json
+
+import click
+from frappe.commands import get_site, pass_context
+
+
+@click.command("waafipay-benchmark")
+@click.option("--scenario", "scenarios", multiple=True, help="Scenario to run (repeatable); defaults to every runnable one")
+@click.option("--concurrency", default="1,8", help="Comma separated concurrency levels")
+@click.option("--transactions", default=200, type=int, help="Transactions per scenario and concurrency level")
+@click.option("--payment-gateway-account", help="Payment Gateway Account backed by WaafiPay Credentials")
+@click.option("--invoice", help="Submitted invoice with a Phone payment and an outstanding amount; replayed by create_payment_request and paid by the settlement scenarios")
+@click.option("--latency", default="fixed:50", help="Mock gateway latency, e.g. lognormal:80,0.4")
+@click.option("--error-rate", default=0.0, type=float, help="Share of requests the mock gateway rejects")
+@click.option("--output", help="Write the results as JSON to this file")
+@click.option("--compare", help="Fail when results regress against this JSON baseline")
+@click.option("--threshold", default=0.2, type=float, help="Allowed regression against the baseline")
+@pass_context
+def waafipay_benchmark(
+    context,
+    scenarios,
+    concurrency,
+    transactions,
+    payment_gateway_account=None,
+    invoice=None,
+    latency="fixed:50",
+    error_rate=0.0,
+    output=None,
+    compare=None,
+    threshold=0.2,
+):
+    "Load test the WaafiPay payment paths against a local mock gateway"
+    import frappe
+
+    from waafipay_integration.waafipay.benchmark import (
+        find_regressions,
+        format_results,
+        run_benchmark,
+        save_results,
+    )
+
+    site = get_site(context)
+    frappe.init(site=site)
+    frappe.connect()
+
+    try:
+        results = run_benchmark(
+            site,
+            scenarios=list(scenarios),
+            concurrency=[int(c) for c in concurrency.split(",")],
+            transactions=transactions,
+            payment_gateway_account=payment_gateway_account,
+            invoice=invoice,
+            latency=latency,
+            error_rate=error_rate,
+        )
+    finally:
+        frappe.destroy()
+
+    click.echo(format_results(results))
+
+    if output:
+        save_results(results, output)
+
+    if compare:
+        with open(compare) as f:
+            regressions = find_regressions(results, json.load(f), threshold)
+
+        if regressions:
+            click.secho("\n".join(["Regressions:", *regressions]), fg="red")
+            raise SystemExit(1)
+
+
+commands = [waafipay_benchmark]
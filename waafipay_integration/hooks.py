@@ -14,6 +14,7 @@ app_license = "MIT"
 # app_include_css = "/assets/waafipay_integration/css/waafipay_integration.css"
 app_include_js = [
     # "/assets/waafipay_integration/js/waafipay_payment_handler.js",
+    "/assets/waafipay_integration/js/waafipay_payment_status.js",
 ]
 
 # include js, css files in header of web template
@@ -125,7 +126,21 @@ override_doctype_class = {
 doc_events = {
     "Payment Request": {
         # "on_submit": "waafipay_integration.waafipay.waafipay_client.generate_payment_link",
-    }
+    },
+    "Payment Gateway": {
+        "on_update": "waafipay_integration.waafipay.credentials.on_gateway_change",
+        "on_trash": "waafipay_integration.waafipay.credentials.on_gateway_change",
+    },
+    "Payment Gateway Account": {
+        "on_update": [
+            "waafipay_integration.waafipay.credentials.on_gateway_change",
+            "waafipay_integration.waafipay.templates.on_gateway_account_change",
+        ],
+        "on_trash": [
+            "waafipay_integration.waafipay.credentials.on_gateway_change",
+            "waafipay_integration.waafipay.templates.on_gateway_account_change",
+        ],
+    },
 }
 
 
@@ -149,6 +164,22 @@ fixtures = [
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+    "all": [
+        "waafipay_integration.waafipay.inbox.run",
+        "waafipay_integration.waafipay.outbox.run",
+        "waafipay_integration.waafipay.log_sink.run",
+    ],
+    "daily": [
+        "waafipay_integration.waafipay.log_retention.run",
+    ],
+    "cron": {
+        "*/5 * * * *": [
+            "waafipay_integration.waafipay.sweeper.run",
+        ],
+    },
+}
+
 # scheduler_events = {
 #	"all": [
 #		"waafipay_integration.tasks.all"
@@ -1,13 +1,18 @@
 
+import json
+
 import frappe
 from frappe import _
-from frappe.utils import flt
+from frappe.model.naming import set_new_name
+from frappe.utils import flt, now_datetime
 from erpnext.accounts.doctype.payment_request.payment_request import PaymentRequest
 from erpnext.accounts.party import get_party_account, get_party_bank_account
 from erpnext.accounts.doctype.accounting_dimension.accounting_dimension import (
 	get_accounting_dimensions,
 )
-from waafipay_integration.waafipay.waafipay_client import generate_payment_link
+from waafipay_integration.waafipay.credentials import get_gateway_account
+from waafipay_integration.waafipay.outbox import enqueue_payment_link
+from waafipay_integration.waafipay.templates import render_template
 
 
 class PaymentRequest(PaymentRequest):
@@ -19,7 +24,7 @@ class PaymentRequest(PaymentRequest):
 			self.db_set("status", "Requested")
 
 		send_mail = self.payment_gateway_validation() if self.payment_gateway else None
-		ref_doc = frappe.get_doc(self.reference_doctype, self.reference_name)
+		ref_doc = get_reference_doc(self)
 
 		if (
 			hasattr(ref_doc, "order_type") and getattr(ref_doc, "order_type") == "Shopping Cart"
@@ -32,7 +37,19 @@ class PaymentRequest(PaymentRequest):
 			self.make_communication_entry()
 
 		elif self.payment_channel == "Phone":
-			generate_payment_link(self)
+			# the link is requested by the outbox dispatcher once this submit has committed
+			enqueue_payment_link(self)
+
+	def get_message(self):
+		"""return message with payment gateway link"""
+		context = {
+			"doc": get_reference_doc(self),
+			"payment_url": self.payment_url,
+		}
+		if self.message:
+			# messages built from get_dummy_message differ per request, only gateway messages repeat
+			gateway_account = get_gateway_account(self.payment_gateway_account) or {}
+			return render_template(self.message, context, cache=self.message == gateway_account.get("message"))
 
 
 @frappe.whitelist(allow_guest=True)
@@ -42,7 +59,7 @@ def make_payment_request(**args):
 	args = frappe._dict(args)
 
 	ref_doc = frappe.get_doc(args.dt, args.dn)
-	gateway_account = get_gateway_details(args) or frappe._dict()
+	gateway_account = get_gateway_details(frappe._dict(args, currency=args.currency or ref_doc.get("currency"))) or frappe._dict()
 
 	grand_total = get_amount(ref_doc, gateway_account.get("payment_account"))
 	if args.loyalty_points and args.dt == "Sales Order":
@@ -78,8 +95,10 @@ def make_payment_request(**args):
 			"Payment Request", draft_payment_request, "grand_total", grand_total, update_modified=False
 		)
 		pr = frappe.get_doc("Payment Request", draft_payment_request)
+		pr.flags.reference_doc = ref_doc
 	else:
 		pr = frappe.new_doc("Payment Request")
+		pr.flags.reference_doc = ref_doc
 		pr.update(
 			{
 				"payment_gateway_account": gateway_account.get("name"),
@@ -130,6 +149,249 @@ def make_payment_request(**args):
 	return pr.as_dict()
 
 
+@frappe.whitelist()
+def make_payment_requests(references, **args):
+	"""
+	Make Payment Requests for many `references` (`[{"dt": ..., "dn": ...}]` or `[[dt, dn]]`) at once.
+
+	Reference documents, existing request amounts and drafts are fetched with one query per
+	doctype, gateway accounts are resolved once per currency and new requests are bulk inserted.
+	Returns one result per reference; a failing reference does not stop the batch.
+	Loyalty points and Shopping Cart orders are only supported by `make_payment_request`.
+	New requests skip the `BULK_INSERT_SKIPPED_EVENTS` of a normal insert; submitting them
+	runs the full submit chain.
+	"""
+	frappe.has_permission("Payment Request", "create", throw=True)
+
+	if isinstance(references, str):
+		references = json.loads(references)
+
+	args = frappe._dict(args)
+	references = [
+		frappe._dict(dt=ref[0], dn=ref[1]) if isinstance(ref, (list, tuple)) else frappe._dict(ref)
+		for ref in references
+	]
+
+	ref_docs = get_reference_docs(references)
+	existing_amounts = get_existing_payment_request_amounts(references)
+	drafts = get_draft_payment_requests(references)
+	dimensions = get_accounting_dimensions()
+	gateway_accounts = {}
+	bank_account = (
+		get_party_bank_account(args.get("party_type"), args.get("party"))
+		if args.get("party_type")
+		else ""
+	)
+
+	results, new_requests = [], []
+	for ref in references:
+		result = frappe._dict(dt=ref.dt, dn=ref.dn)
+		results.append(result)
+
+		try:
+			ref_doc = ref_docs.get((ref.dt, ref.dn))
+			if not ref_doc:
+				frappe.throw(_("{0} {1} not found").format(ref.dt, ref.dn))
+
+			currency = ref_doc.get("currency")
+			if currency not in gateway_accounts:
+				gateway_accounts[currency] = get_gateway_details(frappe._dict(args, currency=currency)) or frappe._dict()
+
+			gateway_account = gateway_accounts[currency]
+			grand_total = get_amount(ref_doc, gateway_account.get("payment_account"))
+			grand_total -= existing_amounts.get((ref.dt, ref.dn), 0)
+			if grand_total <= 0:
+				frappe.throw(_("Total Payment Request amount cannot be greater than {0} amount").format(_(ref.dt)))
+
+			if draft := drafts.get((ref.dt, ref.dn)):
+				frappe.db.set_value("Payment Request", draft, "grand_total", grand_total, update_modified=False)
+				result.update(status="Updated", payment_request=draft, grand_total=grand_total)
+				continue
+
+			pr = build_payment_request(ref_doc, gateway_account, grand_total, args, bank_account, dimensions)
+			validate_payment_request(pr)
+			new_requests.append((pr, result))
+			result.update(status="Created", payment_request=pr.name, grand_total=grand_total)
+			# a reference listed twice must not be requested twice
+			existing_amounts[(ref.dt, ref.dn)] = existing_amounts.get((ref.dt, ref.dn), 0) + grand_total
+		except Exception as e:
+			frappe.clear_last_message()
+			result.update(status="Failed", error=str(e))
+
+	insert_payment_requests([pr for pr, result in new_requests])
+
+	if args.submit_doc:
+		for pr, result in new_requests:
+			try:
+				frappe.db.savepoint("submit_payment_request")
+				doc = frappe.get_doc("Payment Request", pr.name)
+				doc.flags.reference_doc = pr.flags.reference_doc
+				doc.submit()
+				result.status = "Submitted"
+			except Exception as e:
+				frappe.db.rollback(save_point="submit_payment_request")
+				frappe.clear_last_message()
+				result.update(status="Failed", error=str(e))
+
+	return results
+
+
+def build_payment_request(ref_doc, gateway_account, grand_total, args, bank_account, dimensions):
+	pr = frappe.new_doc("Payment Request")
+	pr.update(
+		{
+			"payment_gateway_account": gateway_account.get("name"),
+			"payment_gateway": gateway_account.get("payment_gateway"),
+			"payment_account": gateway_account.get("payment_account"),
+			"payment_channel": gateway_account.get("payment_channel"),
+			"payment_request_type": args.get("payment_request_type"),
+			"currency": ref_doc.currency,
+			"grand_total": grand_total,
+			"mode_of_payment": args.mode_of_payment,
+			"email_to": args.recipient_id or ref_doc.owner,
+			"subject": _("Payment Request for {0}").format(ref_doc.name),
+			"message": gateway_account.get("message") or get_dummy_message(ref_doc),
+			"reference_doctype": ref_doc.doctype,
+			"reference_name": ref_doc.name,
+			"party_type": args.get("party_type") or "Customer",
+			"party": args.get("party") or ref_doc.get("customer"),
+			"bank_account": bank_account,
+			"cost_center": ref_doc.get("cost_center"),
+			"project": ref_doc.get("project"),
+			"status": "Draft",
+		}
+	)
+
+	for dimension in dimensions:
+		pr.update({dimension: ref_doc.get(dimension)})
+
+	if args.mute_email:
+		pr.flags.mute_email = True
+
+	pr.flags.reference_doc = ref_doc
+	set_new_name(pr)
+	return pr
+
+
+def validate_payment_request(pr):
+	"""
+	The checks of `PaymentRequest.validate` that need no query, run before the bulk insert.
+
+	Its amount check is done by `make_payment_requests` against the prefetched reference
+	amounts and existing request totals, and a new request has no subscription plans to check.
+	"""
+	pr.set_parent_in_children()
+	pr.validate_reference_document()
+	pr._validate_mandatory()
+	pr._validate_length()
+
+
+# document events a normal insert runs that bulk inserted Payment Requests skip: the
+# controller's, other apps' `doc_events` and server scripts alike (no Version is kept either)
+BULK_INSERT_SKIPPED_EVENTS = (
+	"before_insert",
+	"before_validate",
+	"validate",
+	"before_save",
+	"after_insert",
+	"on_update",
+	"on_change",
+)
+
+
+def insert_payment_requests(payment_requests):
+	"""
+	Bulk insert new, unsaved Payment Requests already passed through `validate_payment_request`.
+
+	None of the `BULK_INSERT_SKIPPED_EVENTS` are run.
+	"""
+	if not payment_requests:
+		return
+
+	now = now_datetime()
+	for pr in payment_requests:
+		pr.update({"owner": frappe.session.user, "modified_by": frappe.session.user, "creation": now, "modified": now})
+
+	rows = [pr.get_valid_dict(convert_dates_to_str=True) for pr in payment_requests]
+	fields = list(rows[0])
+	frappe.db.bulk_insert("Payment Request", fields, [[row.get(f) for f in fields] for row in rows])
+
+	for pr in payment_requests:
+		for child in pr.get_all_children():
+			child.db_insert()
+
+
+def get_reference_docs(references):
+	"""Reference documents (with their payments) of `references`, loaded with one query per doctype."""
+	docs = {}
+
+	for dt, names in group_references(references).items():
+		meta = frappe.get_meta(dt)
+		payments = {}
+		if meta.has_field("payments"):
+			for row in frappe.get_all(
+				meta.get_field("payments").options,
+				filters={"parent": ["in", names], "parenttype": dt},
+				fields=["*"],
+				order_by="idx",
+			):
+				payments.setdefault(row.parent, []).append(row)
+
+		for row in frappe.get_all(dt, filters={"name": ["in", names]}, fields=["*"]):
+			if meta.has_field("payments"):
+				row.payments = payments.get(row.name, [])
+			docs[(dt, row.name)] = frappe.get_doc({**row, "doctype": dt})
+
+	return docs
+
+
+def get_existing_payment_request_amounts(references):
+	"""`get_existing_payment_request_amount` for many references, one grouped query per doctype."""
+	amounts = {}
+
+	for dt, names in group_references(references).items():
+		for name, amount in frappe.db.sql(
+			"""
+			select reference_name, sum(grand_total)
+			from `tabPayment Request`
+			where
+				reference_doctype = %s
+				and reference_name in %s
+				and docstatus = 1
+				and (status != 'Paid'
+				or (payment_channel = 'Phone'
+					and status = 'Paid'))
+			group by reference_name
+		""",
+			(dt, tuple(names)),
+		):
+			amounts[(dt, name)] = flt(amount)
+
+	return amounts
+
+
+def get_draft_payment_requests(references):
+	drafts = {}
+
+	for dt, names in group_references(references).items():
+		for row in frappe.get_all(
+			"Payment Request",
+			filters={"reference_doctype": dt, "reference_name": ["in", names], "docstatus": 0},
+			fields=["name", "reference_name"],
+		):
+			drafts.setdefault((dt, row.reference_name), row.name)
+
+	return drafts
+
+
+def group_references(references):
+	grouped = {}
+	for ref in references:
+		grouped.setdefault(ref.dt, []).append(ref.dn)
+
+	return grouped
+
+
 def get_gateway_details(args):  # nosemgrep
 	"""Return gateway and payment account based on currency or default."""
 	if args.get("payment_gateway_account"):
@@ -140,24 +402,21 @@ def get_gateway_details(args):  # nosemgrep
 		return get_payment_gateway_account(payment_gateway_account)
 
 	# Try to get a gateway account that matches the document's currency
-	if args.get("dt") and args.get("dn"):
-		ref_doc = frappe.get_doc(args.get("dt"), args.get("dn"))
-		currency = ref_doc.get("currency")
-		if currency:
-			account = frappe.db.get_value(
-				"Payment Gateway Account",
-				{"currency": currency},
-				["name", "payment_gateway", "payment_account", "message", "payment_channel"],
-				as_dict=True,
-			)
-			if account:
-				return account
+	currency = args.get("currency")
+	if not currency and args.get("dt") and args.get("dn"):
+		currency = frappe.db.get_value(args.get("dt"), args.get("dn"), "currency")
+
+	if currency and (account := get_gateway_account(currency=currency)):
+		return account
 
 	# Fallback to default
-	return get_payment_gateway_account({"is_default": 1})
+	return get_gateway_account(default=True)
 
 
 def get_payment_gateway_account(args):
+	if isinstance(args, str):
+		return get_gateway_account(args)
+
 	return frappe.db.get_value(
 		"Payment Gateway Account",
 		args,
@@ -201,26 +460,25 @@ def get_existing_payment_request_amount(ref_dt, ref_dn):
 	Get the existing payment request which are unpaid or partially paid for payment channel other than Phone
 	and get the summation of existing paid payment request for Phone payment channel.
 	"""
-	existing_payment_request_amount = frappe.db.sql(
-		"""
-		select sum(grand_total)
-		from `tabPayment Request`
-		where
-			reference_doctype = %s
-			and reference_name = %s
-			and docstatus = 1
-			and (status != 'Paid'
-			or (payment_channel = 'Phone'
-				and status = 'Paid'))
-	""",
-		(ref_dt, ref_dn),
-	)
-	return flt(existing_payment_request_amount[0][0]) if existing_payment_request_amount else 0
+	return get_existing_payment_request_amounts([frappe._dict(dt=ref_dt, dn=ref_dn)]).get((ref_dt, ref_dn), 0)
+
+
+def get_reference_doc(pr):
+	"""
+	Reference document of `pr`: the one it was built from, handed over in
+	`pr.flags.reference_doc`, or else loaded (once per `pr` object).
+	"""
+	if not pr.flags.reference_doc:
+		pr.flags.reference_doc = frappe.get_doc(pr.reference_doctype, pr.reference_name)
+
+	return pr.flags.reference_doc
 
 
 def get_dummy_message(doc):
-	return frappe.render_template(
-		"""{% if doc.contact_person -%}
+	return render_template(DUMMY_MESSAGE, dict(doc=doc, payment_url="{{ payment_url }}"))
+
+
+DUMMY_MESSAGE = """{% if doc.contact_person -%}
 <p>Dear {{ doc.contact_person }},</p>
 {%- else %}<p>Hello,</p>{% endif %}
 
@@ -232,6 +490,4 @@ def get_dummy_message(doc):
 <p>{{ _("If you have any questions, please get back to us.") }}</p>
 
 <p>{{ _("Thank you for your business!") }}</p>
-""",
-		dict(doc=doc, payment_url="{{ payment_url }}"),
-	)
+"""
@@ -0,0 +1,92 @@
+from unittest.mock import patch
+
+import frappe
+from erpnext.accounts.doctype.payment_request.payment_request import PaymentRequest as ERPNextPaymentRequest
+from erpnext.accounts.doctype.sales_invoice.test_sales_invoice import create_sales_invoice
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.overrides import payment_request
+from waafipay_integration.overrides.payment_request import (
+	BULK_INSERT_SKIPPED_EVENTS,
+	PaymentRequest,
+	get_reference_doc,
+	make_payment_request,
+	make_payment_requests,
+)
+
+
+class TestPaymentRequest(FrappeTestCase):
+	def setUp(self):
+		self.invoices = [create_sales_invoice(rate=rate) for rate in (100, 200)]
+		self.events = []
+		run = PaymentRequest.run_method
+
+		def run_method(doc, method, *args, **kwargs):
+			self.events.append(method)
+			return run(doc, method, *args, **kwargs)
+
+		patcher = patch.object(PaymentRequest, "run_method", run_method)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def get_references(self):
+		return [["Sales Invoice", invoice.name] for invoice in self.invoices]
+
+	def test_bulk_requests(self):
+		results = make_payment_requests([*self.get_references(), self.get_references()[0]], mute_email=1)
+
+		self.assertEqual([r.status for r in results], ["Created", "Created", "Failed"])
+		# a reference listed twice is not requested twice
+		self.assertIn("cannot be greater than", results[2].error)
+
+		for result, invoice in zip(results, self.invoices):
+			pr = frappe.get_doc("Payment Request", result.payment_request)
+			self.assertEqual((pr.reference_name, pr.grand_total, pr.status), (invoice.name, invoice.grand_total, "Draft"))
+
+	def test_validated_against_the_prefetched_sums(self):
+		with (
+			patch.object(ERPNextPaymentRequest, "validate") as validate,
+			patch.object(
+				payment_request,
+				"get_existing_payment_request_amounts",
+				wraps=payment_request.get_existing_payment_request_amounts,
+			) as get_existing_amounts,
+		):
+			make_payment_requests(self.get_references(), mute_email=1)
+
+		validate.assert_not_called()
+		get_existing_amounts.assert_called_once()
+
+	def test_insert_events_are_skipped(self):
+		make_payment_requests(self.get_references(), mute_email=1)
+
+		self.assertFalse(set(self.events) & set(BULK_INSERT_SKIPPED_EVENTS))
+
+	def test_submit_runs_the_full_chain(self):
+		results = make_payment_requests(self.get_references(), mute_email=1, submit_doc=1)
+
+		self.assertEqual([r.status for r in results], ["Submitted", "Submitted"])
+		self.assertIn("before_submit", self.events)
+		self.assertIn("on_submit", self.events)
+
+	def test_invalid_references_do_not_stop_the_batch(self):
+		results = make_payment_requests([["Sales Invoice", "ACC-SINV-MISSING"], *self.get_references()], mute_email=1)
+
+		self.assertEqual([r.status for r in results], ["Failed", "Created", "Created"])
+
+	def test_reference_doc_is_handed_over(self):
+		invoice = self.invoices[0]
+		pr = make_payment_request(dt="Sales Invoice", dn=invoice.name, mute_email=1, return_doc=1)
+
+		with patch.object(frappe, "get_doc") as get_doc:
+			self.assertEqual(get_reference_doc(pr).name, invoice.name)
+
+		get_doc.assert_not_called()
+
+	def test_reference_doc_is_not_cached_across_requests(self):
+		invoice = self.invoices[0]
+		pr = make_payment_request(dt="Sales Invoice", dn=invoice.name, mute_email=1, return_doc=1)
+		frappe.db.set_value("Sales Invoice", invoice.name, "remarks", "Updated after the request", update_modified=False)
+
+		# a later request for the same invoice sees the write
+		self.assertEqual(get_reference_doc(frappe.get_doc("Payment Request", pr.name)).remarks, "Updated after the request")
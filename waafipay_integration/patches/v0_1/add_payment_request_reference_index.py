@@ -0,0 +1,10 @@
+import frappe
+
+
+def execute():
+	"""Index the columns existing payment request amounts and drafts are looked up by."""
+	frappe.db.add_index(
+		"Payment Request",
+		["reference_doctype", "reference_name", "docstatus", "status"],
+		index_name="waafipay_reference_index",
+	)
@@ -0,0 +1,10 @@
+import frappe
+
+
+def execute():
+	"""Index the columns the transaction sweeper selects stale unpaid Payment Requests by."""
+	frappe.db.add_index(
+		"Payment Request",
+		["docstatus", "status", "modified"],
+		index_name="waafipay_status_index",
+	)
@@ -0,0 +1,40 @@
+import json
+
+import frappe
+
+from waafipay_integration.waafipay.log_sink import extract_log_fields
+
+BATCH_SIZE = 1000
+
+
+def execute():
+	"""Fill the structured WaafiPay Log columns from the JSON payloads of existing rows."""
+	last_name = ""
+	while True:
+		logs = frappe.get_all(
+			"WaafiPay Log",
+			filters={"name": [">", last_name], "service_name": ["is", "not set"]},
+			fields=["name", "request_payload", "response_data", "reference_id"],
+			order_by="name asc",
+			limit=BATCH_SIZE,
+		)
+		if not logs:
+			break
+
+		for log in logs:
+			fields = extract_log_fields(_loads(log.request_payload), _loads(log.response_data))
+			if log.reference_id:
+				fields.pop("reference_id", None)
+
+			if fields:
+				frappe.db.set_value("WaafiPay Log", log.name, fields, update_modified=False)
+
+		last_name = logs[-1].name
+		frappe.db.commit()
+
+
+def _loads(value):
+	try:
+		return json.loads(value) if value else None
+	except ValueError:
+		return None
@@ -0,0 +1,37 @@
+from itertools import product
+
+import frappe
+
+from waafipay_integration.waafipay.log_retention import (
+	COMPRESSED_COLUMN,
+	LOG_DOCTYPE,
+	PAYLOAD_FIELDS,
+	add_compressed_column,
+	compress_payloads,
+)
+
+
+def execute():
+	"""Turn the base64 text column of compressed WaafiPay Log payloads into a binary one holding the raw zlib bytes."""
+	if COMPRESSED_COLUMN not in frappe.db.get_table_columns(LOG_DOCTYPE):
+		add_compressed_column()
+		return
+
+	if frappe.db.db_type == "postgres":
+		frappe.db.sql_ddl(
+			f"""alter table "tab{LOG_DOCTYPE}" alter column "{COMPRESSED_COLUMN}" type bytea
+			using decode("{COMPRESSED_COLUMN}", 'base64')"""
+		)
+	else:
+		frappe.db.sql_ddl(f"alter table `tab{LOG_DOCTYPE}` modify `{COMPRESSED_COLUMN}` longblob")
+		frappe.db.sql(
+			f"""update `tab{LOG_DOCTYPE}` set `{COMPRESSED_COLUMN}` = from_base64(`{COMPRESSED_COLUMN}`)
+			where `{COMPRESSED_COLUMN}` is not null"""
+		)
+
+	frappe.cache().hdel("table_columns", f"tab{LOG_DOCTYPE}")
+
+	# logs without payloads were "compressed" too, they need no copy at all
+	Log = frappe.qb.DocType(LOG_DOCTYPE)
+	empty = [compress_payloads(dict(zip(PAYLOAD_FIELDS, values))) for values in product((None, ""), repeat=len(PAYLOAD_FIELDS))]
+	frappe.qb.update(Log).set(Log.field(COMPRESSED_COLUMN), None).where(Log.field(COMPRESSED_COLUMN).isin(empty)).run()
@@ -1,8 +1,27 @@
 frappe.ui.form.on("Payment Request", {
+    setup: function(frm) {
+        // the payment link is generated after submit by the WaafiPay outbox
+        frappe.realtime.on("waafipay_payment_link", function(data) {
+            if (data.payment_request !== frm.doc.name) {
+                return;
+            }
+
+            if (data.error) {
+                frappe.show_alert({ message: __("WaafiPay payment link could not be generated: {0}", [data.error]), indicator: "red" });
+            }
+
+            frm.reload_doc();
+        });
+    },
+    refresh: function(frm) {
+        if (frm.doc.docstatus === 1 && frm.doc.payment_channel === "Phone" && frm.doc.payment_gateway_account && !frm.doc.waafipay_payment_link) {
+            frm.set_intro(__("The WaafiPay payment link is being generated."), "blue");
+        }
+    },
     copy_waafipay_payment_link: function(frm) {
         frappe.utils.copy_to_clipboard(frm.doc.waafipay_payment_link);
     },
     open_waafipay_payment_link: function(frm) {
         window.open(frm.doc.waafipay_payment_link, "_blank", "noopener,noreferrer,width=500,height=600");
     }
-});
\ No newline at end of file
+});
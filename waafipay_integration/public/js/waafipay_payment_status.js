@@ -0,0 +1,104 @@
+// Pushes the state of WaafiPay phone payments (Queued, Processing, Preauthorized, Committed,
+// Paid, Failed, Cancelled) to the POS as it changes, instead of holding the request or polling for it.
+frappe.provide("waafipay.payment_status");
+
+waafipay.payment_status = {
+    EVENT: "waafipay_payment_status",
+    FINAL_STATES: ["Paid", "Failed", "Cancelled", "Cancel Failed"],
+    subscriptions: {},
+
+    // an invoice split across several wallets tracks one Payment Request per wallet
+    subscribe(invoice_doctype, invoice, payment_requests) {
+        const key = `${invoice_doctype}/${invoice}`;
+        if (!this.subscriptions[key]) {
+            frappe.realtime.doc_subscribe(invoice_doctype, invoice);
+        }
+        this.subscriptions[key] = { invoice_doctype, invoice, payment_requests: payment_requests.filter(Boolean), states: {} };
+
+        // catch up with anything published before the subscription was in place
+        this.refresh(this.subscriptions[key]);
+    },
+
+    unsubscribe(invoice_doctype, invoice) {
+        const key = `${invoice_doctype}/${invoice}`;
+        if (this.subscriptions[key]) {
+            frappe.realtime.doc_unsubscribe(invoice_doctype, invoice);
+            delete this.subscriptions[key];
+        }
+    },
+
+    refresh(subscription) {
+        subscription.payment_requests.forEach((payment_request) => {
+            frappe.call({
+                method: "waafipay_integration.api.get_phone_payment_status",
+                args: { payment_request },
+                callback: (r) => r.message && this.dispatch(r.message),
+            });
+        });
+    },
+
+    dispatch(state) {
+        const invoice_doctype = state.invoice_doctype || "Sales Invoice";
+        const subscription = this.subscriptions[`${invoice_doctype}/${state.invoice}`];
+        if (!subscription) {
+            return;
+        }
+        subscription.states[state.payment_request] = state.status;
+
+        // POS Awesome listens on its event bus, anything else can bind to the jQuery event
+        if (window.evntBus) {
+            window.evntBus.$emit(this.EVENT, state);
+        }
+        $(document).trigger(this.EVENT, [state]);
+
+        if (state.status === "Paid") {
+            frappe.show_alert({ message: __("WaafiPay payment received for {0}", [state.invoice]), indicator: "green" });
+        } else if (state.status === "Failed") {
+            frappe.show_alert({ message: __("WaafiPay payment failed for {0}: {1}", [state.invoice, state.message || ""]), indicator: "red" });
+        }
+
+        const pending = subscription.payment_requests.filter(
+            (payment_request) => !this.FINAL_STATES.includes(subscription.states[payment_request])
+        );
+        if (this.FINAL_STATES.includes(state.status) && !pending.length) {
+            this.unsubscribe(invoice_doctype, state.invoice);
+        }
+    },
+};
+
+frappe.realtime.on(waafipay.payment_status.EVENT, (state) => waafipay.payment_status.dispatch(state));
+
+frappe.realtime.on("connect", () => {
+    Object.values(waafipay.payment_status.subscriptions).forEach((subscription) => {
+        frappe.realtime.doc_subscribe(subscription.invoice_doctype, subscription.invoice);
+        waafipay.payment_status.refresh(subscription);
+    });
+});
+
+// subscribe as soon as the POS requests a phone payment, without changes to POS Awesome itself:
+// it calls its own create_payment_request, which hooks.py routes to ours on the server
+waafipay.payment_status.CREATE_METHODS = [
+    "waafipay_integration.api.create_payment_request",
+    "posawesome.posawesome.api.posapp.create_payment_request",
+];
+
+$(document).ajaxSuccess((event, xhr, settings) => {
+    const request = `${settings.url || ""} ${typeof settings.data === "string" ? settings.data : ""}`;
+    if (!waafipay.payment_status.CREATE_METHODS.some((method) => request.includes(method))) {
+        return;
+    }
+
+    const message = xhr.responseJSON && xhr.responseJSON.message;
+    if (!message) {
+        return;
+    }
+
+    const invoice_doctype = message.invoice_doctype || message.reference_doctype;
+    const invoice = message.invoice || message.reference_name;
+    if (invoice_doctype && invoice) {
+        const payment_requests = message.payments
+            ? message.payments.map((payment) => payment.payment_request)
+            : [message.payment_request || message.name];
+        waafipay.payment_status.subscribe(invoice_doctype, invoice, payment_requests);
+    }
+});
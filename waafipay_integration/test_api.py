@@ -0,0 +1,185 @@
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration import api
+from waafipay_integration.waafipay.payment_status import STATUS_KEY, get_payment_status
+from waafipay_integration.waafipay.test_credentials import make_credentials_record
+from waafipay_integration.waafipay.waafipay_client import WaafiPayClient
+
+PAYMENT_ARGS = {
+    "payment_gateway_account": "_Test Gateway - USD",
+    "phone_number": "252610000001",
+    "amount": 5,
+    "currency": "USD",
+    "mode_of_payment": "_Test WaafiPay",
+    "invoice_id": "ACC-SINV-TEST",
+}
+
+
+class TestPhonePaymentJob(FrappeTestCase):
+    def setUp(self):
+        self.payment_request = f"ACC-PRQ-TEST-{frappe.generate_hash(length=10)}"
+
+    def tearDown(self):
+        frappe.cache().delete_value(f"{STATUS_KEY}:{self.payment_request}")
+
+    def test_background_payment_is_queued(self):
+        with patch.object(frappe, "enqueue") as enqueue:
+            state = api.enqueue_phone_payment(self.payment_request, **PAYMENT_ARGS)
+
+        self.assertEqual(state["status"], "Queued")
+        self.assertEqual(state["invoice"], "ACC-SINV-TEST")
+
+        kwargs = enqueue.call_args.kwargs
+        self.assertEqual(enqueue.call_args.args, ("waafipay_integration.api.process_phone_payment",))
+        self.assertEqual(kwargs["job_id"], f"waafipay_phone_payment::{self.payment_request}")
+        self.assertTrue(kwargs["deduplicate"])
+        # the worker must see the submitted Payment Request
+        self.assertTrue(kwargs["enqueue_after_commit"])
+        self.assertEqual(kwargs["payment_request"], self.payment_request)
+
+    def test_request_runs_inline_unless_configured(self):
+        pay_req = frappe._dict(name=self.payment_request, payment_gateway_account="_Test Gateway - USD")
+        doc = {"name": "ACC-SINV-TEST", "currency": "USD"}
+        pay = {"amount": 5, "mode_of_payment": "_Test WaafiPay"}
+
+        with (
+            patch.object(api, "get_phone_payment_request", return_value=pay_req),
+            patch.object(api, "process_phone_payment") as process,
+            patch.object(api, "enqueue_phone_payment") as enqueue,
+        ):
+            with patch.object(api, "process_in_background", return_value=False):
+                self.assertIs(api.request_phone_payment(doc, pay, "252610000001"), pay_req)
+            process.assert_called_once()
+            enqueue.assert_not_called()
+
+            with patch.object(api, "process_in_background", return_value=True):
+                api.request_phone_payment(doc, pay, "252610000001")
+            enqueue.assert_called_once_with(self.payment_request, **PAYMENT_ARGS)
+
+    def test_job_records_its_progress(self):
+        statuses = []
+
+        def preauthorize_payment(**kwargs):
+            statuses.append(get_payment_status(self.payment_request)["status"])
+
+        with patch.object(api, "preauthorize_payment", side_effect=preauthorize_payment) as preauthorize:
+            api.process_phone_payment(self.payment_request, **PAYMENT_ARGS)
+
+        self.assertEqual(statuses, ["Processing"])
+        self.assertEqual(preauthorize.call_args.kwargs["payment_request"], self.payment_request)
+
+    def test_failed_job_records_the_error(self):
+        with patch.object(api, "preauthorize_payment", side_effect=frappe.ValidationError("Payment not approved")):
+            self.assertRaises(frappe.ValidationError, api.process_phone_payment, self.payment_request, **PAYMENT_ARGS)
+
+        state = api.get_phone_payment_status(self.payment_request)
+        self.assertEqual((state["status"], state["message"]), ("Failed", "Payment not approved"))
+
+    def test_status_falls_back_to_payment_request(self):
+        with patch.object(frappe.db, "get_value", MagicMock(return_value="Paid")):
+            self.assertEqual(
+                api.get_phone_payment_status(self.payment_request),
+                {"payment_request": self.payment_request, "status": "Paid"},
+            )
+
+        self.assertRaises(frappe.ValidationError, api.get_phone_payment_status, self.payment_request)
+
+
+class TestSplitPhonePayments(FrappeTestCase):
+    def setUp(self):
+        self.lines = [
+            {"payment_request": "ACC-PRQ-TEST-1", "phone_number": "252610000001", "amount": 5},
+            {"payment_request": "ACC-PRQ-TEST-2", "phone_number": "252610000002", "amount": 3},
+        ]
+
+    def test_committed_lines_are_marked_paid(self):
+        lines = [
+            frappe._dict(self.lines[0], status="Committed", transaction_id="T-1"),
+            frappe._dict(self.lines[1], status="Failed", message="Commit failed"),
+        ]
+
+        with (
+            patch.object(api, "process_split_tender", return_value=("Failed", lines)),
+            patch.object(api, "mark_payment_request_paid") as mark_paid,
+        ):
+            result = api.process_split_phone_payments("ACC-SINV-TEST", self.lines)
+
+        # money was taken for the first line even though the invoice is not paid
+        mark_paid.assert_called_once_with(payment_request="ACC-PRQ-TEST-1")
+        self.assertEqual(result["status"], "Failed")
+        self.assertEqual(result["message"], "Commit failed")
+        self.assertEqual(result["amount"], 8)
+
+    def test_errors_fail_every_line(self):
+        with (
+            patch.object(api, "process_split_tender", side_effect=frappe.ValidationError("Credentials not found")),
+            patch.object(api, "set_payment_status") as set_payment_status,
+        ):
+            self.assertRaises(frappe.ValidationError, api.process_split_phone_payments, "ACC-SINV-TEST", self.lines)
+
+        self.assertEqual(
+            [call.args for call in set_payment_status.call_args_list],
+            [("ACC-PRQ-TEST-1", "Failed"), ("ACC-PRQ-TEST-2", "Failed")],
+        )
+
+
+class TestCaptureModes(FrappeTestCase):
+    def setUp(self):
+        self.payloads = []
+        self.responses = {
+            "API_PREAUTHORIZE": {"responseCode": "2001", "errorCode": "0", "params": {"state": "APPROVED", "transactionId": "T-1"}},
+            "API_PURCHASE": {"responseCode": "2001", "errorCode": "0", "params": {"state": "APPROVED", "transactionId": "T-1"}},
+            "API_PREAUTHORIZE_COMMIT": {"responseCode": "2001", "errorCode": "0", "responseMsg": "RCS_SUCCESS"},
+        }
+
+        def send_request(client, payload, log=None):
+            self.payloads.append(payload)
+            return self.responses[payload["serviceName"]]
+
+        for target, attribute, kwargs in (
+            (WaafiPayClient, "send_request", {"autospec": True, "side_effect": send_request}),
+            (api, "make_log", {"return_value": frappe._dict()}),
+            (api, "update_log", {}),
+            (api, "set_payment_status", {}),
+        ):
+            patcher = patch.object(target, attribute, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def preauthorize(self, capture_mode):
+        credentials = make_credentials_record(capture_mode=capture_mode)
+
+        with (
+            patch.object(api, "get_credentials", return_value=credentials),
+            patch.object(api, "mark_payment_request_paid") as mark_paid,
+        ):
+            api.preauthorize_payment(payment_request="ACC-PRQ-TEST-2", **PAYMENT_ARGS)
+
+        return mark_paid
+
+    def test_purchase_captures_in_one_round_trip(self):
+        mark_paid = self.preauthorize("Purchase")
+
+        self.assertEqual([payload["serviceName"] for payload in self.payloads], ["API_PURCHASE"])
+        # never looked up by invoice: a split or retried invoice has several Payment Requests
+        mark_paid.assert_called_once_with("ACC-SINV-TEST", payment_request="ACC-PRQ-TEST-2")
+
+    def test_preauthorize_and_commit(self):
+        mark_paid = self.preauthorize("Preauthorize and Commit")
+
+        self.assertEqual(
+            [payload["serviceName"] for payload in self.payloads], ["API_PREAUTHORIZE", "API_PREAUTHORIZE_COMMIT"]
+        )
+        self.assertEqual(self.payloads[1]["serviceParams"]["transactionId"], "T-1")
+        mark_paid.assert_called_once_with("ACC-SINV-TEST", payment_request="ACC-PRQ-TEST-2")
+
+    def test_declined_purchase_is_not_paid(self):
+        self.responses["API_PURCHASE"] = {"responseCode": "2001", "errorCode": "0", "params": {"state": "DECLINED"}}
+
+        with patch.object(api, "mark_payment_request_paid") as mark_paid:
+            self.assertRaises(frappe.ValidationError, self.preauthorize, "Purchase")
+
+        mark_paid.assert_not_called()
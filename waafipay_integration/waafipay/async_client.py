@@ -0,0 +1,126 @@
+import asyncio
+import itertools
+import time
+
+import aiohttp
+
+from waafipay_integration.waafipay.rate_limit import BACKGROUND
+from waafipay_integration.waafipay.session import DEFAULT_POOL_SIZE, HEADERS
+from waafipay_integration.waafipay.waafipay_client import WaafiPayClient
+
+DEFAULT_CONCURRENCY = 10
+
+
+class AsyncWaafiPayClient(WaafiPayClient):
+    """
+    asyncio sibling of `WaafiPayClient` for fanning out many gateway calls from one process.
+
+    Credentials are resolved and payloads are built synchronously through the shared
+    `WaafiPayClient` builders; only the HTTP exchange is awaited. `max_concurrency`
+    bounds the number of in-flight requests and `timeout` is the default deadline
+    (in seconds) of a single call, including the time spent waiting for a slot; it
+    defaults to the deadline of the service's `RetryPolicy`.
+    Transient failures are retried with the same `RetryPolicy` as the sync client.
+    Calls go through the merchant's rate limit in the background lane unless
+    `priority="interactive"` is passed.
+
+        async with AsyncWaafiPayClient("WaafiPay", max_concurrency=20) as client:
+            results = await client.gather(
+                client.commit_authorized_payment(transaction_id) for transaction_id in transaction_ids
+            )
+    """
+
+    def __init__(self, credentials, max_concurrency=DEFAULT_CONCURRENCY, timeout=None, priority=BACKGROUND):
+        super().__init__(credentials, priority=priority)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(
+            limit=max(self.max_concurrency, self.settings.get("connection_pool_size") or DEFAULT_POOL_SIZE),
+        )
+        self._session = aiohttp.ClientSession(connector=connector, headers=HEADERS)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._session.close()
+        self._session = None
+
+    async def preauthorize_payment(self, phone_number, amount, currency, invoice_id=None, timeout=None):
+        self.validate_currency(currency)
+        payload = self.build_preauthorize_payload(phone_number, amount, currency, invoice_id)
+        return await self.send_request(payload, timeout=timeout)
+
+    async def purchase(self, phone_number, amount, currency, invoice_id=None, timeout=None):
+        self.validate_currency(currency)
+        payload = self.build_purchase_payload(phone_number, amount, currency, invoice_id)
+        return await self.send_request(payload, timeout=timeout)
+
+    async def commit_authorized_payment(self, transaction_id, description=None, timeout=None):
+        return await self.send_request(self.build_commit_payload(transaction_id, description), timeout=timeout)
+
+    async def cancel_authorized_payment(self, transaction_id, description=None, timeout=None):
+        return await self.send_request(self.build_cancel_payload(transaction_id, description), timeout=timeout)
+
+    async def get_transaction_info(self, reference_id, timeout=None):
+        return await self.send_request(self.build_transaction_info_payload(reference_id), timeout=timeout)
+
+    async def create_payment_link(self, reference_id, amount, currency, description, timeout=None):
+        payload = self.build_hpp_payload(reference_id, amount, currency, description)
+        return await self.send_request(payload, timeout=timeout)
+
+    async def send_request(self, payload, timeout=None):
+        policy = self.get_retry_policy(payload.get("serviceName"))
+        return await asyncio.wait_for(self._send(payload, policy), timeout or self.timeout or policy.deadline + policy.connect_timeout)
+
+    async def _send(self, payload, policy):
+        if not self._session:
+            raise RuntimeError("AsyncWaafiPayClient must be used as an async context manager")
+
+        deadline = policy.start()
+
+        for attempt in itertools.count(1):
+            try:
+                return await self._send_once(payload, policy.timeout(deadline))
+            except aiohttp.ClientResponseError as e:
+                error, retryable = e, policy.is_retryable(e.status)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error, retryable = e, policy.is_retryable(sent=not isinstance(e, aiohttp.ClientConnectorError))
+
+            delay = policy.get_delay(attempt)
+            if not retryable or not policy.should_retry(attempt, deadline, delay):
+                raise error
+
+            await asyncio.sleep(delay)
+
+    async def _send_once(self, payload, timeout):
+        connect_timeout, read_timeout = timeout
+
+        async with self._semaphore:
+            probe = self.breaker.before_call()
+            if self.rate_limiter:
+                await self.rate_limiter.acquire_async()
+
+            start = time.monotonic()
+            try:
+                async with self._session.post(
+                    f"{self.base_url}/asm",
+                    json=payload,
+                    timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+                ) as response:
+                    if response.status >= 500:
+                        self.breaker.record_failure(probe)
+                    else:
+                        self.breaker.record_success(time.monotonic() - start, probe, payload.get("serviceName"))
+
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                self.breaker.record_failure(probe)
+                raise
+
+    async def gather(self, calls):
+        """Run `calls` concurrently; failed calls (including deadlines) are returned as exceptions."""
+        return await asyncio.gather(*calls, return_exceptions=True)
@@ -0,0 +1,383 @@
+"""
+End-to-end load benchmark of the WaafiPay hot paths against the local mock gateway.
+
+Run it through the bench command, e.g.
+
+    bench --site mysite waafipay-benchmark --payment-gateway-account "WaafiPay - USD" \
+        --concurrency 1,8,32 --transactions 500 --latency lognormal:80,0.4
+
+Every transaction is rolled back (WaafiPay Logs are still written, as they are in
+production), so it is safe on a staging site but not meant for production.
+The settlement scenarios submit a fresh Payment Request against --invoice before the clock
+starts and settle it with a callback for its name and amount. Each transaction uses its own
+phone number or Payment Request, so nothing is answered from the single-flight or
+idempotency caches.
+"""
+
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import frappe
+
+from waafipay_integration.waafipay.mock_server import start_mock_server
+
+SCENARIOS = (
+    "create_payment_request",
+    "generate_payment_link",
+    # settling a success callback, as the synchronous callback or an inbox consumer does
+    "payment_received",
+    # an inbox consumer picking up a stored callback and settling it
+    "inbox_consumer",
+    # the message rendered for every new Payment Request, with and without the template cache
+    "render_message",
+    "render_message_uncached",
+)
+
+# what each scenario needs from the command line
+REQUIREMENTS = {
+    "create_payment_request": ("payment_gateway_account", "invoice"),
+    "generate_payment_link": ("payment_gateway_account",),
+    "payment_received": ("payment_gateway_account", "invoice"),
+    "inbox_consumer": ("payment_gateway_account", "invoice"),
+    "render_message": ("invoice",),
+    "render_message_uncached": ("invoice",),
+}
+
+
+def run_benchmark(
+    site,
+    scenarios=None,
+    concurrency=(1, 8),
+    transactions=200,
+    payment_gateway_account=None,
+    invoice=None,
+    latency="fixed:50",
+    error_rate=0.0,
+):
+    """Start the mock gateway, run every scenario at every concurrency level and return the results."""
+    context = _get_context(payment_gateway_account, invoice)
+    scenarios = scenarios or [s for s in SCENARIOS if _is_runnable(s, context)]
+
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            frappe.throw(f"Unknown scenario {scenario}, pick one of {', '.join(SCENARIOS)}")
+        if not _is_runnable(scenario, context):
+            options = " and ".join(f"--{option.replace('_', '-')}" for option in REQUIREMENTS[scenario])
+            frappe.throw(f"Scenario {scenario} needs {options}")
+
+    process, base_url = start_mock_server(latency=latency, error_rate=error_rate)
+    try:
+        return [
+            run_scenario(site, scenario, level, transactions, base_url, context)
+            for scenario in scenarios
+            for level in concurrency
+        ]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_scenario(site, scenario, concurrency, transactions, base_url, context):
+    run = globals()[f"_run_{scenario}"]
+    # builds the documents a sample works on, outside of its timing and query count
+    setup = globals().get(f"_setup_{scenario}")
+    samples = []
+    lock = threading.Lock()
+
+    def worker(count):
+        _connect(site, base_url)
+        queries = _count_queries()
+        try:
+            for _ in range(count):
+                try:
+                    kwargs = setup(context) if setup else {}
+                except Exception:
+                    frappe.db.rollback()
+                    raise
+
+                queries[0] = 0
+                start = time.perf_counter()
+                try:
+                    run(context, **kwargs)
+                    ok = True
+                except Exception:
+                    ok = False
+                finally:
+                    # rolling back also flushes the WaafiPay Logs of the transaction
+                    frappe.db.rollback()
+
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    samples.append((elapsed, queries[0], ok))
+        finally:
+            frappe.destroy()
+
+    counts = [transactions // concurrency + (i < transactions % concurrency) for i in range(concurrency)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, [c for c in counts if c]))
+    wall_time = time.perf_counter() - start
+
+    return summarize(scenario, concurrency, samples, wall_time)
+
+
+def summarize(scenario, concurrency, samples, wall_time):
+    latencies = sorted(s[0] for s in samples)
+    count = len(samples)
+
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "transactions": count,
+        "errors": sum(1 for s in samples if not s[2]),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "throughput": count / wall_time if wall_time else 0.0,
+        "queries_per_transaction": sum(s[1] for s in samples) / count if count else 0.0,
+    }
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def format_results(results):
+    header = ("scenario", "conc", "tx", "errors", "p50 ms", "p95 ms", "p99 ms", "tx/s", "queries/tx")
+    rows = [
+        (
+            r["scenario"],
+            str(r["concurrency"]),
+            str(r["transactions"]),
+            str(r["errors"]),
+            f"{r['p50']:.1f}",
+            f"{r['p95']:.1f}",
+            f"{r['p99']:.1f}",
+            f"{r['throughput']:.1f}",
+            f"{r['queries_per_transaction']:.1f}",
+        )
+        for r in results
+    ]
+    widths = [max(len(row[i]) for row in [header, *rows]) for i in range(len(header))]
+
+    return "\n".join(
+        "  ".join(value.ljust(width) if i == 0 else value.rjust(width) for i, (value, width) in enumerate(zip(row, widths)))
+        for row in [header, *rows]
+    )
+
+
+def _connect(site, base_url):
+    frappe.init(site=site)
+    frappe.connect()
+    frappe.set_user("Administrator")
+    frappe.local.conf.waafipay_api_base_url = base_url
+
+
+def _count_queries():
+    """Count every statement sent through `frappe.db.sql` (query builder included) on this thread."""
+    counter = [0]
+    sql = frappe.db.sql
+
+    def counted_sql(*args, **kwargs):
+        counter[0] += 1
+        return sql(*args, **kwargs)
+
+    frappe.db.sql = counted_sql
+    return counter
+
+
+def _get_context(payment_gateway_account, invoice):
+    from waafipay_integration.waafipay.waafipay_client import get_credentials
+
+    context = frappe._dict(payment_gateway_account=payment_gateway_account)
+
+    if payment_gateway_account:
+        credentials = get_credentials(payment_gateway_account)
+        if not credentials:
+            frappe.throw(f"No WaafiPay Credentials for {payment_gateway_account}")
+        context.currency = next(iter(sorted(credentials.currencies)), None)
+        context.mode_of_payment = next(iter(sorted(credentials.modes)), None)
+
+    if invoice:
+        doctype = "POS Invoice" if frappe.db.exists("POS Invoice", invoice) else "Sales Invoice"
+        doc = frappe.get_doc(doctype, invoice)
+        if doc.docstatus != 1 or doc.outstanding_amount <= 0:
+            frappe.throw(f"{doctype} {invoice} must be submitted and have an outstanding amount")
+
+        context.invoice = doc.as_json()
+        context.invoice_doctype = doctype
+        context.invoice_name = doc.name
+
+    return context
+
+
+def _is_runnable(scenario, context):
+    return all(context.get(option) for option in REQUIREMENTS[scenario])
+
+
+def _run_create_payment_request(context):
+    from waafipay_integration.api import create_payment_request
+
+    # a new phone number gives every iteration its own single-flight key
+    doc = json.loads(context.invoice)
+    doc["contact_mobile"] = f"25261{random.randrange(10 ** 7):07d}"
+    for pay in doc.get("payments") or []:
+        pay.pop("contact_mobile", None)
+
+    create_payment_request(json.dumps(doc))
+
+
+def _run_generate_payment_link(context):
+    from waafipay_integration.waafipay.waafipay_client import generate_payment_link
+
+    doc = frappe._dict(
+        name=f"BENCH-{uuid.uuid4().hex[:10]}",
+        create_payment_request=1,
+        payment_gateway_account=context.payment_gateway_account,
+        grand_total=10,
+        currency=context.currency,
+        reference_name="BENCH",
+        flags=frappe._dict(),
+    )
+    doc.db_update = lambda: None
+
+    generate_payment_link(doc)
+    if not doc.waafipay_payment_link:
+        raise frappe.ValidationError("No payment link returned")
+
+
+def _setup_payment_received(context):
+    return {"callback": _make_callback(_make_payment_request(context))}
+
+
+def _run_payment_received(context, callback):
+    from waafipay_integration.waafipay.waafipay_client import handle_payment_received
+
+    # the settlement itself: payment_received would only store the callback in Inbox mode
+    _check_settled(handle_payment_received(callback))
+
+
+def _setup_inbox_consumer(context):
+    from waafipay_integration.waafipay.idempotency import get_idempotency_key
+    from waafipay_integration.waafipay.inbox import DOCTYPE
+
+    callback = _make_callback(_make_payment_request(context))
+    # stored as receive_callback does, without waking the real consumers
+    entry = frappe.get_doc({
+        "doctype": DOCTYPE,
+        "callback_type": "Success",
+        "status": "Processing",
+        "idempotency_key": get_idempotency_key(callback),
+        "payload": json.dumps(callback),
+    }).insert(ignore_permissions=True)
+
+    return {"entry": entry.name}
+
+
+def _run_inbox_consumer(context, entry):
+    from waafipay_integration.waafipay.inbox import DOCTYPE, process_entry
+
+    # process_entry commits its outcome; keep it in the transaction so the Payment Entry is
+    # rolled back with the sample (the commit itself is not measured)
+    with _without_commit():
+        process_entry(entry)
+
+    if frappe.db.get_value(DOCTYPE, entry, "status") != "Processed":
+        raise frappe.ValidationError(f"Inbox entry {entry} not processed")
+
+
+def _make_payment_request(context):
+    from waafipay_integration.overrides.payment_request import make_payment_request
+
+    return make_payment_request(
+        dt=context.invoice_doctype,
+        dn=context.invoice_name,
+        payment_gateway_account=context.payment_gateway_account,
+        mode_of_payment=context.mode_of_payment,
+        submit_doc=1,
+        mute_email=1,
+        return_doc=1,
+    )
+
+
+def _make_callback(payment_request):
+    return {
+        "responseCode": "2001",
+        "errorCode": "0",
+        "params": {
+            "state": "APPROVED",
+            "referenceId": payment_request.name,
+            "transactionId": uuid.uuid4().hex[:12],
+            "txAmount": f"{payment_request.grand_total:.2f}",
+        },
+    }
+
+
+def _check_settled(outcome):
+    if (outcome or {}).get("status") != "Success":
+        raise frappe.ValidationError(f"Callback not settled: {outcome}")
+
+
+@contextmanager
+def _without_commit():
+    commit = frappe.db.commit
+    frappe.db.commit = lambda: None
+    try:
+        yield
+    finally:
+        frappe.db.commit = commit
+
+
+def _run_render_message(context):
+    from waafipay_integration.overrides.payment_request import DUMMY_MESSAGE
+    from waafipay_integration.waafipay.templates import render_template
+
+    render_template(DUMMY_MESSAGE, {"doc": _get_invoice_doc(context), "payment_url": "{{ payment_url }}"})
+
+
+def _run_render_message_uncached(context):
+    from waafipay_integration.overrides.payment_request import DUMMY_MESSAGE
+
+    frappe.render_template(DUMMY_MESSAGE, {"doc": _get_invoice_doc(context), "payment_url": "{{ payment_url }}"})
+
+
+def _get_invoice_doc(context):
+    if getattr(frappe.local, "waafipay_benchmark_invoice", None) is None:
+        frappe.local.waafipay_benchmark_invoice = frappe.get_doc(json.loads(context.invoice))
+
+    return frappe.local.waafipay_benchmark_invoice
+
+
+def save_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def find_regressions(results, baseline, threshold=0.2):
+    """Scenarios whose p95 grew or throughput dropped by more than `threshold` against `baseline`."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline}
+    regressions = []
+
+    for result in results:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if not before:
+            continue
+
+        if before["p95"] and result["p95"] > before["p95"] * (1 + threshold):
+            regressions.append(f"{result['scenario']} x{result['concurrency']}: p95 {before['p95']:.1f} -> {result['p95']:.1f} ms")
+        if before["throughput"] and result["throughput"] < before["throughput"] * (1 - threshold):
+            regressions.append(
+                f"{result['scenario']} x{result['concurrency']}: throughput {before['throughput']:.1f} -> {result['throughput']:.1f} tx/s"
+            )
+
+    return regressions
@@ -0,0 +1,243 @@
+import json
+
+import frappe
+from frappe import _
+
+from waafipay_integration.waafipay.idempotency import (
+    claim_callback,
+    get_idempotency_key,
+    record_callback_outcome,
+    release_callback,
+)
+from waafipay_integration.waafipay.log_retention import decompress_payloads
+from waafipay_integration.waafipay.log_sink import LOG_DOCTYPE
+from waafipay_integration.waafipay.metrics import increment, traced
+from waafipay_integration.waafipay.payment_status import get_payment_queue, set_payment_status
+from waafipay_integration.waafipay.sweeper import APPROVED_STATES, check_transactions, is_approved
+
+RETRYABLE_STATUSES = ("Failed", "Initiated", "Error")
+CHUNK_SIZE = 100
+REALTIME_EVENT = "waafipay_bulk_retry_progress"
+PROGRESS_KEY = "waafipay_bulk_retry:{batch}"
+PROGRESS_TTL = 24 * 60 * 60
+
+
+@frappe.whitelist()
+def retry_logs(names):
+    """
+    Replay the settlement of many WaafiPay Logs in background chunks of `CHUNK_SIZE`.
+
+    Progress and the result of every log are pushed to the calling user as each chunk
+    finishes. Returns the batch id, which tags those updates, and the number of logs queued.
+    """
+    frappe.only_for("System Manager")
+
+    if isinstance(names, str):
+        names = json.loads(names)
+
+    names = frappe.get_all(
+        LOG_DOCTYPE,
+        filters={"name": ["in", list(set(names))], "status": ["in", RETRYABLE_STATUSES]},
+        order_by="creation asc",
+        pluck="name",
+    ) if names else []
+
+    if not names:
+        frappe.throw(_("None of the selected logs can be retried"))
+
+    batch = frappe.generate_hash(length=10)
+    cache = frappe.cache()
+    progress_key = cache.make_key(PROGRESS_KEY.format(batch=batch))
+    cache.set(f"{progress_key}:total", len(names), ex=PROGRESS_TTL)
+    cache.set(f"{progress_key}:done", 0, ex=PROGRESS_TTL)
+
+    for index in range(0, len(names), CHUNK_SIZE):
+        frappe.enqueue(
+            "waafipay_integration.waafipay.bulk_retry.process_chunk",
+            queue=get_payment_queue(),
+            # a chunk is only queued once, and running it again is harmless (see retry_chunk)
+            job_id=f"waafipay_bulk_retry::{batch}::{index // CHUNK_SIZE}",
+            deduplicate=True,
+            enqueue_after_commit=True,
+            batch=batch,
+            names=names[index:index + CHUNK_SIZE],
+            user=frappe.session.user,
+        )
+
+    return {"batch": batch, "total": len(names)}
+
+
+def process_chunk(batch, names, user=None):
+    results = retry_chunk(names)
+    frappe.db.commit()
+
+    cache = frappe.cache()
+    progress_key = cache.make_key(PROGRESS_KEY.format(batch=batch))
+    done = cache.incrby(f"{progress_key}:done", len(names))
+    total = int(cache.get(f"{progress_key}:total") or done)
+
+    frappe.publish_realtime(
+        REALTIME_EVENT,
+        {"batch": batch, "done": done, "total": total, "results": results},
+        user=user or frappe.session.user,
+    )
+
+
+@traced("retry_logs")
+def retry_chunk(names):
+    """
+    Settle the Payment Requests of `names` and write each outcome back to its log.
+
+    Logs and Payment Requests are loaded with one query each. A Payment Request is only
+    settled on proof of payment: an approved callback stored on the log, or else an approved
+    HPP_GETTRANINFO answer for its payment link. Retrying is idempotent: logs already settled
+    are skipped, a Payment Request that is Paid only closes its logs, and each Payment Request
+    is settled once, under the same idempotency key as its gateway callback and after its
+    status has been read again.
+    """
+    logs = frappe.get_all(
+        LOG_DOCTYPE,
+        filters={"name": ["in", names]},
+        fields=[
+            "name", "status", "reference_id", "transaction_id",
+            "request_payload", "response_data", "compressed_payloads",
+        ],
+    )
+    for log in logs:
+        request, response = get_payloads(log)
+        log.reference_id = log.reference_id or get_reference_id(response)
+        log.approved = is_approved_callback(request, response)
+
+    references = [log.reference_id for log in logs if log.reference_id]
+    payment_requests = {
+        row.name: frappe.get_doc({**row, "doctype": "Payment Request"})
+        for row in frappe.get_all("Payment Request", filters={"name": ["in", references]}, fields=["*"])
+    } if references else {}
+
+    # without a callback to go by, ask the gateway about the payment link
+    approved = {log.reference_id for log in logs if log.approved}
+    unconfirmed = [
+        pr for name, pr in payment_requests.items()
+        if name not in approved and pr.status != "Paid" and pr.get("waafipay_payment_link")
+    ]
+    approved.update(pr.name for pr, response in check_transactions(unconfirmed) if is_approved(response))
+
+    # a Payment Request is settled once however many of its logs were selected
+    outcomes, groups = {}, {}
+    for log in logs:
+        if log.status in RETRYABLE_STATUSES:
+            groups.setdefault(log.reference_id, []).append(log)
+        else:
+            outcomes[log.name] = {"status": "Skipped", "message": _("Already {0}").format(log.status)}
+
+    for reference_id, group in groups.items():
+        outcome = retry_payment_request(reference_id, payment_requests.get(reference_id), group, reference_id in approved)
+        outcomes.update((log.name, outcome) for log in group)
+
+    results = []
+    for log in logs:
+        result = {"log": log.name, "reference_id": log.reference_id, **outcomes[log.name]}
+        increment("waafipay_log_retries_total", status=result["status"])
+        results.append(result)
+
+    return results
+
+
+def retry_payment_request(reference_id, payment_request, logs, approved):
+    """Settle `payment_request` once for all of its `logs` and return the outcome they share."""
+    if not payment_request:
+        message = _("Payment Request {0} not found").format(reference_id) if reference_id else _("Reference ID not found")
+        set_log_status(logs, "Failed", message)
+        return {"status": "Failed", "message": message}
+
+    if payment_request.status == "Paid":
+        set_log_status(logs, "Success")
+        return {"status": "Success", "message": _("Payment Request was already paid")}
+
+    if not approved:
+        # the logs themselves are still accurate, nothing was settled
+        return {"status": "Failed", "message": _("No approved payment found for {0}").format(payment_request.name)}
+
+    # one key per Payment Request, the very key its gateway callback claims
+    key = get_idempotency_key({"referenceId": payment_request.name})
+    claimed, outcome = claim_callback(key)
+    if not claimed:
+        if outcome.get("status") == "Success":
+            set_log_status(logs, "Success")
+            return {"status": "Success", "message": _("Already settled")}
+
+        return {"status": "Skipped", "message": _("Being processed by another worker")}
+
+    # settled by a callback or another chunk since this chunk was loaded
+    if frappe.db.get_value("Payment Request", payment_request.name, "status") == "Paid":
+        release_callback(key)
+        set_log_status(logs, "Success")
+        return {"status": "Success", "message": _("Payment Request was already paid")}
+
+    try:
+        frappe.db.savepoint("waafipay_retry_log")
+        payment_request.flags.ignore_permissions = True
+        payment_entry = payment_request.create_payment_entry()
+    except Exception as e:
+        frappe.db.rollback(save_point="waafipay_retry_log")
+        frappe.clear_last_message()
+        release_callback(key)
+        set_log_status(logs, "Failed", str(e))
+        return {"status": "Failed", "message": str(e)}
+
+    record_callback_outcome(
+        key,
+        {"status": "Success", "log": logs[0].name, "reference_id": payment_request.name},
+        log=logs[0].name,
+        transaction_id=next((log.transaction_id for log in logs if log.transaction_id), None),
+    )
+    set_log_status(logs, "Success")
+    set_payment_status(payment_request.name, "Paid", after_commit=True)
+
+    return {"status": "Success", "payment_entry": getattr(payment_entry, "name", None)}
+
+
+def set_log_status(logs, status, error_message=None):
+    values = {"status": status}
+    if error_message:
+        values["error_message"] = error_message
+
+    for log in logs:
+        frappe.db.set_value(LOG_DOCTYPE, log.name, values)
+
+
+def get_payloads(log):
+    """`(request, response)` of `log` as dicts, from the compressed copy once the columns are cleared."""
+    values = {"request_payload": log.request_payload, "response_data": log.response_data}
+    if not any(values.values()) and log.compressed_payloads:
+        values = decompress_payloads(log.compressed_payloads)
+
+    return [_load(values.get(fieldname)) for fieldname in ("request_payload", "response_data")]
+
+
+def _load(value):
+    try:
+        value = json.loads(value) if isinstance(value, str) else value
+    except ValueError:
+        return {}
+
+    return value if isinstance(value, dict) else {}
+
+
+def is_approved_callback(request, response):
+    """Whether the log holds an approved payment callback, rather than a request we sent (payment link, preauthorize...)."""
+    if request.get("serviceParams"):
+        return False
+
+    params = response.get("params") if isinstance(response.get("params"), dict) else {}
+    return (
+        response.get("responseCode") == "2001"
+        and response.get("errorCode") in ("0", 0, None)
+        # process_payment_received settles a 2001 callback that carries no state as well
+        and str(params.get("state") or "APPROVED").upper() in APPROVED_STATES
+    )
+
+
+def get_reference_id(response):
+    params = response.get("params") if isinstance(response.get("params"), dict) else {}
+    return response.get("referenceId") or params.get("referenceId")
@@ -0,0 +1,173 @@
+import time
+
+import frappe
+import requests
+from frappe import _
+from frappe.utils import cint, flt
+
+from waafipay_integration.waafipay.credentials import get_credentials_record
+from waafipay_integration.waafipay.session import get_base_url
+
+CIRCUIT_KEY = "waafipay_circuit:{name}:{base_url}"
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_SLOW_CALL_THRESHOLD = 10
+DEFAULT_OPEN_SECONDS = 30
+DEFAULT_HALF_OPEN_PROBES = 1
+FAILURE_WINDOW = 60
+TRIPPED_TTL = 24 * 60 * 60
+# these block until the customer answers on the phone, so a slow call is not a sign of trouble
+CUSTOMER_WAIT_SERVICES = ("API_PREAUTHORIZE", "API_PURCHASE")
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised instead of calling a WaafiPay endpoint that is known to be down."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for one credential / base URL, shared by every worker through Redis.
+
+    closed: calls go through; connection errors, timeouts, HTTP 5xx and slow calls are
+        counted, and `failure_threshold` of them within a minute open the circuit.
+        Calls of `CUSTOMER_WAIT_SERVICES` are never counted as slow.
+    open: calls fail fast with `CircuitOpenError` for `open_seconds`.
+    half-open: after that, up to `half_open_probes` concurrent calls are let through.
+        A healthy probe closes the circuit and a failed one opens it again.
+
+    A closed circuit costs one Redis round-trip per call.
+    """
+
+    def __init__(
+        self,
+        name,
+        base_url,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        slow_call_threshold=DEFAULT_SLOW_CALL_THRESHOLD,
+        open_seconds=DEFAULT_OPEN_SECONDS,
+        half_open_probes=DEFAULT_HALF_OPEN_PROBES,
+        enabled=True,
+    ):
+        self.name = name
+        self.base_url = base_url
+        self.failure_threshold = failure_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.enabled = enabled
+
+        self.cache = frappe.cache()
+        prefix = self.cache.make_key(CIRCUIT_KEY.format(name=name, base_url=base_url))
+        self.keys = frappe._dict(
+            failures=f"{prefix}:failures",
+            open=f"{prefix}:open",
+            tripped=f"{prefix}:tripped",
+            probes=f"{prefix}:probes",
+        )
+
+    @classmethod
+    def for_credentials(cls, credentials):
+        return cls(
+            credentials.name,
+            get_base_url(credentials),
+            failure_threshold=cint(credentials.get("circuit_failure_threshold")) or DEFAULT_FAILURE_THRESHOLD,
+            slow_call_threshold=flt(credentials.get("circuit_slow_call_threshold")) or DEFAULT_SLOW_CALL_THRESHOLD,
+            open_seconds=cint(credentials.get("circuit_open_seconds")) or DEFAULT_OPEN_SECONDS,
+            half_open_probes=cint(credentials.get("circuit_half_open_probes")) or DEFAULT_HALF_OPEN_PROBES,
+            enabled=bool(cint(credentials.get("circuit_breaker_enabled", 1))),
+        )
+
+    def before_call(self):
+        """Raise `CircuitOpenError` while open; returns True when the call is a half-open probe."""
+        if not self.enabled or not self.cache.exists(self.keys.tripped):
+            return False
+
+        if self.cache.exists(self.keys.open):
+            raise self.open_error()
+
+        probes = self.cache.incr(self.keys.probes)
+        # a probe that never reports back must not keep the circuit half-open forever
+        self.cache.expire(self.keys.probes, max(self.open_seconds, FAILURE_WINDOW))
+        if probes > self.half_open_probes:
+            raise self.open_error()
+
+        return True
+
+    def record_success(self, elapsed, probe=False, service_name=None):
+        if not self.enabled:
+            return
+
+        if elapsed > self.slow_call_threshold and service_name not in CUSTOMER_WAIT_SERVICES:
+            return self.record_failure(probe)
+
+        if probe:
+            self.close()
+
+    def record_failure(self, probe=False):
+        if not self.enabled:
+            return
+
+        if probe:
+            return self.trip()
+
+        failures = self.cache.incr(self.keys.failures)
+        if failures == 1:
+            self.cache.expire(self.keys.failures, FAILURE_WINDOW)
+
+        if failures >= self.failure_threshold:
+            self.trip()
+
+    def trip(self):
+        now = time.time()
+        pipe = self.cache.pipeline()
+        pipe.set(self.keys.open, now, ex=self.open_seconds)
+        pipe.set(self.keys.tripped, now, ex=TRIPPED_TTL)
+        pipe.delete(self.keys.failures, self.keys.probes)
+        pipe.execute()
+
+        frappe.logger("waafipay").warning(f"Circuit for {self.name} ({self.base_url}) opened for {self.open_seconds}s")
+
+    def close(self):
+        self.cache.delete(*self.keys.values())
+
+    def get_state(self):
+        tripped = self.cache.get(self.keys.tripped)
+        retry_in = self.cache.ttl(self.keys.open) if tripped else -2
+
+        if not tripped:
+            state = "Closed"
+        elif retry_in > 0:
+            state = "Open"
+        else:
+            state = "Half-Open"
+
+        return {
+            "state": state,
+            "enabled": self.enabled,
+            "failures": cint(self.cache.get(self.keys.failures)),
+            "failure_threshold": self.failure_threshold,
+            "opened_at": flt(tripped) or None,
+            "retry_in": max(retry_in, 0),
+            "base_url": self.base_url,
+        }
+
+    def open_error(self):
+        retry_in = max(self.cache.ttl(self.keys.open), 1)
+        return CircuitOpenError(
+            _("WaafiPay is not responding, payments through {0} are paused for {1} seconds. Please try again shortly or use another payment method.").format(
+                self.name, retry_in
+            )
+        )
+
+
+@frappe.whitelist()
+def get_circuit_state(credentials):
+    frappe.has_permission("WaafiPay Credentials", "read", credentials, throw=True)
+
+    return CircuitBreaker.for_credentials(get_credentials_record(credentials)).get_state()
+
+
+@frappe.whitelist()
+def reset_circuit(credentials):
+    frappe.has_permission("WaafiPay Credentials", "write", credentials, throw=True)
+
+    CircuitBreaker.for_credentials(get_credentials_record(credentials)).close()
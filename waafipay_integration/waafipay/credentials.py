@@ -0,0 +1,151 @@
+import threading
+
+import frappe
+from frappe.model import no_value_fields, table_fields
+from frappe.utils.password import get_decrypted_password
+
+DOCTYPE = "WaafiPay Credentials"
+RECORD_KEY = "waafipay_credentials"
+GATEWAY_KEY = "waafipay_gateway_credentials"
+GATEWAY_ACCOUNTS_KEY = "waafipay_gateway_accounts"
+GATEWAY_ACCOUNT_FIELDS = ["name", "payment_gateway", "payment_account", "message", "payment_channel"]
+
+# Decrypted passwords never leave the worker: they are kept here, keyed by
+# (site, credentials name, modified), while Redis only holds the non secret record.
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+
+class WaafiPayCredentialsRecord(frappe._dict):
+    """Compact, cacheable view of a `WaafiPay Credentials` doc."""
+
+    def get_password(self, fieldname="api_key", raise_exception=True):
+        value = _get_secrets(self).get(fieldname)
+        if not value and raise_exception:
+            # let frappe raise its usual "Password not found" error
+            return get_decrypted_password(DOCTYPE, self.name, fieldname, raise_exception=True)
+
+        return value
+
+
+def get_credentials_record(credentials_name):
+    local_cache = _get_local_cache()
+    if credentials_name in local_cache:
+        return local_cache[credentials_name]
+
+    record = frappe.cache().hget(RECORD_KEY, credentials_name, lambda: _build_record(credentials_name))
+    local_cache[credentials_name] = record
+    return record
+
+
+def get_gateway_credentials(payment_gateway_account):
+    """Resolve Payment Gateway Account -> Payment Gateway -> WaafiPay Credentials, cached."""
+    credentials_name = frappe.cache().hget(
+        GATEWAY_KEY, payment_gateway_account, lambda: _get_credentials_name(payment_gateway_account)
+    )
+
+    if credentials_name:
+        return get_credentials_record(credentials_name)
+
+
+def get_gateway_account(name=None, currency=None, default=False):
+    """
+    Payment Gateway Account by `name`, by `currency` or the default one, from a cached map.
+
+    The map holds every account and is rebuilt after any Payment Gateway Account changes.
+    """
+    accounts = frappe.cache().get_value(GATEWAY_ACCOUNTS_KEY, _build_gateway_accounts)
+
+    if currency:
+        name = accounts["by_currency"].get(currency)
+    elif default:
+        name = accounts["default"]
+
+    if account := accounts["by_name"].get(name):
+        return frappe._dict(account)
+
+
+def clear_credentials_cache(credentials_name=None):
+    if credentials_name:
+        frappe.cache().hdel(RECORD_KEY, credentials_name)
+    else:
+        frappe.cache().delete_value(RECORD_KEY)
+
+    frappe.cache().delete_value(GATEWAY_KEY)
+    frappe.cache().delete_value(GATEWAY_ACCOUNTS_KEY)
+    frappe.local.waafipay_credentials = {}
+
+
+def on_gateway_change(doc, method=None):
+    clear_credentials_cache()
+
+
+def _get_credentials_name(payment_gateway_account):
+    payment_gateway = frappe.db.get_value("Payment Gateway Account", payment_gateway_account, "payment_gateway")
+
+    if payment_gateway:
+        return frappe.db.get_value("Payment Gateway", payment_gateway, "gateway_controller")
+
+
+def _build_gateway_accounts():
+    accounts = {"by_name": {}, "by_currency": {}, "default": None}
+
+    # same precedence as a get_value by currency: the most recently modified account wins
+    for account in frappe.get_all(
+        "Payment Gateway Account",
+        fields=GATEWAY_ACCOUNT_FIELDS + ["currency", "is_default"],
+        order_by="modified desc",
+    ):
+        accounts["by_name"][account.name] = {f: account.get(f) for f in GATEWAY_ACCOUNT_FIELDS}
+        if account.currency:
+            accounts["by_currency"].setdefault(account.currency, account.name)
+        if account.is_default and not accounts["default"]:
+            accounts["default"] = account.name
+
+    return accounts
+
+
+def _build_record(credentials_name):
+    if not frappe.db.exists(DOCTYPE, credentials_name):
+        return None
+
+    doc = frappe.get_doc(DOCTYPE, credentials_name)
+    record = WaafiPayCredentialsRecord(name=doc.name, modified=str(doc.modified))
+
+    for df in doc.meta.fields:
+        if df.fieldtype in table_fields:
+            record[df.fieldname] = [row.as_dict(no_default_fields=True) for row in doc.get(df.fieldname)]
+        elif df.fieldtype != "Password" and df.fieldtype not in no_value_fields:
+            record[df.fieldname] = doc.get(df.fieldname)
+
+    record.currencies = {row.currency for row in doc.supported_currencies}
+    record.modes = {row.mode_of_payment for row in doc.waafipay_modes}
+    return record
+
+
+def _get_secrets(record):
+    site = frappe.local.site
+    key = (site, record.name, record.modified)
+    secrets = _secrets.get(key)
+    if secrets is not None:
+        return secrets
+
+    meta = frappe.get_meta(DOCTYPE)
+    secrets = {
+        df.fieldname: get_decrypted_password(DOCTYPE, record.name, df.fieldname, raise_exception=False)
+        for df in meta.get("fields", {"fieldtype": "Password"})
+    }
+
+    with _secrets_lock:
+        for stale in [k for k in _secrets if k[:2] == (site, record.name)]:
+            del _secrets[stale]
+        _secrets[key] = secrets
+
+    return secrets
+
+
+def _get_local_cache():
+    if getattr(frappe.local, "waafipay_credentials", None) is None:
+        frappe.local.waafipay_credentials = {}
+
+    return frappe.local.waafipay_credentials
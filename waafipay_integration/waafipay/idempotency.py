@@ -0,0 +1,110 @@
+import json
+
+import frappe
+
+DOCTYPE = "WaafiPay Processed Callback"
+CALLBACK_KEY = "waafipay_callback:{key}"
+HITS_KEY = "waafipay_callback_hits"
+PENDING = "__pending__"
+TTL = 7 * 24 * 60 * 60
+# a claim whose worker died before it could release it must not block the callback for long
+PENDING_TTL = 10 * 60
+
+
+def get_idempotency_key(data):
+    """
+    A success callback settles the Payment Request named by its `referenceId`, so that is the
+    key: redeliveries, the sweeper and bulk retries of one Payment Request all share it.
+    """
+    params = data.get("params")
+    params = params if isinstance(params, dict) else {}
+
+    if reference_id := params.get("referenceId") or data.get("referenceId"):
+        return f"ref:{reference_id}"
+
+    if transaction_id := params.get("transactionId") or data.get("transactionId"):
+        return f"txn:{transaction_id}"
+
+
+def claim_callback(key):
+    """
+    Claim `key` for processing with a Redis SETNX.
+
+    Returns `(True, None)` when the caller should process the callback, or `(False, outcome)`
+    for a duplicate: the stored outcome of the first delivery, or `{"status": "Processing"}`
+    while that delivery is still in flight. An in-flight claim expires after `PENDING_TTL`,
+    a stored outcome after `TTL`; the unique `WaafiPay Processed Callback` table backs Redis
+    up once the key has expired.
+    """
+    cache = frappe.cache()
+    redis_key = cache.make_key(CALLBACK_KEY.format(key=key))
+
+    if cache.set(redis_key, PENDING, nx=True, ex=PENDING_TTL):
+        outcome = frappe.db.get_value(DOCTYPE, key, "outcome")
+        if not outcome:
+            # the claim is dropped again if this transaction never commits
+            frappe.db.after_rollback.add(lambda: release_callback(key))
+            return True, None
+
+        cache.set(redis_key, outcome, ex=TTL)
+        value = outcome
+    else:
+        value = cache.get(redis_key)
+
+    _record_hit(key)
+
+    if not value or frappe.safe_decode(value) == PENDING:
+        return False, {"status": "Processing"}
+
+    return False, json.loads(value)
+
+
+def get_callback_outcome(key):
+    """Stored outcome of an already settled callback, without claiming the key."""
+    cache = frappe.cache()
+    value = cache.get(cache.make_key(CALLBACK_KEY.format(key=key)))
+
+    if value and frappe.safe_decode(value) != PENDING:
+        _record_hit(key)
+        return json.loads(value)
+
+
+def record_callback_outcome(key, outcome, log=None, transaction_id=None):
+    outcome_json = json.dumps(outcome, default=str)
+    frappe.get_doc({
+        "doctype": DOCTYPE,
+        "idempotency_key": key,
+        "status": outcome.get("status"),
+        "transaction_id": transaction_id or (key[4:] if key.startswith("txn:") else None),
+        "reference_id": outcome.get("reference_id") or (key[4:] if key.startswith("ref:") else None),
+        "waafipay_log": log,
+        "outcome": outcome_json,
+    }).insert(ignore_permissions=True, ignore_if_duplicate=True)
+
+    cache = frappe.cache()
+    frappe.db.after_commit.add(
+        lambda: cache.set(cache.make_key(CALLBACK_KEY.format(key=key)), outcome_json, ex=TTL)
+    )
+
+
+def release_callback(key):
+    frappe.cache().delete_value(CALLBACK_KEY.format(key=key))
+
+
+def _record_hit(key):
+    cache = frappe.cache()
+    cache.incr(cache.make_key(HITS_KEY))
+    cache.zincrby(cache.make_key(f"{HITS_KEY}:by_key"), 1, key)
+
+
+@frappe.whitelist()
+def get_idempotency_stats(limit=20):
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    top_keys = cache.zrevrange(cache.make_key(f"{HITS_KEY}:by_key"), 0, int(limit) - 1, withscores=True)
+
+    return {
+        "duplicate_hits": int(cache.get(cache.make_key(HITS_KEY)) or 0),
+        "top_keys": [(frappe.safe_decode(key), int(hits)) for key, hits in top_keys],
+    }
@@ -0,0 +1,162 @@
+import json
+import random
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+
+from waafipay_integration.waafipay.idempotency import get_callback_outcome, get_idempotency_key
+from waafipay_integration.waafipay.payment_status import get_payment_queue
+from waafipay_integration.waafipay_integration.doctype.waafipay_integration_settings.waafipay_integration_settings import (
+    get_settings,
+)
+
+DOCTYPE = "WaafiPay Callback Inbox"
+HANDLERS = {
+    "Success": "waafipay_integration.waafipay.waafipay_client.handle_payment_received",
+    "Failure": "waafipay_integration.waafipay.waafipay_client.handle_failure_callback",
+}
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONSUMERS = 2
+DEFAULT_MAX_ATTEMPTS = 5
+STALE_PROCESSING_MINUTES = 15
+
+
+def use_inbox():
+    return (get_settings().callback_processing or "Inbox") == "Inbox"
+
+
+def receive_callback(callback_type, payload):
+    """Persist a raw callback, commit, and leave settling it to the inbox consumers."""
+    key = get_idempotency_key(payload) if callback_type == "Success" else None
+
+    if key and (outcome := get_callback_outcome(key)):
+        return outcome
+
+    entry = frappe.get_doc({
+        "doctype": DOCTYPE,
+        "callback_type": callback_type,
+        "status": "Pending",
+        "idempotency_key": key,
+        "payload": json.dumps(payload, default=str),
+    }).insert(ignore_permissions=True)
+
+    # callbacks may arrive as GET requests, which frappe would otherwise roll back
+    frappe.db.commit()
+    enqueue_consumer()
+
+    return {"status": "Queued", "inbox": entry.name}
+
+
+def enqueue_consumer():
+    consumers = cint(get_settings().inbox_consumers) or DEFAULT_CONSUMERS
+    job_id = f"waafipay_callback_inbox::{random.randrange(consumers)}"
+
+    frappe.enqueue(
+        "waafipay_integration.waafipay.inbox.drain_inbox",
+        queue=get_payment_queue(),
+        job_id=job_id,
+        deduplicate=True,
+    )
+
+
+def drain_inbox(batch_size=None):
+    settings = get_settings()
+    batch_size = cint(batch_size) or cint(settings.inbox_batch_size) or DEFAULT_BATCH_SIZE
+    max_attempts = cint(settings.inbox_max_attempts) or DEFAULT_MAX_ATTEMPTS
+
+    processed = 0
+    while names := claim_batch(batch_size):
+        for name in names:
+            process_entry(name, max_attempts)
+
+        processed += len(names)
+
+    return processed
+
+
+def claim_batch(batch_size):
+    """Lock a batch of due entries (skipping those other consumers hold) and mark them Processing."""
+    Inbox = frappe.qb.DocType(DOCTYPE)
+    now = now_datetime()
+
+    names = (
+        frappe.qb.from_(Inbox)
+        .select(Inbox.name)
+        .where(
+            (Inbox.status == "Pending")
+            | ((Inbox.status == "Failed") & (Inbox.next_attempt_on <= now))
+        )
+        .orderby(Inbox.creation)
+        .limit(batch_size)
+        .for_update(skip_locked=True)
+        .run(pluck=True)
+    )
+
+    if names:
+        frappe.qb.update(Inbox).set(Inbox.status, "Processing").set(Inbox.modified, now).where(
+            Inbox.name.isin(names)
+        ).run()
+
+    frappe.db.commit()
+    return names
+
+
+def process_entry(name, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    entry = frappe.db.get_value(DOCTYPE, name, ["callback_type", "payload", "attempts"], as_dict=True)
+    attempts = cint(entry.attempts) + 1
+
+    try:
+        outcome = frappe.get_attr(HANDLERS[entry.callback_type])(json.loads(entry.payload)) or {}
+        if entry.callback_type == "Success" and outcome.get("status") == "Processing":
+            # another delivery holds the claim and may still fail: check back after the backoff
+            raise frappe.ValidationError(f"Callback still being processed elsewhere: {outcome}")
+        if entry.callback_type == "Success" and outcome.get("status") != "Success":
+            raise frappe.ValidationError(f"Callback not settled: {outcome}")
+    except Exception:
+        frappe.db.rollback()
+        failed = attempts >= max_attempts
+        frappe.db.set_value(DOCTYPE, name, {
+            "status": "Dead Letter" if failed else "Failed",
+            "attempts": attempts,
+            "last_error": frappe.get_traceback(),
+            # exponential backoff: 1, 2, 4, 8... minutes
+            "next_attempt_on": None if failed else add_to_date(now_datetime(), minutes=2 ** (attempts - 1)),
+        })
+    else:
+        frappe.db.set_value(DOCTYPE, name, {
+            "status": "Processed",
+            "attempts": attempts,
+            "processed_on": now_datetime(),
+            "outcome": json.dumps(outcome, default=str),
+        })
+
+    frappe.db.commit()
+
+
+def run():
+    """Scheduled safety net: recover entries of crashed consumers and drain anything left behind."""
+    Inbox = frappe.qb.DocType(DOCTYPE)
+    frappe.qb.update(Inbox).set(Inbox.status, "Pending").where(
+        (Inbox.status == "Processing")
+        & (Inbox.modified < add_to_date(now_datetime(), minutes=-STALE_PROCESSING_MINUTES))
+    ).run()
+    frappe.db.commit()
+
+    if frappe.db.exists(DOCTYPE, {"status": ["in", ["Pending", "Failed"]]}):
+        enqueue_consumer()
+
+
+@frappe.whitelist()
+def requeue(names):
+    frappe.only_for("System Manager")
+
+    if isinstance(names, str):
+        names = json.loads(names)
+
+    Inbox = frappe.qb.DocType(DOCTYPE)
+    frappe.qb.update(Inbox).set(Inbox.status, "Pending").set(Inbox.attempts, 0).where(
+        Inbox.name.isin(names) & Inbox.status.isin(["Failed", "Dead Letter"])
+    ).run()
+    frappe.db.commit()
+
+    enqueue_consumer()
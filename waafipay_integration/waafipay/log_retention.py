@@ -0,0 +1,162 @@
+import gzip
+import json
+import os
+import zlib
+
+import frappe
+from frappe.utils import add_days, cint, nowdate
+
+from waafipay_integration.waafipay_integration.doctype.waafipay_integration_settings.waafipay_integration_settings import (
+    get_settings,
+)
+
+LOG_DOCTYPE = "WaafiPay Log"
+PAYLOAD_FIELDS = ("request_payload", "response_data")
+# raw zlib bytes: frappe has no binary fieldtype, so the column lives outside the doctype's fields
+COMPRESSED_COLUMN = "compressed_payloads"
+DEFAULT_BATCH_SIZE = 1000
+ARCHIVE_TABLE = "waafipay_log_archive_{month}"
+ARCHIVE_FOLDER = "waafipay_log_archive"
+
+
+def run():
+    """Daily: compress payloads past the hot window, then archive rows past the warm window."""
+    settings = get_settings()
+    if not settings.enable_log_retention:
+        return
+
+    batch_size = cint(settings.log_retention_batch_size) or DEFAULT_BATCH_SIZE
+
+    if cint(settings.log_hot_days):
+        compress_logs(add_days(nowdate(), -cint(settings.log_hot_days)), batch_size)
+
+    if cint(settings.log_archive_days):
+        archive_logs(
+            add_days(nowdate(), -cint(settings.log_archive_days)),
+            settings.log_archive_target or "Archive Table",
+            batch_size,
+        )
+
+
+def compress_payloads(values):
+    return zlib.compress(json.dumps(values).encode(), 9)
+
+
+def decompress_payloads(value):
+    # postgres hands bytea columns back as a memoryview
+    return json.loads(zlib.decompress(bytes(value)))
+
+
+def add_compressed_column():
+    """Add the binary `compressed_payloads` column to the log table if it is missing."""
+    if COMPRESSED_COLUMN in frappe.db.get_table_columns(LOG_DOCTYPE):
+        return
+
+    if frappe.db.db_type == "postgres":
+        frappe.db.sql_ddl(f'alter table "tab{LOG_DOCTYPE}" add column "{COMPRESSED_COLUMN}" bytea')
+    else:
+        frappe.db.sql_ddl(f"alter table `tab{LOG_DOCTYPE}` add column `{COMPRESSED_COLUMN}` longblob")
+
+    frappe.cache().hdel("table_columns", f"tab{LOG_DOCTYPE}")
+
+
+def compress_logs(before, batch_size=DEFAULT_BATCH_SIZE):
+    """Move the payloads of logs created before `before` into the compressed column; logs without payloads are left alone."""
+    Log = frappe.qb.DocType(LOG_DOCTYPE)
+    compressed = Log.field(COMPRESSED_COLUMN)
+
+    total = 0
+    while True:
+        logs = (
+            frappe.qb.from_(Log)
+            .select(Log.name, *(Log.field(f) for f in PAYLOAD_FIELDS))
+            .where(
+                (Log.creation < before)
+                & compressed.isnull()
+                & ((Log.request_payload.notnull() & (Log.request_payload != ""))
+                    | (Log.response_data.notnull() & (Log.response_data != "")))
+            )
+            .orderby(Log.creation)
+            .limit(batch_size)
+            .run(as_dict=True)
+        )
+        if not logs:
+            break
+
+        for log in logs:
+            values = {fieldname: log.get(fieldname) for fieldname in PAYLOAD_FIELDS}
+            frappe.qb.update(Log).set(compressed, compress_payloads(values)).set(Log.request_payload, None).set(
+                Log.response_data, None
+            ).where(Log.name == log.name).run()
+
+        total += len(logs)
+        frappe.db.commit()
+
+    return total
+
+
+def archive_logs(before, target="Archive Table", batch_size=DEFAULT_BATCH_SIZE):
+    total = 0
+    while True:
+        logs = frappe.get_all(
+            LOG_DOCTYPE,
+            filters={"creation": ["<", before]},
+            fields=["name", "creation"],
+            order_by="creation asc",
+            limit=batch_size,
+        )
+        if not logs:
+            break
+
+        by_month = {}
+        for log in logs:
+            by_month.setdefault(log.creation.strftime("%Y%m"), []).append(log.name)
+
+        for month, names in by_month.items():
+            if target == "Compressed File":
+                _archive_to_file(month, names)
+            else:
+                _archive_to_table(month, names)
+
+        frappe.db.delete(LOG_DOCTYPE, {"name": ["in", [log.name for log in logs]]})
+        total += len(logs)
+        frappe.db.commit()
+
+    return total
+
+
+def _archive_to_table(month, names):
+    table = ARCHIVE_TABLE.format(month=month)
+    quote = '"' if frappe.db.db_type == "postgres" else "`"
+
+    if frappe.db.db_type == "postgres":
+        frappe.db.sql_ddl(f'create table if not exists "{table}" (like "tab{LOG_DOCTYPE}" including all)')
+    else:
+        frappe.db.sql_ddl(f"create table if not exists `{table}` like `tab{LOG_DOCTYPE}`")
+
+    # only copy columns both tables have, the live table may have gained fields since
+    archive_columns = set(frappe.db.get_db_table_columns(table))
+    columns = [c for c in frappe.db.get_db_table_columns(f"tab{LOG_DOCTYPE}") if c in archive_columns]
+    column_list = ", ".join(f"{quote}{c}{quote}" for c in columns)
+
+    frappe.db.sql(
+        f"""insert into {quote}{table}{quote} ({column_list})
+        select {column_list} from {quote}tab{LOG_DOCTYPE}{quote} where name in %(names)s""",
+        {"names": tuple(names)},
+    )
+
+
+def _archive_to_file(month, names):
+    folder = frappe.get_site_path("private", ARCHIVE_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+
+    logs = frappe.get_all(LOG_DOCTYPE, filters={"name": ["in", names]}, fields=["*"], order_by="creation asc")
+
+    # appending creates a multi-member gzip file, which gzip readers handle transparently
+    with gzip.open(os.path.join(folder, f"{month}.jsonl.gz"), "at") as f:
+        for log in logs:
+            compressed = log.pop(COMPRESSED_COLUMN, None)
+            if compressed:
+                log.update(decompress_payloads(compressed))
+
+            f.write(frappe.as_json(log, indent=None) + "\n")
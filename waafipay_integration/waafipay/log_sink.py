@@ -0,0 +1,261 @@
+import json
+
+import frappe
+from frappe.utils import add_to_date, flt, now_datetime
+
+from waafipay_integration.waafipay.metrics import trace
+from waafipay_integration.waafipay_integration.doctype.waafipay_integration_settings.waafipay_integration_settings import (
+    get_settings,
+)
+
+LOG_DOCTYPE = "WaafiPay Log"
+QUEUE_KEY = "waafipay_log_queue"
+WRITER_JOB_ID = "waafipay_log_writer"
+WRITER_LOCK_KEY = "waafipay_log_writer_lock"
+WRITER_LOCK_TTL = 5 * 60
+LOG_FIELDS = (
+    "status",
+    "sales_invoice",
+    "mode_of_payment",
+    "reference_id",
+    "service_name",
+    "transaction_id",
+    "request_id",
+    "credential",
+    "response_code",
+    "state",
+    "amount",
+    "currency",
+    "latency",
+    "attempts",
+    "retry_errors",
+    "error_message",
+    "request_payload",
+    "response_data",
+)
+
+
+class WaafiPayLogSink:
+    """
+    Collects `WaafiPay Log` rows in memory for the current request.
+
+    Rows are bulk inserted right before the transaction commits. If the transaction
+    is rolled back instead, they are written (and committed) on their own, so a failed
+    payment never loses its log. Rows already written earlier in the request are
+    updated in place on the next flush.
+
+    With the "Background" log writer, each flush is appended to a per-site Redis list
+    instead, which a single writer job drains in order: an update is never written
+    before the insert of its row.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.updates = {}
+        self.last_creation = None
+        self.registered = False
+
+    def add(self, **fields):
+        creation = now_datetime()
+        if self.last_creation and creation <= self.last_creation:
+            # keep insertion order visible in `creation`
+            creation = add_to_date(self.last_creation, seconds=0.000001)
+
+        self.last_creation = creation
+
+        log = frappe._dict(name=frappe.generate_hash(length=10), creation=creation, flushed=False)
+        log.update(_serialize(fields))
+        self.pending.append(log)
+        self.register()
+        return log
+
+    def update(self, log, **fields):
+        fields = _serialize(fields)
+        log.update(fields)
+
+        if log.flushed:
+            self.updates.setdefault(log.name, {}).update(fields)
+            self.register()
+
+    def register(self):
+        if self.registered:
+            return
+
+        frappe.db.before_commit.add(self.flush)
+        frappe.db.after_rollback.add(self.flush_after_rollback)
+        self.registered = True
+
+    def flush(self):
+        self.registered = False
+        rows, updates = self.pending, self.updates
+        self.pending, self.updates = [], {}
+
+        if not rows and not updates:
+            return
+
+        for log in rows:
+            log.flushed = True
+
+        with trace("log_flush"):
+            rows = [_make_row(log) for log in rows]
+
+            if get_settings().log_writer == "Background":
+                queue_logs(rows, updates)
+            else:
+                write_logs(rows, updates)
+
+    def flush_after_rollback(self):
+        if not self.pending and not self.updates:
+            self.registered = False
+            return
+
+        self.flush()
+        frappe.db.commit()
+
+
+def get_log_sink():
+    if getattr(frappe.local, "waafipay_log_sink", None) is None:
+        frappe.local.waafipay_log_sink = WaafiPayLogSink()
+
+    return frappe.local.waafipay_log_sink
+
+
+def make_log(**fields):
+    """Queue a new `WaafiPay Log`; dict / list payloads are serialized to JSON."""
+    return get_log_sink().add(**fields)
+
+
+def update_log(log, **fields):
+    get_log_sink().update(log, **fields)
+
+
+def flush_logs():
+    get_log_sink().flush()
+
+
+def write_logs(rows, updates=None):
+    if rows:
+        fields = list(rows[0])
+        frappe.db.bulk_insert(LOG_DOCTYPE, fields, [[row[f] for f in fields] for row in rows])
+
+    for name, values in (updates or {}).items():
+        frappe.db.set_value(LOG_DOCTYPE, name, values)
+
+
+def queue_logs(rows, updates=None):
+    frappe.cache().rpush(QUEUE_KEY, frappe.as_json({"rows": rows, "updates": updates or {}}, indent=None))
+    enqueue_writer()
+
+
+def enqueue_writer():
+    frappe.enqueue(
+        "waafipay_integration.waafipay.log_sink.drain_log_queue",
+        queue="short",
+        job_id=WRITER_JOB_ID,
+        deduplicate=True,
+    )
+
+
+def drain_log_queue():
+    """
+    Write the queued log batches in the order they were flushed, committing each one.
+
+    Only one writer runs per site at a time. A batch that cannot be written is kept in an
+    Error Log and dropped, so it does not hold up the ones behind it.
+    """
+    cache = frappe.cache()
+    lock_key = cache.make_key(WRITER_LOCK_KEY)
+    if not cache.set(lock_key, 1, nx=True, ex=WRITER_LOCK_TTL):
+        return
+
+    written = 0
+    try:
+        while batch := cache.lrange(QUEUE_KEY, 0, 0):
+            cache.expire(lock_key, WRITER_LOCK_TTL)
+            batch = json.loads(batch[0])
+            try:
+                write_logs(batch["rows"], batch["updates"])
+                frappe.db.commit()
+            except Exception:
+                frappe.db.rollback()
+                frappe.log_error(
+                    frappe.as_json({"batch": batch, "error": frappe.get_traceback()}),
+                    "WaafiPay Log Write Failed",
+                )
+                frappe.db.commit()
+
+            cache.lpop(QUEUE_KEY)
+            written += 1
+    finally:
+        cache.delete(lock_key)
+
+    return written
+
+
+def run():
+    """Scheduled safety net: drain batches queued while the previous writer job was finishing."""
+    if frappe.cache().llen(QUEUE_KEY):
+        enqueue_writer()
+
+
+def _make_row(log):
+    user = frappe.session.user if getattr(frappe.local, "session", None) else "Administrator"
+    row = {
+        "name": log.name,
+        "creation": log.creation,
+        "modified": log.creation,
+        "owner": user,
+        "modified_by": user,
+        "docstatus": 0,
+        "idx": 0,
+    }
+    row.update({fieldname: log.get(fieldname) for fieldname in LOG_FIELDS})
+    return row
+
+
+def extract_log_fields(request_payload=None, response_data=None):
+    """Pull the searchable bits of a gateway request / response (or callback) into log columns."""
+    fields = {}
+
+    if isinstance(request_payload, dict):
+        service_params = request_payload.get("serviceParams") or {}
+        transaction_info = service_params.get("transactionInfo") or {}
+        fields.update({
+            "request_id": request_payload.get("requestId"),
+            "service_name": request_payload.get("serviceName"),
+            "transaction_id": service_params.get("transactionId"),
+            "reference_id": transaction_info.get("referenceId"),
+            "amount": transaction_info.get("amount"),
+            "currency": transaction_info.get("currency"),
+        })
+
+    if isinstance(response_data, dict):
+        params = response_data.get("params")
+        params = params if isinstance(params, dict) else {}
+        fields.update({
+            "response_code": response_data.get("responseCode"),
+            "state": params.get("state"),
+            "transaction_id": params.get("transactionId") or response_data.get("transactionId") or fields.get("transaction_id"),
+            "reference_id": params.get("referenceId") or response_data.get("referenceId") or fields.get("reference_id"),
+            "amount": params.get("txAmount") or fields.get("amount"),
+        })
+
+    if fields.get("amount") is not None:
+        fields["amount"] = flt(fields["amount"])
+
+    return {key: value for key, value in fields.items() if value not in (None, "")}
+
+
+def _serialize(fields):
+    out = extract_log_fields(fields.get("request_payload"), fields.get("response_data"))
+    fields = {key: value for key, value in fields.items() if value is not None or key not in out}
+
+    for key, value in fields.items():
+        if isinstance(value, (dict, list)):
+            value = frappe.as_json(value, indent=None)
+        elif isinstance(value, Exception):
+            value = str(value)
+
+        out[key] = value
+
+    return out
@@ -0,0 +1,193 @@
+import json
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import frappe
+from werkzeug.wrappers import Response
+
+METRICS_KEY = "waafipay_metrics"
+COUNTERS_KEY = "waafipay_counters"
+METRIC_NAME = "waafipay_phase_duration_seconds"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LABELS = ("operation", "phase", "credential", "service", "response_code")
+
+
+class Trace:
+    """Phase timings of one hot-path call, written to Redis in a single pipeline once the call ends."""
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.labels = {}
+        self.phases = []
+
+    def observe(self, phase, seconds):
+        self.phases.append((phase, seconds))
+
+    def flush(self):
+        record(self.operation, self.phases, **self.labels)
+
+
+@contextmanager
+def trace(operation):
+    stack = _get_traces()
+    current = Trace(operation)
+    stack.append(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.observe("total", time.perf_counter() - start)
+        stack.pop()
+        current.flush()
+
+
+def traced(operation):
+    """Decorator form of `trace`; nested traced calls are recorded as their own operation."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace(operation):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def span(phase):
+    """Time a phase of the current trace; a no-op outside of one."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if current := current_trace():
+            current.observe(phase, time.perf_counter() - start)
+
+
+def set_labels(**labels):
+    if current := current_trace():
+        current.labels.update({k: str(v) for k, v in labels.items() if v})
+
+
+def current_trace():
+    stack = _get_traces()
+    return stack[-1] if stack else None
+
+
+def _get_traces():
+    if getattr(frappe.local, "waafipay_traces", None) is None:
+        frappe.local.waafipay_traces = []
+
+    return frappe.local.waafipay_traces
+
+
+def record(operation, phases, credential=None, service=None, response_code=None):
+    """Add observations to the Redis histograms, one hash field per series and bucket."""
+    if not phases:
+        return
+
+    cache = frappe.cache()
+    key = cache.make_key(METRICS_KEY)
+
+    try:
+        pipe = cache.pipeline()
+        for phase, seconds in phases:
+            series = [operation, phase, credential or "", service or "", response_code or ""]
+            bucket = next((b for b in BUCKETS if seconds <= b), "+Inf")
+            pipe.hincrby(key, json.dumps([*series, bucket]), 1)
+            pipe.hincrbyfloat(key, json.dumps([*series, "sum"]), seconds)
+            pipe.hincrby(key, json.dumps([*series, "count"]), 1)
+        pipe.execute()
+    except Exception:
+        # metrics must never fail a payment
+        frappe.logger("waafipay").warning("Could not record WaafiPay metrics", exc_info=True)
+
+
+def increment(metric, value=1, **labels):
+    """Add `value` to a Prometheus counter (`metric` should end in `_total`)."""
+    cache = frappe.cache()
+    field = json.dumps([metric, sorted((k, str(v)) for k, v in labels.items())])
+
+    try:
+        cache.hincrbyfloat(cache.make_key(COUNTERS_KEY), field, value)
+    except Exception:
+        frappe.logger("waafipay").warning("Could not record WaafiPay metrics", exc_info=True)
+
+
+def render_metrics():
+    return render_histograms() + render_counters()
+
+
+def render_counters():
+    cache = frappe.cache()
+    counters = {}
+
+    for field, value in cache.hscan_iter(cache.make_key(COUNTERS_KEY)):
+        metric, labels = json.loads(frappe.safe_decode(field))
+        counters.setdefault(metric, []).append((labels, float(value)))
+
+    lines = []
+    for metric, samples in sorted(counters.items()):
+        lines.append(f"# TYPE {metric} counter")
+        for labels, value in sorted(samples):
+            label_text = ",".join(f'{name}="{_escape(v)}"' for name, v in labels)
+            lines.append(f"{metric}{{{label_text}}} {value:g}")
+
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def render_histograms():
+    cache = frappe.cache()
+    series = {}
+
+    for field, value in cache.hscan_iter(cache.make_key(METRICS_KEY)):
+        *labels, slot = json.loads(frappe.safe_decode(field))
+        entry = series.setdefault(tuple(labels), {"buckets": {}, "sum": 0.0, "count": 0})
+        if slot == "sum":
+            entry["sum"] = float(value)
+        elif slot == "count":
+            entry["count"] = int(value)
+        else:
+            entry["buckets"][slot] = int(value)
+
+    lines = [
+        f"# HELP {METRIC_NAME} Duration of the phases of WaafiPay payment operations.",
+        f"# TYPE {METRIC_NAME} histogram",
+    ]
+    for labels, entry in sorted(series.items()):
+        label_text = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(LABELS, labels))
+
+        cumulative = 0
+        for bucket in BUCKETS:
+            cumulative += entry["buckets"].get(bucket, 0)
+            lines.append(f'{METRIC_NAME}_bucket{{{label_text},le="{bucket}"}} {cumulative}')
+
+        cumulative += entry["buckets"].get("+Inf", 0)
+        lines.append(f'{METRIC_NAME}_bucket{{{label_text},le="+Inf"}} {cumulative}')
+        lines.append(f"{METRIC_NAME}_sum{{{label_text}}} {entry['sum']}")
+        lines.append(f"{METRIC_NAME}_count{{{label_text}}} {entry['count']}")
+
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@frappe.whitelist()
+def get_metrics():
+    """Prometheus scrape endpoint: /api/method/waafipay_integration.waafipay.metrics.get_metrics"""
+    frappe.only_for("System Manager")
+
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
+
+@frappe.whitelist()
+def reset_metrics():
+    frappe.only_for("System Manager")
+
+    cache = frappe.cache()
+    cache.delete(cache.make_key(METRICS_KEY), cache.make_key(COUNTERS_KEY))
@@ -0,0 +1,319 @@
+"""
+Local stand-in for the WaafiPay `/asm` endpoint, used by the benchmark suite.
+
+Standard library only, so it can run anywhere as a subprocess:
+
+    python -m waafipay_integration.waafipay.mock_server --port 8765 \
+        --latency lognormal:80,0.4 --error-rate 0.02 --callback-delay 0.5
+
+It prints `listening on http://host:port` once ready.
+"""
+
+import argparse
+import json
+import math
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+APPROVED = {"responseCode": "2001", "errorCode": "0", "responseMsg": "RCS_SUCCESS"}
+REJECTED = {"responseCode": "5206", "errorCode": "E10205", "responseMsg": "RCS_USER_REJECTED"}
+
+
+class LatencyDistribution:
+    """
+    Parse `kind:params` (all values in milliseconds):
+
+    fixed:50, uniform:20,200, normal:80,15, lognormal:80,0.4 (median, sigma)
+    """
+
+    def __init__(self, spec="fixed:0"):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p] or [0.0]
+
+        if kind not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self):
+        p = self.params
+        if self.kind == "uniform":
+            value = random.uniform(p[0], p[1])
+        elif self.kind == "normal":
+            value = random.gauss(p[0], p[1])
+        elif self.kind == "lognormal":
+            value = random.lognormvariate(math.log(p[0]), p[1])
+        else:
+            value = p[0]
+
+        return max(value, 0.0) / 1000
+
+
+class MockWaafiPay:
+    def __init__(self, latency="fixed:0", error_rate=0.0, http_error_rate=0.0, callback_delay=None, callback_url=None):
+        self.latency = LatencyDistribution(latency)
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.callback_delay = callback_delay
+        self.callback_url = callback_url
+        self.transactions = {}
+        self.references = {}
+        self.lock = threading.Lock()
+        self.handlers = {
+            "API_PREAUTHORIZE": self.preauthorize,
+            "API_PURCHASE": self.preauthorize,
+            "API_PREAUTHORIZE_COMMIT": self.commit,
+            "API_PREAUTHORIZE_CANCEL": self.cancel,
+            "HPP_PURCHASE": self.hpp_purchase,
+            "HPP_GETTRANINFO": self.transaction_info,
+        }
+
+    def handle(self, payload):
+        """Return `(http_status, body)` for a request payload."""
+        time.sleep(self.latency.sample())
+
+        if random.random() < self.http_error_rate:
+            return 503, {"error": "Service Unavailable"}
+
+        service_name = payload.get("serviceName")
+        handler = self.handlers.get(service_name)
+        if not handler:
+            return 200, self.response(payload, {"responseCode": "5000", "errorCode": "E10000", "responseMsg": f"Unknown service {service_name}"})
+
+        if random.random() < self.error_rate:
+            return 200, self.response(payload, REJECTED)
+
+        return 200, handler(payload)
+
+    def response(self, payload, result, **params):
+        return {
+            "schemaVersion": "1.0",
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "requestId": payload.get("requestId"),
+            "sessionId": None,
+            "channelName": payload.get("channelName"),
+            "serviceName": payload.get("serviceName"),
+            **result,
+            "params": params,
+        }
+
+    def preauthorize(self, payload):
+        service_params = payload.get("serviceParams") or {}
+        info = service_params.get("transactionInfo") or {}
+        transaction_id = str(random.randint(10**7, 10**8))
+
+        with self.lock:
+            self.transactions[transaction_id] = {"referenceId": info.get("referenceId"), "amount": info.get("amount"), "state": "APPROVED"}
+            self.references[info.get("referenceId")] = transaction_id
+
+        return self.response(
+            payload,
+            APPROVED,
+            state="APPROVED",
+            transactionId=transaction_id,
+            referenceId=info.get("referenceId"),
+            txAmount=info.get("amount"),
+            issuerTransactionId=uuid.uuid4().hex[:12],
+        )
+
+    def commit(self, payload):
+        transaction_id = (payload.get("serviceParams") or {}).get("transactionId")
+
+        with self.lock:
+            transaction = self.transactions.get(str(transaction_id)) or {}
+            transaction["state"] = "COMMITTED"
+
+        return self.response(
+            payload,
+            APPROVED,
+            state="approved",
+            transactionId=transaction_id,
+            referenceId=transaction.get("referenceId"),
+        )
+
+    def cancel(self, payload):
+        transaction_id = (payload.get("serviceParams") or {}).get("transactionId")
+
+        with self.lock:
+            transaction = self.transactions.get(str(transaction_id))
+            if transaction and transaction["state"] == "APPROVED":
+                transaction["state"] = "CANCELLED"
+
+        if not transaction or transaction["state"] != "CANCELLED":
+            return self.response(
+                payload,
+                {"responseCode": "5206", "errorCode": "E10309", "responseMsg": "RCS_TRAN_NOT_FOUND_OR_NOT_CANCELLABLE"},
+                transactionId=transaction_id,
+            )
+
+        return self.response(
+            payload,
+            APPROVED,
+            state="CANCELLED",
+            transactionId=transaction_id,
+            referenceId=transaction.get("referenceId"),
+        )
+
+    def hpp_purchase(self, payload):
+        service_params = payload.get("serviceParams") or {}
+        info = service_params.get("transactionInfo") or {}
+        reference_id = info.get("referenceId")
+
+        # the payer is assumed to pay right away, whether or not the callback is sent
+        with self.lock:
+            transaction_id = str(random.randint(10**7, 10**8))
+            self.transactions[transaction_id] = {"referenceId": reference_id, "amount": info.get("amount"), "state": "APPROVED"}
+            self.references[reference_id] = transaction_id
+
+        callback_url = self.callback_url or service_params.get("hppSuccessCallbackUrl")
+        if self.callback_delay is not None and callback_url:
+            threading.Timer(
+                self.callback_delay, self.emit_callback, (callback_url, reference_id, info.get("amount"), transaction_id)
+            ).start()
+
+        return self.response(
+            payload,
+            APPROVED,
+            hppUrl=f"https://mock.waafipay.local/hpp/{uuid.uuid4().hex}",
+            directPaymentLink=f"https://mock.waafipay.local/pay/{uuid.uuid4().hex}",
+            referenceId=reference_id,
+        )
+
+    def transaction_info(self, payload):
+        reference_id = (payload.get("serviceParams") or {}).get("referenceId")
+
+        with self.lock:
+            transaction_id = self.references.get(reference_id)
+            transaction = dict(self.transactions.get(transaction_id) or {})
+
+        if not transaction:
+            return self.response(
+                payload,
+                {"responseCode": "5206", "errorCode": "E10308", "responseMsg": "RCS_TRAN_NOT_FOUND"},
+                referenceId=reference_id,
+            )
+
+        return self.response(
+            payload,
+            APPROVED,
+            state=transaction["state"],
+            transactionId=transaction_id,
+            referenceId=reference_id,
+            txAmount=transaction.get("amount"),
+        )
+
+    def emit_callback(self, url, reference_id, amount, transaction_id=None):
+        body = {
+            **APPROVED,
+            "params": {
+                "state": "APPROVED",
+                "referenceId": reference_id,
+                "transactionId": transaction_id or str(random.randint(10**7, 10**8)),
+                "txAmount": amount,
+            },
+        }
+        request = urllib.request.Request(
+            url, data=json.dumps(body).encode(), headers={"Content-Type": "application/json"}, method="POST"
+        )
+        try:
+            urllib.request.urlopen(request, timeout=10).close()
+        except Exception as e:
+            print(f"callback to {url} failed: {e}", file=sys.stderr, flush=True)
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/asm":
+                return self.reply(404, {"error": "Not Found"})
+
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            except ValueError:
+                return self.reply(400, {"error": "Invalid JSON"})
+
+            self.reply(*mock.handle(payload))
+
+        def reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(host="127.0.0.1", port=0, **options):
+    server = ThreadingHTTPServer((host, port), make_handler(MockWaafiPay(**options)))
+    server.daemon_threads = True
+    return server
+
+
+def start_mock_server(port=0, latency="fixed:0", error_rate=0.0, http_error_rate=0.0, callback_delay=None, callback_url=None):
+    """Run the mock in a subprocess; returns `(process, base_url)`."""
+    cmd = [
+        sys.executable, "-m", "waafipay_integration.waafipay.mock_server",
+        "--port", str(port),
+        "--latency", latency,
+        "--error-rate", str(error_rate),
+        "--http-error-rate", str(http_error_rate),
+    ]
+    if callback_delay is not None:
+        cmd += ["--callback-delay", str(callback_delay)]
+    if callback_url:
+        cmd += ["--callback-url", callback_url]
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+    if not line.startswith("listening on "):
+        process.kill()
+        raise RuntimeError(f"WaafiPay mock server failed to start: {line}")
+
+    return process, line.removeprefix("listening on ")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Local WaafiPay /asm mock server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", default="fixed:0", help="fixed:MS | uniform:MIN,MAX | normal:MEAN,SD | lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests rejected by the gateway")
+    parser.add_argument("--http-error-rate", type=float, default=0.0, help="share of requests answered with HTTP 503")
+    parser.add_argument("--callback-delay", type=float, default=None, help="emit HPP success callbacks after N seconds")
+    parser.add_argument("--callback-url", default=None, help="override the hppSuccessCallbackUrl of requests")
+    args = parser.parse_args(args)
+
+    server = serve(
+        args.host,
+        args.port,
+        latency=args.latency,
+        error_rate=args.error_rate,
+        http_error_rate=args.http_error_rate,
+        callback_delay=args.callback_delay,
+        callback_url=args.callback_url,
+    )
+    host, port = server.server_address[:2]
+    print(f"listening on http://{host}:{port}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import asyncio
+import json
+import random
+
+import frappe
+from frappe.utils import add_to_date, cint, now_datetime
+
+from waafipay_integration.waafipay.async_client import AsyncWaafiPayClient
+from waafipay_integration.waafipay.log_sink import make_log, update_log
+from waafipay_integration.waafipay.metrics import traced
+from waafipay_integration.waafipay.payment_status import get_payment_queue
+from waafipay_integration.waafipay.waafipay_client import get_credentials
+from waafipay_integration.waafipay_integration.doctype.waafipay_integration_settings.waafipay_integration_settings import (
+    get_settings,
+)
+
+DOCTYPE = "WaafiPay Link Outbox"
+REALTIME_EVENT = "waafipay_payment_link"
+DEFAULT_CONSUMERS = 2
+DEFAULT_CONCURRENCY = 10
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_MAX_ATTEMPTS = 5
+STALE_PROCESSING_MINUTES = 15
+
+
+def enqueue_payment_link(doc):
+    """
+    Record that a submitted Payment Request needs a WaafiPay payment link.
+
+    The intent is inserted in the submit transaction and only dispatched once that commits,
+    so the gateway is never called while the submit holds its locks, and a rolled back
+    submit leaves neither an intent nor a link behind.
+    """
+    if not doc.get("create_payment_request") or not doc.payment_gateway_account:
+        return
+
+    if doc.flags.only_get_payment_link:
+        return
+
+    if not get_credentials(doc.payment_gateway_account):
+        frappe.log_error(f"No credentials found for payment gateway account {doc.payment_gateway_account}", "WaafiPay Link Generation Failed")
+        return
+
+    frappe.get_doc({
+        "doctype": DOCTYPE,
+        "payment_request": doc.name,
+        "payment_gateway_account": doc.payment_gateway_account,
+        "status": "Pending",
+    }).insert(ignore_permissions=True)
+
+    enqueue_dispatcher(enqueue_after_commit=True)
+
+
+def enqueue_dispatcher(enqueue_after_commit=False):
+    consumers = cint(get_settings().link_outbox_consumers) or DEFAULT_CONSUMERS
+
+    frappe.enqueue(
+        "waafipay_integration.waafipay.outbox.dispatch_outbox",
+        queue=get_payment_queue(),
+        job_id=f"waafipay_link_outbox::{random.randrange(consumers)}",
+        deduplicate=True,
+        enqueue_after_commit=enqueue_after_commit,
+    )
+
+
+def dispatch_outbox(batch_size=None):
+    settings = get_settings()
+    batch_size = cint(batch_size) or cint(settings.link_outbox_batch_size) or DEFAULT_BATCH_SIZE
+    concurrency = cint(settings.link_outbox_concurrency) or DEFAULT_CONCURRENCY
+    max_attempts = cint(settings.link_outbox_max_attempts) or DEFAULT_MAX_ATTEMPTS
+
+    processed = 0
+    while entries := claim_batch(batch_size):
+        dispatch_batch(entries, concurrency, max_attempts)
+        processed += len(entries)
+
+    return processed
+
+
+def claim_batch(batch_size):
+    """Lock a batch of due intents (skipping those other consumers hold) and mark them Processing."""
+    Outbox = frappe.qb.DocType(DOCTYPE)
+    now = now_datetime()
+
+    entries = (
+        frappe.qb.from_(Outbox)
+        .select(Outbox.name, Outbox.payment_request, Outbox.payment_gateway_account, Outbox.attempts)
+        .where(
+            (Outbox.status == "Pending")
+            | ((Outbox.status == "Failed") & (Outbox.next_attempt_on <= now))
+        )
+        .orderby(Outbox.creation)
+        .limit(batch_size)
+        .for_update(skip_locked=True)
+        .run(as_dict=True)
+    )
+
+    if entries:
+        frappe.qb.update(Outbox).set(Outbox.status, "Processing").set(Outbox.modified, now).where(
+            Outbox.name.isin([entry.name for entry in entries])
+        ).run()
+
+    frappe.db.commit()
+    return entries
+
+
+@traced("dispatch_payment_links")
+def dispatch_batch(entries, concurrency=DEFAULT_CONCURRENCY, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    payment_requests = {
+        pr.name: pr
+        for pr in frappe.get_all(
+            "Payment Request",
+            filters={"name": ["in", [entry.payment_request for entry in entries]]},
+            fields=["name", "docstatus", "grand_total", "currency", "reference_name"],
+        )
+    }
+
+    groups = {}
+    for entry in entries:
+        pr = payment_requests.get(entry.payment_request)
+        if not pr or pr.docstatus != 1:
+            mark_failed(entry, f"Payment Request {entry.payment_request} is not submitted", final=True)
+            continue
+
+        credentials = get_credentials(entry.payment_gateway_account)
+        if not credentials:
+            mark_failed(entry, f"No credentials found for payment gateway account {entry.payment_gateway_account}", final=True)
+            continue
+
+        groups.setdefault(credentials.name, (credentials, []))[1].append((entry, pr))
+
+    if groups:
+        for entry, pr, payload, response in asyncio.run(request_links(groups.values(), concurrency)):
+            try:
+                apply_link_response(entry, pr, payload, response, max_attempts)
+            except Exception:
+                # one bad row must not leave the rest of the batch Processing
+                mark_failed(entry, frappe.get_traceback(), max_attempts=max_attempts)
+
+    frappe.db.commit()
+
+
+async def request_links(groups, concurrency):
+    """
+    Request the links of every (credentials, items) group concurrently.
+
+    Errors are returned in place of the response, per row, or for every row of a group whose
+    client could not be set up, so each of them counts as an attempt.
+    """
+
+    async def request_group(credentials, items):
+        try:
+            async with AsyncWaafiPayClient(credentials, max_concurrency=concurrency) as client:
+                payloads = [build_link_payload(client, pr) for entry, pr in items]
+                responses = await client.gather(send_link_request(client, payload) for payload in payloads)
+        except Exception as e:
+            return [(entry, pr, None, e) for entry, pr in items]
+
+        return [
+            (entry, pr, None if isinstance(payload, BaseException) else payload, response)
+            for (entry, pr), payload, response in zip(items, payloads, responses)
+        ]
+
+    results = await asyncio.gather(*(request_group(credentials, items) for credentials, items in groups))
+    return [result for group in results for result in group]
+
+
+def build_link_payload(client, pr):
+    try:
+        return client.build_hpp_payload(
+            pr.name,
+            pr.grand_total,
+            pr.currency,
+            f"Payment for {pr.grand_total} {pr.currency} for {pr.reference_name}",
+        )
+    except Exception as e:
+        return e
+
+
+async def send_link_request(client, payload):
+    if isinstance(payload, BaseException):
+        raise payload
+
+    return await client.send_request(payload)
+
+
+def apply_link_response(entry, pr, payload, response, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    log = make_log(status="Initiated", reference_id=pr.name, request_payload=payload)
+
+    if isinstance(response, BaseException):
+        error = str(response) or type(response).__name__
+        update_log(log, status="Failed", error_message=error)
+        return mark_failed(entry, error, max_attempts=max_attempts, log=log.name)
+
+    update_log(log, response_data=response)
+    params = response.get("params") or {}
+    link = (params.get("hppUrl") or params.get("directPaymentLink")) if response.get("responseCode") == "2001" else None
+
+    if not link:
+        update_log(log, status="Failed", error_message=response.get("responseMsg"))
+        return mark_failed(entry, json.dumps(response, default=str), max_attempts=max_attempts, log=log.name)
+
+    frappe.db.set_value("Payment Request", pr.name, "waafipay_payment_link", link, update_modified=False)
+    update_log(log, status="Success")
+
+    frappe.db.set_value(DOCTYPE, entry.name, {
+        "status": "Processed",
+        "attempts": cint(entry.attempts) + 1,
+        "processed_on": now_datetime(),
+        "payment_link": link,
+        "waafipay_log": log.name,
+        "last_error": None,
+    })
+    notify(pr.name, payment_link=link)
+
+
+def mark_failed(entry, error, max_attempts=DEFAULT_MAX_ATTEMPTS, log=None, final=False):
+    attempts = cint(entry.attempts) + 1
+    dead = final or attempts >= max_attempts
+
+    frappe.db.set_value(DOCTYPE, entry.name, {
+        "status": "Dead Letter" if dead else "Failed",
+        "attempts": attempts,
+        "last_error": error,
+        "waafipay_log": log,
+        # exponential backoff: 1, 2, 4, 8... minutes
+        "next_attempt_on": None if dead else add_to_date(now_datetime(), minutes=2 ** (attempts - 1)),
+    })
+
+    if dead:
+        notify(entry.payment_request, error=error)
+
+
+def notify(payment_request, **data):
+    frappe.publish_realtime(
+        REALTIME_EVENT,
+        {"payment_request": payment_request, **data},
+        doctype="Payment Request",
+        docname=payment_request,
+        after_commit=True,
+    )
+
+
+def run():
+    """Scheduled safety net: recover intents of crashed consumers and dispatch anything left behind."""
+    Outbox = frappe.qb.DocType(DOCTYPE)
+    frappe.qb.update(Outbox).set(Outbox.status, "Pending").where(
+        (Outbox.status == "Processing")
+        & (Outbox.modified < add_to_date(now_datetime(), minutes=-STALE_PROCESSING_MINUTES))
+    ).run()
+    frappe.db.commit()
+
+    if frappe.db.exists(DOCTYPE, {"status": ["in", ["Pending", "Failed"]]}):
+        enqueue_dispatcher()
+
+
+@frappe.whitelist()
+def requeue(names):
+    frappe.only_for("System Manager")
+
+    if isinstance(names, str):
+        names = json.loads(names)
+
+    Outbox = frappe.qb.DocType(DOCTYPE)
+    frappe.qb.update(Outbox).set(Outbox.status, "Pending").set(Outbox.attempts, 0).where(
+        Outbox.name.isin(names) & Outbox.status.isin(["Failed", "Dead Letter"])
+    ).run()
+    frappe.db.commit()
+
+    enqueue_dispatcher()
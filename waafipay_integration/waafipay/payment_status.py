@@ -0,0 +1,56 @@
+import frappe
+from frappe.utils import now
+from frappe.utils.background_jobs import get_queues_timeout
+
+PAYMENT_QUEUE = "waafipay"
+STATUS_KEY = "waafipay_payment_status"
+STATUS_TTL = 6 * 60 * 60
+REALTIME_EVENT = "waafipay_payment_status"
+
+
+def get_payment_queue():
+    """Dedicated `waafipay` RQ queue when a worker is configured for it, `default` otherwise."""
+    return PAYMENT_QUEUE if PAYMENT_QUEUE in get_queues_timeout() else "default"
+
+
+def set_payment_status(payment_request, status, after_commit=False, **details):
+    """
+    Record a state transition of a phone payment and push it to the invoice's realtime room.
+
+    Pass `after_commit` for states that only hold once the transaction commits (e.g. Paid);
+    failures are pushed right away, as their transaction is usually rolled back.
+    """
+    state = get_payment_status(payment_request) or {}
+    state.update(details)
+    state.update({
+        "payment_request": payment_request,
+        "status": status,
+        "modified": now(),
+    })
+
+    if not state.get("invoice_doctype"):
+        reference = frappe.db.get_value("Payment Request", payment_request, ["reference_doctype", "reference_name"])
+        if reference:
+            state["invoice_doctype"], state["invoice"] = reference
+
+    frappe.cache().set_value(f"{STATUS_KEY}:{payment_request}", state, expires_in_sec=STATUS_TTL)
+    publish_payment_status(state, after_commit=after_commit)
+    return state
+
+
+def publish_payment_status(state, after_commit=False):
+    """Publish to the invoice's document room, which the POS subscribes to once it requests a payment."""
+    if not state.get("invoice"):
+        return
+
+    frappe.publish_realtime(
+        REALTIME_EVENT,
+        state,
+        doctype=state.get("invoice_doctype") or "Sales Invoice",
+        docname=state["invoice"],
+        after_commit=after_commit,
+    )
+
+
+def get_payment_status(payment_request):
+    return frappe.cache().get_value(f"{STATUS_KEY}:{payment_request}")
@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+import frappe
+import requests
+from frappe import _
+from frappe.utils import cint, flt
+
+from waafipay_integration.waafipay.metrics import increment, span
+
+# not prefixed with the site: every site using a merchant account shares its bucket
+BUCKET_KEY = "waafipay_rate_limit:{merchant_uid}"
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+DEFAULT_RESERVE = 25
+DEFAULT_MAX_WAIT = {INTERACTIVE: 2, BACKGROUND: 30}
+
+# KEYS[1]: bucket, ARGV: rate (tokens/s), capacity, tokens kept back for this lane
+# Returns {1, 0} when a token was taken, otherwise {0, ms until one is available to the lane}.
+TAKE_TOKEN = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+
+local allowed = 0
+local wait = 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = math.ceil((reserve + 1 - tokens) / rate * 1000)
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, wait}
+"""
+
+_script = None
+
+
+class RateLimitedError(requests.RequestException):
+    """The merchant's request budget did not free up within the caller's wait bound."""
+
+
+class RateLimiter:
+    """
+    Token bucket for the outbound calls of one merchant account, shared through Redis.
+
+    The bucket refills at `rate` tokens per second up to `burst`. Background callers
+    may not dip into the last `reserve` percent of the bucket, which stays available
+    to interactive (POS) calls. Background work therefore yields to interactive calls
+    as soon as the merchant is near its limit. Each caller waits at most `max_wait`
+    seconds for a token before giving up with `RateLimitedError`.
+    """
+
+    def __init__(self, merchant_uid, rate, burst=None, reserve=DEFAULT_RESERVE, priority=INTERACTIVE, max_wait=None):
+        self.merchant_uid = merchant_uid
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self.priority = priority
+        self.reserve = 0 if priority == INTERACTIVE else min(self.burst * reserve / 100, self.burst - 1)
+        self.max_wait = DEFAULT_MAX_WAIT[priority] if max_wait is None else max_wait
+        self.key = BUCKET_KEY.format(merchant_uid=merchant_uid)
+
+    @classmethod
+    def for_credentials(cls, credentials, priority=INTERACTIVE):
+        """Limiter of the credentials' merchant, or None when no rate limit is configured."""
+        rate = flt(credentials.get("rate_limit_per_second"))
+        if not rate or not credentials.get("merchant_uid"):
+            return None
+
+        max_wait = credentials.get("rate_limit_max_wait" if priority == INTERACTIVE else "rate_limit_background_max_wait")
+
+        return cls(
+            credentials.merchant_uid,
+            rate,
+            burst=cint(credentials.get("rate_limit_burst")),
+            reserve=flt(credentials.get("rate_limit_reserve")) if credentials.get("rate_limit_reserve") is not None else DEFAULT_RESERVE,
+            priority=priority,
+            max_wait=flt(max_wait) if max_wait is not None else None,
+        )
+
+    def try_acquire(self):
+        """Take a token if the lane may; returns seconds to wait otherwise (0 when taken)."""
+        allowed, wait_ms = _get_script()(keys=[self.key], args=[self.rate, self.burst, self.reserve])
+        return 0 if allowed else wait_ms / 1000
+
+    def acquire(self):
+        waited = 0
+        with span("throttle"):
+            while wait := self.try_acquire():
+                if waited + wait > self.max_wait:
+                    self.reject(waited)
+                time.sleep(wait)
+                waited += wait
+
+        self.record(waited)
+
+    async def acquire_async(self):
+        waited = 0
+        while wait := self.try_acquire():
+            if waited + wait > self.max_wait:
+                self.reject(waited)
+            await asyncio.sleep(wait)
+            waited += wait
+
+        self.record(waited)
+
+    def record(self, waited):
+        if waited:
+            labels = {"merchant": self.merchant_uid, "lane": self.priority}
+            increment("waafipay_rate_limit_throttled_total", **labels)
+            increment("waafipay_rate_limit_wait_seconds_total", waited, **labels)
+
+    def reject(self, waited):
+        self.record(waited)
+        increment("waafipay_rate_limit_rejected_total", merchant=self.merchant_uid, lane=self.priority)
+        raise RateLimitedError(
+            _("Too many WaafiPay requests for merchant {0}, please try again in a moment.").format(self.merchant_uid)
+        )
+
+
+def _get_script():
+    global _script
+    if _script is None:
+        _script = frappe.cache().register_script(TAKE_TOKEN)
+
+    return _script
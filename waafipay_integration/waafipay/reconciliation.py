@@ -0,0 +1,385 @@
+"""
+Reconciliation of WaafiPay settlement exports against our WaafiPay Logs.
+
+Both sides are streamed and put in key order with an external merge sort (sorted runs
+spilled to temporary files, then merged with `heapq.merge`), then joined in a single
+sort-merge pass. Memory stays bounded by `SORT_CHUNK_SIZE` rows whatever the size of
+the settlement file, and the database is only read in keyset paginated batches.
+"""
+
+import csv
+import heapq
+import json
+import os
+import re
+import tempfile
+import time
+from itertools import groupby
+
+import frappe
+from frappe import _
+from frappe.utils import add_days, flt, getdate, now_datetime
+
+from waafipay_integration.waafipay.log_sink import LOG_DOCTYPE
+
+DOCTYPE = "WaafiPay Reconciliation"
+ENTRY_DOCTYPE = "WaafiPay Reconciliation Entry"
+REALTIME_EVENT = "waafipay_reconciliation_progress"
+SORT_CHUNK_SIZE = 100_000
+DB_BATCH_SIZE = 5000
+INSERT_BATCH_SIZE = 1000
+PROGRESS_INTERVAL = 2
+
+MATCHED = "Matched"
+AMOUNT_MISMATCH = "Amount Mismatch"
+MISSING_ON_OUR_SIDE = "Missing on Our Side"
+MISSING_ON_THEIR_SIDE = "Missing on Their Side"
+BUCKET_FIELDS = {
+    MATCHED: "matched",
+    AMOUNT_MISMATCH: "amount_mismatch",
+    MISSING_ON_OUR_SIDE: "missing_on_our_side",
+    MISSING_ON_THEIR_SIDE: "missing_on_their_side",
+}
+
+# settlement columns, compared lower case and without separators
+COLUMNS = {
+    "transaction_id": ("transactionid", "transid", "tranid", "txnid"),
+    "reference_id": ("referenceid", "reference", "refid"),
+    "amount": ("amount", "txamount", "transactionamount", "settledamount"),
+}
+# logs that never move money on their own
+IGNORED_SERVICES = ("HPP_PURCHASE", "HPP_GETTRANINFO")
+CANCEL_SERVICE = "API_PREAUTHORIZE_CANCEL"
+
+
+@frappe.whitelist()
+def start_reconciliation(name):
+    doc = frappe.get_doc(DOCTYPE, name)
+    doc.check_permission("write")
+
+    if doc.status in ("Queued", "Running"):
+        frappe.throw(_("Reconciliation {0} is already {1}").format(name, doc.status.lower()))
+
+    doc.db_set({"status": "Queued", "error": None})
+
+    frappe.enqueue(
+        "waafipay_integration.waafipay.reconciliation.run_reconciliation",
+        queue="long",
+        timeout=4 * 60 * 60,
+        job_id=f"waafipay_reconciliation::{name}",
+        deduplicate=True,
+        enqueue_after_commit=True,
+        name=name,
+    )
+
+
+def run_reconciliation(name):
+    doc = frappe.get_doc(DOCTYPE, name)
+    doc.db_set({
+        "status": "Running",
+        "started_on": now_datetime(),
+        "completed_on": None,
+        "error": None,
+        "settlement_rows": 0,
+        **{fieldname: 0 for fieldname in BUCKET_FIELDS.values()},
+    })
+    frappe.db.delete(ENTRY_DOCTYPE, {"reconciliation": name})
+    frappe.db.commit()
+
+    progress = Progress(name)
+    try:
+        results = reconcile(doc, progress)
+    except Exception:
+        frappe.db.rollback()
+        doc.db_set({"status": "Failed", "error": frappe.get_traceback()})
+        frappe.db.commit()
+        progress.publish("Failed", force=True)
+        raise
+
+    doc.db_set({"status": "Completed", "completed_on": now_datetime(), **results})
+    frappe.db.commit()
+    progress.publish("Completed", percent=100, force=True, **results)
+
+
+def reconcile(doc, progress):
+    """Join the settlement file of `doc` with our logs and write the entries; returns the counts."""
+    key_field = "reference_id" if doc.match_on == "Reference ID" else "transaction_id"
+    tolerance = flt(doc.amount_tolerance)
+    counts = dict.fromkeys(BUCKET_FIELDS.values(), 0)
+    writer = EntryWriter(doc.name)
+
+    with tempfile.TemporaryDirectory(prefix="waafipay_reconciliation_") as folder:
+        settlement_rows = [0]
+
+        def read_settlement():
+            for row in read_settlement_file(get_file_path(doc.settlement_file), key_field, progress):
+                settlement_rows[0] += 1
+                yield row
+
+        theirs = sum_by_key(external_sort(read_settlement(), os.path.join(folder, "theirs")))
+        ours = collapse_logs(external_sort(stream_logs(doc, key_field), os.path.join(folder, "ours")))
+
+        merged = 0
+        for bucket, their, our in merge_join(theirs, ours, tolerance):
+            counts[BUCKET_FIELDS[bucket]] += 1
+            writer.add(bucket, their, our)
+
+            merged += 1
+            progress.publish(
+                "Matching",
+                percent=min(99, 50 + merged * 50 // max(settlement_rows[0], 1)),
+                rows=merged,
+            )
+
+    writer.flush()
+    return {"settlement_rows": settlement_rows[0], **counts}
+
+
+def read_settlement_file(path, key_field, progress):
+    """Yield `[key, row number, transaction_id, reference_id, amount, raw row]` for every settlement line."""
+    size = os.path.getsize(path) or 1
+
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if not header:
+            frappe.throw(_("The settlement file is empty"))
+
+        columns = get_columns(header)
+        if key_field not in columns or "amount" not in columns:
+            frappe.throw(
+                _("The settlement file needs {0} and amount columns, found: {1}").format(
+                    key_field.replace("_", " "), ", ".join(header)
+                )
+            )
+
+        for row_number, row in enumerate(reader, start=2):
+            if not any(row):
+                continue
+
+            values = {field: (row[index].strip() if index < len(row) else "") for field, index in columns.items()}
+            key = values.get(key_field)
+            if not key:
+                continue
+
+            yield [
+                key,
+                row_number,
+                values.get("transaction_id"),
+                values.get("reference_id"),
+                flt(values.get("amount", "").replace(",", "")),
+                dict(zip(header, row)),
+            ]
+
+            if row_number % 1000 == 0:
+                progress.publish("Reading settlement file", percent=f.buffer.tell() * 50 // size, rows=row_number - 1)
+
+
+def get_columns(header):
+    normalized = [re.sub(r"[^a-z0-9]", "", column.lower()) for column in header]
+    columns = {}
+
+    for field, names in COLUMNS.items():
+        for name in names:
+            if name in normalized:
+                columns[field] = normalized.index(name)
+                break
+
+    return columns
+
+
+def stream_logs(doc, key_field):
+    """Yield `[key, log name, transaction_id, reference_id, amount, service_name]` for the successful logs of the period."""
+    Log = frappe.qb.DocType(LOG_DOCTYPE)
+    conditions = (
+        (Log.status == "Success")
+        & (Log.creation >= getdate(doc.from_date))
+        & (Log.creation < add_days(getdate(doc.to_date), 1))
+        & Log[key_field].isnotnull()
+        & (Log[key_field] != "")
+    )
+    if doc.credential:
+        conditions &= Log.credential == doc.credential
+
+    last = None
+    while True:
+        query = (
+            frappe.qb.from_(Log)
+            .select(Log.name, Log.creation, Log.transaction_id, Log.reference_id, Log.amount, Log.service_name)
+            .where(conditions)
+            .orderby(Log.creation)
+            .orderby(Log.name)
+            .limit(DB_BATCH_SIZE)
+        )
+        if last:
+            query = query.where((Log.creation > last.creation) | ((Log.creation == last.creation) & (Log.name > last.name)))
+
+        logs = query.run(as_dict=True)
+        if not logs:
+            return
+
+        for log in logs:
+            yield [log[key_field], log.name, log.transaction_id, log.reference_id, flt(log.amount), log.service_name]
+
+        last = logs[-1]
+
+
+def external_sort(rows, prefix, chunk_size=SORT_CHUNK_SIZE):
+    """Sort JSON serializable `rows` by their first item, holding at most `chunk_size` of them in memory."""
+    runs = []
+    chunk = []
+
+    def spill():
+        chunk.sort(key=lambda row: row[0])
+        path = f"{prefix}_{len(runs)}.jsonl"
+        with open(path, "w") as f:
+            f.writelines(json.dumps(row, default=str) + "\n" for row in chunk)
+        runs.append(path)
+        chunk.clear()
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            spill()
+
+    if not runs:
+        # everything fit in memory, no need to touch the disk
+        chunk.sort(key=lambda row: row[0])
+        yield from chunk
+        return
+
+    if chunk:
+        spill()
+
+    files = [open(path) for path in runs]
+    try:
+        yield from heapq.merge(*(map(json.loads, f) for f in files), key=lambda row: row[0])
+    finally:
+        for f in files:
+            f.close()
+
+
+def sum_by_key(rows):
+    """Settlement lines sharing a key (e.g. a charge and its fee) are added up, keeping the first line."""
+    for key, group in groupby(rows, key=lambda row: row[0]):
+        first = next(group)
+        for row in group:
+            first[4] += row[4]
+        yield first
+
+
+def collapse_logs(rows):
+    """
+    One row per key out of all the logs of a transaction (preauthorize, commit, callback...).
+
+    Transactions with a successful cancel, and keys only seen on non settling services,
+    are left out: no money moved for them.
+    """
+    for key, group in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        if any(row[5] == CANCEL_SERVICE for row in group):
+            continue
+
+        settling = [row for row in group if row[5] not in IGNORED_SERVICES]
+        if not settling:
+            continue
+
+        yield next((row for row in settling if row[4]), settling[0])
+
+
+def merge_join(theirs, ours, tolerance=0.01):
+    """Sort-merge join of two key ordered streams; yields `(bucket, their row, our row)`."""
+    their = next(theirs, None)
+    our = next(ours, None)
+
+    while their is not None or our is not None:
+        if our is None or (their is not None and their[0] < our[0]):
+            yield MISSING_ON_OUR_SIDE, their, None
+            their = next(theirs, None)
+        elif their is None or our[0] < their[0]:
+            yield MISSING_ON_THEIR_SIDE, None, our
+            our = next(ours, None)
+        else:
+            bucket = MATCHED if abs(flt(their[4]) - flt(our[4])) <= tolerance + 1e-9 else AMOUNT_MISMATCH
+            yield bucket, their, our
+            their = next(theirs, None)
+            our = next(ours, None)
+
+
+class EntryWriter:
+    """Bulk inserts reconciliation entries, linking the Payment Entries of each batch in one query."""
+
+    def __init__(self, reconciliation):
+        self.reconciliation = reconciliation
+        self.rows = []
+        self.fields = None
+
+    def add(self, bucket, their, our):
+        their_amount = their[4] if their else None
+        our_amount = our[4] if our else None
+
+        self.rows.append({
+            "reconciliation": self.reconciliation,
+            "bucket": bucket,
+            "transaction_id": (their and their[2]) or (our and our[2]),
+            "reference_id": (their and their[3]) or (our and our[3]),
+            "settlement_amount": their_amount,
+            "our_amount": our_amount,
+            "difference": flt(their_amount) - flt(our_amount) if their and our else None,
+            "waafipay_log": our[1] if our else None,
+            "settlement_row": their[1] if their else None,
+            "settlement_data": json.dumps(their[5], default=str) if their else None,
+        })
+
+        if len(self.rows) >= INSERT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        references = {row["reference_id"] for row in self.rows if row["waafipay_log"] and row["reference_id"]}
+        payment_entries = dict(
+            frappe.get_all(
+                "Payment Entry",
+                filters={"reference_no": ["in", list(references)], "docstatus": 1},
+                fields=["reference_no", "name"],
+                as_list=True,
+            )
+        ) if references else {}
+
+        now = now_datetime()
+        user = frappe.session.user
+        values = []
+        for row in self.rows:
+            row["payment_entry"] = payment_entries.get(row["reference_id"]) if row["waafipay_log"] else None
+            values.append([frappe.generate_hash(length=10), now, now, user, user, *row.values()])
+
+        fields = ["name", "creation", "modified", "owner", "modified_by", *self.rows[0].keys()]
+        frappe.db.bulk_insert(ENTRY_DOCTYPE, fields, values)
+        frappe.db.commit()
+        self.rows = []
+
+
+class Progress:
+    """Publishes the progress of a reconciliation to its form, at most every `PROGRESS_INTERVAL` seconds."""
+
+    def __init__(self, reconciliation):
+        self.reconciliation = reconciliation
+        self.last = 0
+
+    def publish(self, stage, percent=None, force=False, **data):
+        if not force and time.monotonic() - self.last < PROGRESS_INTERVAL:
+            return
+
+        self.last = time.monotonic()
+        frappe.publish_realtime(
+            REALTIME_EVENT,
+            {"reconciliation": self.reconciliation, "stage": stage, "percent": percent, **data},
+            doctype=DOCTYPE,
+            docname=self.reconciliation,
+        )
+
+
+def get_file_path(file_url):
+    return frappe.get_doc("File", {"file_url": file_url}).get_full_path()
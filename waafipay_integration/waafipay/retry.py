@@ -0,0 +1,126 @@
+import random
+import time
+
+import requests
+from frappe.utils import cint, flt
+from urllib3.exceptions import NewConnectionError
+
+from waafipay_integration.waafipay.circuit_breaker import CUSTOMER_WAIT_SERVICES
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 30
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_DEADLINE = 20
+DEFAULT_BACKOFF = 0.2
+# how long a customer may take to approve a preauthorize or purchase on the phone
+CUSTOMER_WAIT_TIMEOUT = 120
+MAX_BACKOFF = 5
+# an attempt is not worth starting with less budget left than this
+MIN_ATTEMPT_TIME = 0.5
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+# answers that guarantee the gateway did not process the request
+REJECTED_STATUS_CODES = {429, 503}
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+
+
+class RetryPolicy:
+    """
+    Timeouts and retry budget of one gateway service.
+
+    A call gets up to `max_attempts` attempts within `deadline` seconds. Retries wait an
+    exponential backoff with full jitter, and each attempt's timeouts are capped to the
+    budget that is left, so a call never outlives its deadline by more than a connect.
+
+    A service that is not `idempotent` is only sent again when the gateway cannot have
+    processed the request, since WaafiPay is not known to deduplicate by `requestId`.
+    """
+
+    def __init__(
+        self,
+        connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+        read_timeout=DEFAULT_READ_TIMEOUT,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        deadline=DEFAULT_DEADLINE,
+        backoff=DEFAULT_BACKOFF,
+        idempotent=True,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max(max_attempts, 1)
+        self.deadline = deadline
+        self.backoff = backoff
+        self.idempotent = idempotent
+
+    @classmethod
+    def for_service(cls, credentials, service_name):
+        """
+        Policy of `service_name`: its `Service Policies` row, then the credentials' defaults.
+
+        `CUSTOMER_WAIT_SERVICES` answer once the customer has responded on the phone, so unless
+        their row says otherwise they wait `CUSTOMER_WAIT_TIMEOUT` and their deadline covers it.
+        """
+        row = next(
+            (r for r in credentials.get("service_policies") or [] if r.get("service_name") == service_name),
+            {},
+        )
+        customer_wait = service_name in CUSTOMER_WAIT_SERVICES
+
+        connect_timeout = flt(row.get("connect_timeout")) or flt(credentials.get("connect_timeout")) or DEFAULT_CONNECT_TIMEOUT
+        if customer_wait:
+            read_timeout = flt(row.get("read_timeout")) or CUSTOMER_WAIT_TIMEOUT
+            deadline = flt(row.get("deadline")) or connect_timeout + read_timeout
+        else:
+            read_timeout = flt(row.get("read_timeout")) or flt(credentials.get("read_timeout")) or DEFAULT_READ_TIMEOUT
+            deadline = flt(row.get("deadline")) or flt(credentials.get("retry_deadline")) or DEFAULT_DEADLINE
+
+        return cls(
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            max_attempts=cint(row.get("max_attempts")) or cint(credentials.get("retry_max_attempts")) or DEFAULT_MAX_ATTEMPTS,
+            deadline=deadline,
+            backoff=flt(credentials.get("retry_backoff"), 3) if credentials.get("retry_backoff") is not None else DEFAULT_BACKOFF,
+            idempotent=not customer_wait,
+        )
+
+    def start(self):
+        """Absolute (monotonic) deadline of a call starting now."""
+        return time.monotonic() + self.deadline
+
+    def timeout(self, deadline):
+        remaining = max(deadline - time.monotonic(), MIN_ATTEMPT_TIME)
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** (attempt - 1)))
+
+    def is_retryable(self, status_code=None, sent=True):
+        """
+        Whether a failed attempt may be sent again: `status_code` is its HTTP status, if any,
+        and `sent` is False when the request never left (see `was_sent`).
+        """
+        if not sent:
+            return True
+
+        if status_code is not None:
+            return status_code in (RETRY_STATUS_CODES if self.idempotent else REJECTED_STATUS_CODES)
+
+        # a read timeout or a dropped connection may have been processed by the gateway
+        return self.idempotent
+
+    def should_retry(self, attempt, deadline, delay):
+        return attempt < self.max_attempts and time.monotonic() + delay + MIN_ATTEMPT_TIME < deadline
+
+
+def was_sent(error):
+    """
+    Whether a request that failed with `error` may have reached the gateway.
+
+    Connect timeouts, refused connections, DNS failures and TLS handshake errors all happen
+    before the request is written; a reset or a read timeout may come after it.
+    """
+    if isinstance(error, (requests.ConnectTimeout, requests.exceptions.SSLError)):
+        return False
+
+    # requests wraps urllib3's MaxRetryError, whose reason is the error of the connect phase
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return not isinstance(reason, NewConnectionError)
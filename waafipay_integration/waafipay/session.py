@@ -0,0 +1,102 @@
+import threading
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_BASE_URL = "https://api.waafipay.com"
+
+HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Connection": "keep-alive",
+}
+
+# Per worker process registry of keep-alive sessions, keyed by (site, credentials, base url).
+# Each entry remembers the `modified` timestamp of the credentials it was built from,
+# so an edit on any worker makes every other worker rebuild its session on next use.
+# Replaced sessions are only dropped from the registry, never closed: another thread may
+# still be sending through them, and their pooled connections close once released.
+_sessions = {}
+_stats = {"hits": 0, "misses": 0, "rebuilds": 0}
+_lock = threading.Lock()
+
+
+def get_session(credentials_name, base_url, pool_size=None, version=None):
+    key = (frappe.local.site, credentials_name, base_url)
+
+    with _lock:
+        entry = _sessions.get(key)
+        if entry and entry.version == version:
+            _stats["hits"] += 1
+            entry.hits += 1
+            return entry.session
+
+        _stats["misses"] += 1
+        if entry:
+            _stats["rebuilds"] += 1
+
+        entry = frappe._dict(
+            session=_build_session(pool_size or DEFAULT_POOL_SIZE),
+            version=version,
+            pool_size=pool_size or DEFAULT_POOL_SIZE,
+            hits=0,
+        )
+        _sessions[key] = entry
+        return entry.session
+
+
+def get_credentials_session(credentials):
+    """Return the pooled session for a `WaafiPay Credentials` doc (or cached record)."""
+    return get_session(
+        credentials.name,
+        get_base_url(credentials),
+        credentials.get("connection_pool_size"),
+        str(credentials.get("modified")),
+    )
+
+
+def get_base_url(credentials):
+    # `waafipay_api_base_url` in site config points every credential at another gateway (e.g. the local mock)
+    base_url = frappe.conf.get("waafipay_api_base_url") or credentials.get("api_base_url") or DEFAULT_BASE_URL
+    return base_url.rstrip("/")
+
+
+def clear_sessions(credentials_name=None):
+    """Forget the sessions of this site (of `credentials_name` only, if given)."""
+    with _lock:
+        for key in list(_sessions):
+            site, name, base_url = key
+            if site != frappe.local.site or (credentials_name and name != credentials_name):
+                continue
+            _sessions.pop(key)
+
+
+def _build_session(pool_size):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+
+@frappe.whitelist()
+def get_session_stats():
+    frappe.only_for("System Manager")
+
+    with _lock:
+        return {
+            **_stats,
+            "sessions": [
+                {
+                    "credentials": name,
+                    "base_url": base_url,
+                    "pool_size": entry.pool_size,
+                    "hits": entry.hits,
+                }
+                for (site, name, base_url), entry in _sessions.items()
+                if site == frappe.local.site
+            ],
+        }
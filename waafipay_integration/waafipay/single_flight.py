@@ -0,0 +1,113 @@
+import hashlib
+import json
+import time
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+from waafipay_integration.waafipay.metrics import increment, span
+
+LOCK_KEY = "waafipay_single_flight:{key}"
+RESULT_KEY = "waafipay_single_flight_result:{key}"
+# outlives a preauthorize waiting on the customer (see retry.CUSTOMER_WAIT_TIMEOUT)
+LOCK_TTL = 180
+RESULT_TTL = 30
+# callers give up waiting long before the web worker's request timeout
+MAX_WAIT = 15
+# failures are kept just long enough for waiting callers to pick them up, so a new tap can retry
+ERROR_TTL = 3
+POLL_INTERVAL = 0.2
+
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_release_script = None
+
+
+def get_payment_flight_key(invoice, amount, phone_number):
+    return hashlib.sha1(f"{invoice}|{flt(amount, 2)}|{phone_number}".encode()).hexdigest()
+
+
+def single_flight(key, fn, lock_ttl=LOCK_TTL, result_ttl=RESULT_TTL, max_wait=MAX_WAIT):
+    """
+    Run `fn` once for concurrent and repeated calls with the same `key`, across workers.
+
+    The first caller takes a Redis lock (expiring after `lock_ttl` in case it dies) and runs
+    `fn`. Its JSON-serialized result is published once the caller's transaction commits and
+    kept for `result_ttl` seconds; a rollback only releases the lock. Callers arriving
+    meanwhile wait up to `max_wait` seconds for that result, and callers arriving shortly
+    after receive it directly; neither runs `fn` again. An error is passed to the callers
+    that were waiting for it.
+    """
+    cache = frappe.cache()
+    lock_key = cache.make_key(LOCK_KEY.format(key=key))
+    result_key = cache.make_key(RESULT_KEY.format(key=key))
+
+    if (result := cache.get(result_key)) is not None:
+        return _coalesced(result)
+
+    token = frappe.generate_hash()
+    if not cache.set(lock_key, token, nx=True, ex=lock_ttl):
+        return _coalesced(_wait_for_result(cache, lock_key, result_key, max_wait))
+
+    def release():
+        _get_release_script()(keys=[lock_key], args=[token])
+
+    try:
+        result = fn()
+    except Exception as e:
+        cache.set(result_key, json.dumps({"error": str(e)}), ex=ERROR_TTL)
+        release()
+        raise
+
+    value = json.dumps({"result": json.loads(frappe.as_json(result, indent=None))})
+
+    def publish():
+        cache.set(result_key, value, ex=result_ttl)
+        release()
+
+    # a result is only shared once the documents it names exist for everyone else
+    frappe.db.after_commit.add(publish)
+    frappe.db.after_rollback.add(release)
+
+    return result
+
+
+def _wait_for_result(cache, lock_key, result_key, timeout):
+    deadline = time.monotonic() + timeout
+
+    with span("single_flight_wait"):
+        while time.monotonic() < deadline:
+            if (result := cache.get(result_key)) is not None:
+                return result
+
+            if not cache.exists(lock_key):
+                # the lock holder gave up without leaving a result behind
+                break
+
+            time.sleep(POLL_INTERVAL)
+
+    frappe.throw(_("This payment is already being processed, please check its status before trying again."))
+
+
+def _coalesced(value):
+    increment("waafipay_single_flight_coalesced_total")
+
+    value = json.loads(value)
+    if "error" in value:
+        frappe.throw(value["error"])
+
+    return value["result"]
+
+
+def _get_release_script():
+    global _release_script
+    if _release_script is None:
+        _release_script = frappe.cache().register_script(RELEASE_LOCK)
+
+    return _release_script
@@ -0,0 +1,170 @@
+import asyncio
+
+import frappe
+from frappe import _
+from frappe.utils import flt
+
+from waafipay_integration.waafipay.async_client import AsyncWaafiPayClient
+from waafipay_integration.waafipay.log_sink import make_log, update_log
+from waafipay_integration.waafipay.metrics import traced
+from waafipay_integration.waafipay.payment_status import set_payment_status
+from waafipay_integration.waafipay.rate_limit import INTERACTIVE
+from waafipay_integration.waafipay.waafipay_client import get_credentials
+
+MAX_CONCURRENCY = 4
+APPROVED_STATES = ("APPROVED", "RCS_SUCCESS")
+
+
+@traced("split_tender")
+def process_split_tender(lines, invoice_id):
+    """
+    Take every phone payment line of an invoice, all or nothing.
+
+    `lines` are dicts with payment_request, payment_gateway_account, phone_number, amount,
+    currency and mode_of_payment. Every line is preauthorized concurrently, even under the
+    Purchase capture mode, since only a preauthorization can be taken back. Once all of them
+    are approved they are committed concurrently; otherwise the approved ones are cancelled.
+    A commit failing after others went through cannot be undone here: those lines keep
+    the Committed status, the result is Failed and an Error Log lists them for a refund.
+
+    Returns `(status, lines)`, each line updated with its status, transaction_id and message.
+    """
+    lines = [frappe._dict(line, invoice_id=invoice_id) for line in lines]
+
+    for line in lines:
+        line.credentials = get_credentials(line.payment_gateway_account)
+        if not line.credentials:
+            frappe.throw(_("Credentials not found for {0}").format(line.payment_gateway_account))
+
+        if line.currency not in line.credentials.currencies:
+            frappe.throw(
+                _("Currency <b>{0}</b> is not supported by this gateway <b>{1}</b>.").format(
+                    line.currency, line.payment_gateway_account
+                )
+            )
+
+        line.amount = flt(line.amount, 2)
+        set_status(line, "Processing")
+
+    for line, response, error in send_all(lines, build_preauthorize_payload):
+        state = (response or {}).get("params", {}).get("state")
+        if not error and is_success(response) and state in APPROVED_STATES:
+            set_status(line, "Preauthorized", transaction_id=response["params"].get("transactionId"))
+        else:
+            set_status(line, "Failed", message=error or _("Payment not approved: {0}").format(state or get_message(response)))
+
+    if all(line.status == "Preauthorized" for line in lines):
+        for line, response, error in send_all(lines, build_commit_payload):
+            if not error and (response.get("responseCode") == "2001" or response.get("responseMsg") == "RCS_SUCCESS"):
+                set_status(line, "Committed")
+            else:
+                set_status(line, "Failed", message=error or _("Commit payment failed: {0}").format(get_message(response)))
+
+    if all(line.status == "Committed" for line in lines):
+        return "Paid", lines
+
+    cancel_preauthorized(lines)
+
+    if committed := [line for line in lines if line.status == "Committed"]:
+        frappe.log_error(
+            frappe.as_json({
+                "invoice": invoice_id,
+                "committed": [
+                    {field: line.get(field) for field in ("payment_request", "phone_number", "amount", "currency", "transaction_id")}
+                    for line in committed
+                ],
+                "failed": [{"payment_request": line.payment_request, "message": line.message} for line in lines if line.status == "Failed"],
+            }),
+            "WaafiPay Split Tender Partially Committed",
+        )
+
+    return "Failed", lines
+
+
+def cancel_preauthorized(lines):
+    """Release the holds of approved lines that were not committed."""
+    preauthorized = [line for line in lines if line.status == "Preauthorized"]
+
+    for line, response, error in send_all(preauthorized, build_cancel_payload):
+        if not error and is_success(response):
+            set_status(line, "Cancelled", message=_("Cancelled because another payment of the invoice failed"))
+        else:
+            set_status(line, "Cancel Failed", message=error or get_message(response))
+            frappe.log_error(
+                f"Could not cancel preauthorized transaction {line.transaction_id} of {line.payment_request}: {error or get_message(response)}",
+                "WaafiPay Split Tender Cancel Failed",
+            )
+
+
+def send_all(lines, build_payload):
+    """
+    Send one request per line concurrently, with one client per credentials.
+
+    Yields `(line, response, error)` after every call has finished, logging each of them.
+    """
+    groups = {}
+    for line in lines:
+        groups.setdefault(line.credentials.name, (line.credentials, []))[1].append(line)
+
+    async def send_group(credentials, group):
+        # POS terminals are waiting on these calls: use the interactive rate limit lane
+        async with AsyncWaafiPayClient(credentials, max_concurrency=MAX_CONCURRENCY, priority=INTERACTIVE) as client:
+            payloads = [build_payload(client, line) for line in group]
+            responses = await client.gather(client.send_request(payload) for payload in payloads)
+
+        return list(zip(group, payloads, responses))
+
+    async def send_groups():
+        results = await asyncio.gather(*(send_group(credentials, group) for credentials, group in groups.values()))
+        return [result for group in results for result in group]
+
+    for line, payload, response in asyncio.run(send_groups()) if groups else []:
+        log = make_log(
+            status="Initiated",
+            mode_of_payment=line.mode_of_payment,
+            reference_id=line.invoice_id,
+            request_payload=payload,
+        )
+
+        if isinstance(response, BaseException):
+            error = str(response) or type(response).__name__
+            update_log(log, status="Failed", error_message=error)
+            yield line, None, error
+            continue
+
+        update_log(
+            log,
+            status="Success" if is_success(response) else "Failed",
+            response_data=response,
+            error_message=None if is_success(response) else response.get("responseMsg"),
+        )
+        yield line, response, None
+
+
+def build_preauthorize_payload(client, line):
+    return client.build_preauthorize_payload(
+        line.phone_number, line.amount, line.currency, line.invoice_id, reference_id=line.payment_request
+    )
+
+
+def build_commit_payload(client, line):
+    return client.build_commit_payload(line.transaction_id)
+
+
+def build_cancel_payload(client, line):
+    return client.build_cancel_payload(line.transaction_id)
+
+
+def is_success(response):
+    return response.get("responseCode") == "2001" and response.get("errorCode") in ("0", 0, None)
+
+
+def get_message(response):
+    return (response or {}).get("responseMsg") or "Unknown error"
+
+
+def set_status(line, status, **details):
+    line.status = status
+    line.update(details)
+    if line.payment_request:
+        set_payment_status(line.payment_request, status, **details)
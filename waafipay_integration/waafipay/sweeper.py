@@ -0,0 +1,271 @@
+import asyncio
+import time
+
+import frappe
+from frappe.utils import add_to_date, cint, now, now_datetime
+
+from waafipay_integration.waafipay.async_client import AsyncWaafiPayClient
+from waafipay_integration.waafipay.log_sink import LOG_DOCTYPE
+from waafipay_integration.waafipay.metrics import increment, traced
+from waafipay_integration.waafipay.payment_status import set_payment_status
+from waafipay_integration.waafipay.waafipay_client import get_credentials, handle_payment_received
+from waafipay_integration.waafipay_integration.doctype.waafipay_integration_settings.waafipay_integration_settings import (
+    get_settings,
+)
+
+STATS_KEY = "waafipay_sweeper_last_run"
+DEFAULT_LOG_AGE = 15
+DEFAULT_PAYMENT_REQUEST_AGE = 30
+DEFAULT_MAX_AGE = 48
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CONCURRENCY = 10
+APPROVED_STATES = ("APPROVED", "RCS_SUCCESS")
+FAILED_STATES = ("FAILED", "DECLINED", "CANCELLED", "EXPIRED", "REJECTED")
+PENDING_STATUSES = ("Initiated", "Requested")
+
+
+def run():
+    """Scheduled: settle phone payments whose callback never arrived."""
+    settings = get_settings()
+    if not settings.enable_sweeper:
+        return
+
+    sweep(
+        log_age=cint(settings.sweeper_log_age_minutes) or DEFAULT_LOG_AGE,
+        payment_request_age=cint(settings.sweeper_payment_request_age_minutes) or DEFAULT_PAYMENT_REQUEST_AGE,
+        max_age=cint(settings.sweeper_max_age_hours) or DEFAULT_MAX_AGE,
+        batch_size=cint(settings.sweeper_batch_size) or DEFAULT_BATCH_SIZE,
+        concurrency=cint(settings.sweeper_concurrency) or DEFAULT_CONCURRENCY,
+    )
+
+
+def sweep(
+    log_age=DEFAULT_LOG_AGE,
+    payment_request_age=DEFAULT_PAYMENT_REQUEST_AGE,
+    max_age=DEFAULT_MAX_AGE,
+    batch_size=DEFAULT_BATCH_SIZE,
+    concurrency=DEFAULT_CONCURRENCY,
+):
+    """
+    Ask WaafiPay (HPP_GETTRANINFO) for the outcome of stale pending transactions.
+
+    Candidates are Payment Requests paid through a WaafiPay payment link (the only flow the
+    transaction info service covers): those with WaafiPay Logs still "Initiated" after
+    `log_age` minutes and those still unpaid after `payment_request_age` minutes, up to
+    `max_age` hours old.
+    They are checked in batches of `batch_size`, `concurrency` at a time per credentials.
+    Approved transactions go through `handle_payment_received`, exactly like a late callback.
+    Returns the stats of the run, which are also kept for `get_sweeper_stats`.
+    """
+    stats = frappe._dict(started=now(), checked=0, settled=0, failed=0, pending=0, errors=0)
+    start = time.monotonic()
+    oldest = add_to_date(now_datetime(), hours=-max_age)
+
+    for candidates in get_stale_log_batches(add_to_date(now_datetime(), minutes=-log_age), oldest, batch_size):
+        sweep_batch(candidates, concurrency, stats)
+
+    for candidates in get_stale_payment_request_batches(
+        add_to_date(now_datetime(), minutes=-payment_request_age), oldest, batch_size
+    ):
+        sweep_batch(candidates, concurrency, stats)
+
+    stats.duration = round(time.monotonic() - start, 3)
+    stats.throughput = round(stats.checked / stats.duration, 2) if stats.duration else 0.0
+    frappe.cache().set_value(STATS_KEY, stats)
+    frappe.logger("waafipay").info(f"WaafiPay sweeper: {frappe.as_json(stats, indent=None)}")
+
+    return stats
+
+
+def get_stale_log_batches(before, after, batch_size):
+    """Yield `{payment_request: [log names]}` for "Initiated" logs referencing a Payment Request."""
+    Log = frappe.qb.DocType(LOG_DOCTYPE)
+    last = None
+
+    while True:
+        query = (
+            frappe.qb.from_(Log)
+            .select(Log.name, Log.reference_id, Log.creation)
+            .where((Log.status == "Initiated") & (Log.creation < before) & (Log.creation > after))
+            .orderby(Log.creation)
+            .orderby(Log.name)
+            .limit(batch_size)
+        )
+        if last:
+            query = query.where((Log.creation > last.creation) | ((Log.creation == last.creation) & (Log.name > last.name)))
+
+        logs = query.run(as_dict=True)
+        if not logs:
+            return
+
+        last = logs[-1]
+        references = {log.reference_id for log in logs if log.reference_id}
+        payment_requests = set(
+            frappe.get_all(
+                "Payment Request",
+                filters={"name": ["in", list(references)], "waafipay_payment_link": ["is", "set"]},
+                pluck="name",
+            )
+        ) if references else set()
+
+        candidates = {}
+        for log in logs:
+            if log.reference_id in payment_requests:
+                candidates.setdefault(log.reference_id, []).append(log.name)
+
+        if candidates:
+            yield candidates
+
+
+def get_stale_payment_request_batches(before, after, batch_size):
+    """
+    Yield `{payment_request: []}` for submitted Payment Requests with a payment link that are still unpaid.
+
+    Links are generated for Email channel requests as well, so the channel is not filtered on.
+    """
+    PaymentRequest = frappe.qb.DocType("Payment Request")
+    last = None
+
+    while True:
+        query = (
+            frappe.qb.from_(PaymentRequest)
+            .select(PaymentRequest.name, PaymentRequest.modified)
+            .where(
+                (PaymentRequest.docstatus == 1)
+                & PaymentRequest.status.isin(PENDING_STATUSES)
+                & PaymentRequest.waafipay_payment_link.isnotnull()
+                & (PaymentRequest.modified < before)
+                & (PaymentRequest.modified > after)
+            )
+            .orderby(PaymentRequest.modified)
+            .orderby(PaymentRequest.name)
+            .limit(batch_size)
+        )
+        if last:
+            query = query.where(
+                (PaymentRequest.modified > last.modified)
+                | ((PaymentRequest.modified == last.modified) & (PaymentRequest.name > last.name))
+            )
+
+        rows = query.run(as_dict=True)
+        if not rows:
+            return
+
+        last = rows[-1]
+        yield {row.name: [] for row in rows}
+
+
+@traced("sweep_transactions")
+def sweep_batch(candidates, concurrency, stats):
+    payment_requests = frappe.get_all(
+        "Payment Request",
+        filters={"name": ["in", list(candidates)]},
+        fields=["name", "status", "payment_gateway_account"],
+    )
+
+    pending = []
+    for pr in payment_requests:
+        if pr.status == "Paid":
+            # settled meanwhile, only its stuck logs are left to close
+            resolve_logs(candidates[pr.name], "Success")
+        else:
+            pending.append(pr)
+
+    for pr, response in check_transactions(pending, concurrency):
+        apply_transaction_info(pr, response, candidates[pr.name], stats)
+
+    frappe.db.commit()
+
+
+def check_transactions(payment_requests, concurrency=DEFAULT_CONCURRENCY):
+    """HPP_GETTRANINFO of each of `payment_requests`, as `(payment_request, response)`, `concurrency` at a time per credentials."""
+    groups = {}
+    for pr in payment_requests:
+        credentials = get_credentials(pr.payment_gateway_account)
+        if credentials:
+            groups.setdefault(credentials.name, (credentials, []))[1].append(pr)
+
+    return asyncio.run(get_transaction_infos(groups.values(), concurrency)) if groups else []
+
+
+def is_approved(response):
+    if isinstance(response, BaseException) or response.get("responseCode") != "2001":
+        return False
+
+    return str((response.get("params") or {}).get("state") or "").upper() in APPROVED_STATES
+
+
+async def get_transaction_infos(groups, concurrency):
+    async def get_group(credentials, payment_requests):
+        async with AsyncWaafiPayClient(credentials, max_concurrency=concurrency) as client:
+            responses = await client.gather(client.get_transaction_info(pr.name) for pr in payment_requests)
+
+        return list(zip(payment_requests, responses))
+
+    results = await asyncio.gather(*(get_group(credentials, prs) for credentials, prs in groups))
+    return [result for group in results for result in group]
+
+
+def apply_transaction_info(pr, response, logs, stats):
+    stats.checked += 1
+
+    if isinstance(response, BaseException) or response.get("responseCode") != "2001":
+        # unknown to the gateway (link never opened) or not reachable: try again next run
+        outcome = "error" if isinstance(response, BaseException) else "pending"
+        stats.errors += outcome == "error"
+        stats.pending += outcome == "pending"
+        increment("waafipay_sweeper_checked_total", outcome=outcome)
+        return
+
+    params = response.get("params") or {}
+    state = str(params.get("state") or "").upper()
+
+    if state in APPROVED_STATES:
+        # the same settlement path as a late success callback, idempotency store included
+        outcome = handle_payment_received({
+            "responseCode": "2001",
+            "errorCode": "0",
+            "responseMsg": response.get("responseMsg"),
+            "params": {
+                "state": params.get("state"),
+                "referenceId": pr.name,
+                "transactionId": params.get("transactionId"),
+                "txAmount": params.get("txAmount"),
+            },
+        })
+        if outcome.get("status") == "Success":
+            stats.settled += 1
+            resolve_logs(logs, "Success")
+            increment("waafipay_sweeper_checked_total", outcome="settled")
+        else:
+            stats.errors += 1
+            increment("waafipay_sweeper_checked_total", outcome="error")
+
+    elif state in FAILED_STATES:
+        stats.failed += 1
+        resolve_logs(logs, "Failed", f"Transaction {state.lower()} at WaafiPay")
+        # no longer pending, so the next runs leave it alone
+        frappe.db.set_value("Payment Request", pr.name, "status", "Failed")
+        set_payment_status(pr.name, "Failed", message=response.get("responseMsg") or state)
+        increment("waafipay_sweeper_checked_total", outcome="failed")
+
+    else:
+        stats.pending += 1
+        increment("waafipay_sweeper_checked_total", outcome="pending")
+
+
+def resolve_logs(logs, status, error_message=None):
+    if not logs:
+        return
+
+    Log = frappe.qb.DocType(LOG_DOCTYPE)
+    query = frappe.qb.update(Log).set(Log.status, status).where(Log.name.isin(logs) & (Log.status == "Initiated"))
+    if error_message:
+        query = query.set(Log.error_message, error_message)
+    query.run()
+
+
+@frappe.whitelist()
+def get_sweeper_stats():
+    frappe.only_for("System Manager")
+    return frappe.cache().get_value(STATS_KEY)
@@ -0,0 +1,75 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import frappe
+from frappe import _
+from frappe.utils.jinja import get_jenv
+from jinja2 import TemplateError
+
+from waafipay_integration.waafipay.metrics import increment, span
+
+MAX_TEMPLATES = 128
+
+# Compiled templates of this worker, keyed by (source hash, language). The key changes
+# with the source, so an edited message never renders stale; clearing only frees memory.
+_templates = OrderedDict()
+_templates_lock = threading.Lock()
+
+
+def render_template(source, context, cache=True):
+    """
+    `frappe.render_template` for inline message templates, compiling each source only once.
+
+    Pass `cache=False` for one-off sources, which would only push the shared templates
+    out of the cache. Keeps frappe's guards: sources without Jinja markup are returned
+    as is and dunder access is refused, since gateway messages are user editable.
+    """
+    if not source:
+        return ""
+
+    if "{{" not in source and "{%" not in source:
+        return source
+
+    if ".__" in source:
+        frappe.throw(_("Illegal template"))
+
+    with span("render_message"):
+        try:
+            template = get_compiled_template(source) if cache else get_jenv().from_string(source)
+            return template.render(context)
+        except TemplateError:
+            frappe.throw(
+                title=_("Jinja Template Error"),
+                msg=f"<pre>{source}</pre><pre>{frappe.get_traceback()}</pre>",
+            )
+
+
+def get_compiled_template(source):
+    key = (hashlib.sha1(source.encode()).hexdigest(), frappe.local.lang)
+
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is not None:
+            _templates.move_to_end(key)
+            return template
+
+    template = get_jenv().from_string(source)
+    increment("waafipay_template_compiled_total")
+
+    with _templates_lock:
+        _templates[key] = template
+        while len(_templates) > MAX_TEMPLATES:
+            _templates.popitem(last=False)
+
+    return template
+
+
+def clear_template_cache():
+    with _templates_lock:
+        _templates.clear()
+
+
+def on_gateway_account_change(doc, method=None):
+    if method == "on_trash" or doc.has_value_changed("message"):
+        clear_template_cache()
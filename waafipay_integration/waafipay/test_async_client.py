@@ -0,0 +1,116 @@
+import asyncio
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay.async_client import AsyncWaafiPayClient
+from waafipay_integration.waafipay.test_credentials import make_credentials_record
+
+APPROVED = {"responseCode": "2001", "errorCode": "0", "params": {"state": "APPROVED"}}
+
+
+class MockGateway:
+    """In-process `/asm` endpoint answering with `respond(payload, attempt)`; keeps every payload it got."""
+
+    def __init__(self, respond=None, delay=0):
+        self.respond = respond or (lambda payload, attempt: APPROVED)
+        self.delay = delay
+        self.payloads = []
+        self.in_flight = self.max_in_flight = 0
+
+    async def handle(self, request):
+        payload = await request.json()
+        self.payloads.append(payload)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            response = self.respond(payload, len(self.payloads))
+        finally:
+            self.in_flight -= 1
+
+        if isinstance(response, int):
+            return web.Response(status=response)
+        return web.json_response(response)
+
+    def run(self, calls, **kwargs):
+        """Run `calls(client)` against this gateway and return its result."""
+
+        async def run():
+            app = web.Application()
+            app.router.add_post("/asm", self.handle)
+            async with TestServer(app) as server:
+                credentials = make_credentials_record(api_base_url=str(server.make_url("")))
+                async with AsyncWaafiPayClient(credentials, **kwargs) as client:
+                    return await calls(client)
+
+        return asyncio.run(run())
+
+
+class TestAsyncClient(FrappeTestCase):
+    def test_payloads_match_the_sync_client(self):
+        gateway = MockGateway()
+
+        response = gateway.run(lambda client: client.commit_authorized_payment("T-1"))
+
+        self.assertEqual(response, APPROVED)
+        (payload,) = gateway.payloads
+        self.assertEqual(payload["serviceName"], "API_PREAUTHORIZE_COMMIT")
+        self.assertEqual(payload["serviceParams"]["transactionId"], "T-1")
+        self.assertEqual(payload["serviceParams"]["apiKey"], "test-api-key")
+
+    def test_gather_bounds_concurrency(self):
+        gateway = MockGateway(
+            respond=lambda payload, attempt: {**APPROVED, "transactionId": payload["serviceParams"]["transactionId"]},
+            delay=0.05,
+        )
+
+        results = gateway.run(
+            lambda client: client.gather(client.commit_authorized_payment(f"T-{i}") for i in range(6)),
+            max_concurrency=2,
+        )
+
+        self.assertEqual([result["transactionId"] for result in results], [f"T-{i}" for i in range(6)])
+        self.assertEqual(gateway.max_in_flight, 2)
+
+    def test_gather_returns_failures(self):
+        gateway = MockGateway(respond=lambda payload, attempt: 400 if payload["serviceParams"]["transactionId"] == "T-1" else APPROVED)
+
+        results = gateway.run(lambda client: client.gather(client.commit_authorized_payment(f"T-{i}") for i in range(3)))
+
+        self.assertEqual(results[0], APPROVED)
+        self.assertIsInstance(results[1], aiohttp.ClientResponseError)
+        self.assertEqual(results[2], APPROVED)
+
+    def test_call_deadline(self):
+        gateway = MockGateway(delay=1)
+
+        (result,) = gateway.run(
+            lambda client: client.gather([client.commit_authorized_payment("T-1", timeout=0.1)])
+        )
+
+        self.assertIsInstance(result, asyncio.TimeoutError)
+
+    def test_transient_errors_are_retried(self):
+        gateway = MockGateway(respond=lambda payload, attempt: 502 if attempt == 1 else APPROVED)
+
+        self.assertEqual(gateway.run(lambda client: client.commit_authorized_payment("T-1")), APPROVED)
+        self.assertEqual(len(gateway.payloads), 2)
+        # the very same request is sent again
+        self.assertEqual(gateway.payloads[0]["requestId"], gateway.payloads[1]["requestId"])
+
+    def test_customer_wait_calls_are_not_sent_twice(self):
+        gateway = MockGateway(respond=lambda payload, attempt: 502 if attempt == 1 else APPROVED)
+
+        (result,) = gateway.run(lambda client: client.gather([client.preauthorize_payment("252610000001", 5, "USD")]))
+
+        self.assertIsInstance(result, aiohttp.ClientResponseError)
+        self.assertEqual(len(gateway.payloads), 1)
+
+    def test_needs_context_manager(self):
+        client = AsyncWaafiPayClient(make_credentials_record())
+
+        with self.assertRaises(RuntimeError):
+            asyncio.run(client.commit_authorized_payment("T-1"))
@@ -0,0 +1,121 @@
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import bulk_retry
+from waafipay_integration.waafipay.idempotency import get_idempotency_key, release_callback
+from waafipay_integration.waafipay.waafipay_client import try_again
+from waafipay_integration.waafipay_integration.doctype.waafipay_log.test_waafipay_log import get_status, make_log
+
+APPROVED_CALLBACK = {"responseCode": "2001", "errorCode": "0", "params": {"state": "APPROVED", "transactionId": "T-1"}}
+
+
+class TestBulkRetry(FrappeTestCase):
+    def setUp(self):
+        self.reference_id = f"PR-TEST-{frappe.generate_hash(length=10)}"
+
+        patcher = patch.object(bulk_retry, "set_payment_status")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        release_callback(get_idempotency_key({"referenceId": self.reference_id}))
+
+    def make_payment_request(self, status="Requested"):
+        return frappe._dict(
+            name=self.reference_id,
+            status=status,
+            flags=frappe._dict(),
+            create_payment_entry=MagicMock(return_value=frappe._dict(name="ACC-PAY-TEST")),
+        )
+
+    def test_approved_callback(self):
+        self.assertTrue(bulk_retry.is_approved_callback({}, APPROVED_CALLBACK))
+        # a 2001 callback without a state is settled as well
+        self.assertTrue(bulk_retry.is_approved_callback({}, {"responseCode": "2001"}))
+
+        self.assertFalse(bulk_retry.is_approved_callback({}, {"responseCode": "2001", "params": {"state": "DECLINED"}}))
+        self.assertFalse(bulk_retry.is_approved_callback({}, {**APPROVED_CALLBACK, "errorCode": "E10205"}))
+        # the answer to a request we sent, such as a payment link, is no proof of payment
+        self.assertFalse(bulk_retry.is_approved_callback({"serviceParams": {}}, APPROVED_CALLBACK))
+
+    def test_retry_chunk_settles_each_payment_request_once(self):
+        logs = [make_log(self.reference_id, response=APPROVED_CALLBACK), make_log(self.reference_id)]
+        settled = make_log(self.reference_id, status="Success")
+
+        with patch.object(bulk_retry, "retry_payment_request", return_value={"status": "Success"}) as retry:
+            results = bulk_retry.retry_chunk([log.name for log in [*logs, settled]])
+
+        retry.assert_called_once()
+        reference_id, payment_request, group, approved = retry.call_args.args
+        self.assertEqual(reference_id, self.reference_id)
+        self.assertEqual({log.name for log in group}, {log.name for log in logs})
+        self.assertTrue(approved)
+
+        statuses = {result["log"]: result["status"] for result in results}
+        self.assertEqual(statuses, {logs[0].name: "Success", logs[1].name: "Success", settled.name: "Skipped"})
+
+    def test_retry_payment_request_is_idempotent(self):
+        payment_request = self.make_payment_request()
+        logs = [make_log(self.reference_id, response=APPROVED_CALLBACK)]
+
+        outcome = bulk_retry.retry_payment_request(self.reference_id, payment_request, logs, True)
+        self.assertEqual(outcome, {"status": "Success", "payment_entry": "ACC-PAY-TEST"})
+        self.assertEqual(get_status(logs[0]), "Success")
+
+        # the claim is still in flight until the chunk commits
+        outcome = bulk_retry.retry_payment_request(self.reference_id, payment_request, logs, True)
+        self.assertEqual(outcome["status"], "Skipped")
+
+        # the Redis key is gone, the stored outcome still answers
+        release_callback(get_idempotency_key({"referenceId": self.reference_id}))
+        outcome = bulk_retry.retry_payment_request(self.reference_id, payment_request, logs, True)
+        self.assertEqual(outcome["status"], "Success")
+        self.assertEqual(outcome["message"], "Already settled")
+
+        payment_request.create_payment_entry.assert_called_once()
+
+    def test_retry_payment_request_needs_proof_of_payment(self):
+        payment_request = self.make_payment_request()
+        log = make_log(self.reference_id)
+
+        outcome = bulk_retry.retry_payment_request(self.reference_id, payment_request, [log], False)
+
+        self.assertEqual(outcome["status"], "Failed")
+        self.assertEqual(get_status(log), "Failed")
+        payment_request.create_payment_entry.assert_not_called()
+
+    def test_paid_payment_request_only_closes_logs(self):
+        payment_request = self.make_payment_request(status="Paid")
+        log = make_log(self.reference_id)
+
+        outcome = bulk_retry.retry_payment_request(self.reference_id, payment_request, [log], True)
+
+        self.assertEqual(outcome["status"], "Success")
+        self.assertEqual(get_status(log), "Success")
+        payment_request.create_payment_entry.assert_not_called()
+
+    def test_retry_logs_is_restricted(self):
+        log = make_log(self.reference_id)
+
+        frappe.set_user("Guest")
+        try:
+            self.assertRaises(frappe.PermissionError, bulk_retry.retry_logs, [log.name])
+            self.assertRaises(frappe.PermissionError, try_again, log.name)
+        finally:
+            frappe.set_user("Administrator")
+
+    def test_retry_logs_queues_chunks(self):
+        logs = [make_log(self.reference_id) for _ in range(3)]
+        settled = make_log(self.reference_id, status="Success")
+
+        with (
+            patch.object(bulk_retry, "CHUNK_SIZE", 2),
+            patch.object(frappe, "enqueue") as enqueue,
+        ):
+            batch = bulk_retry.retry_logs([log.name for log in [*logs, settled]])
+
+        self.assertEqual(batch["total"], 3)
+        self.assertEqual([len(call.kwargs["names"]) for call in enqueue.call_args_list], [2, 1])
+        self.assertNotIn(settled.name, [name for call in enqueue.call_args_list for name in call.kwargs["names"]])
@@ -0,0 +1,93 @@
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import waafipay_client
+from waafipay_integration.waafipay.circuit_breaker import DEFAULT_OPEN_SECONDS, CircuitBreaker, CircuitOpenError
+from waafipay_integration.waafipay.test_credentials import make_credentials_record
+from waafipay_integration.waafipay.waafipay_client import WaafiPayClient
+
+
+class TestCircuitBreaker(FrappeTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(
+            f"TEST-{frappe.generate_hash(length=10)}",
+            "http://waafipay.test",
+            failure_threshold=2,
+            slow_call_threshold=10,
+            open_seconds=30,
+            half_open_probes=1,
+        )
+
+    def tearDown(self):
+        self.breaker.close()
+
+    def test_breaker_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.get_state()["state"], "Closed")
+        self.assertFalse(self.breaker.before_call())
+
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.get_state()["state"], "Open")
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+
+    def test_breaker_half_open_probe(self):
+        self.breaker.trip()
+        # the open period is over
+        self.breaker.cache.delete(self.breaker.keys.open)
+        self.assertEqual(self.breaker.get_state()["state"], "Half-Open")
+
+        self.assertTrue(self.breaker.before_call())
+        # only one probe at a time
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+
+        self.breaker.record_success(0.2, probe=True)
+        self.assertEqual(self.breaker.get_state()["state"], "Closed")
+
+    def test_failed_probe_opens_again(self):
+        self.breaker.trip()
+        self.breaker.cache.delete(self.breaker.keys.open)
+
+        self.breaker.record_failure(probe=self.breaker.before_call())
+        self.assertEqual(self.breaker.get_state()["state"], "Open")
+
+    def test_customer_wait_is_not_slow(self):
+        for _ in range(3):
+            self.breaker.record_success(60, service_name="API_PREAUTHORIZE")
+            self.breaker.record_success(60, service_name="API_PURCHASE")
+        self.assertEqual(self.breaker.get_state()["state"], "Closed")
+
+        for _ in range(2):
+            self.breaker.record_success(60, service_name="API_PREAUTHORIZE_COMMIT")
+        self.assertEqual(self.breaker.get_state()["state"], "Open")
+
+    def test_breaker_is_shared_per_credential_and_url(self):
+        self.breaker.trip()
+
+        self.assertEqual(CircuitBreaker(self.breaker.name, "http://waafipay.test").get_state()["state"], "Open")
+        self.assertEqual(CircuitBreaker(self.breaker.name, "http://other.test").get_state()["state"], "Closed")
+
+    def test_for_credentials(self):
+        breaker = CircuitBreaker.for_credentials(
+            make_credentials_record(circuit_breaker_enabled=1, circuit_failure_threshold=3, circuit_open_seconds=0)
+        )
+
+        self.assertEqual(breaker.base_url, "http://waafipay.test")
+        self.assertEqual((breaker.failure_threshold, breaker.open_seconds), (3, DEFAULT_OPEN_SECONDS))
+
+        disabled = CircuitBreaker.for_credentials(make_credentials_record())
+        for _ in range(10):
+            disabled.record_failure()
+        self.assertFalse(disabled.before_call())
+        self.assertEqual(disabled.get_state()["state"], "Closed")
+
+    def test_open_circuit_fails_fast(self):
+        client = WaafiPayClient(make_credentials_record(circuit_breaker_enabled=1))
+        self.addCleanup(client.breaker.close)
+        client.breaker.trip()
+
+        with patch.object(waafipay_client, "get_credentials_session", MagicMock()) as get_session:
+            self.assertRaises(CircuitOpenError, client.commit_authorized_payment, "T-1")
+
+        get_session.assert_not_called()
@@ -0,0 +1,157 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import credentials
+from waafipay_integration.waafipay.credentials import (
+    WaafiPayCredentialsRecord,
+    clear_credentials_cache,
+    get_credentials_record,
+    get_gateway_account,
+    get_gateway_credentials,
+)
+
+TEST_CREDENTIALS = "_Test WaafiPay Credentials"
+TEST_MODE_OF_PAYMENT = "_Test WaafiPay"
+
+
+def make_credentials_record(name=TEST_CREDENTIALS, api_key="test-api-key", hpp_key="test-hpp-key", **fields):
+    """
+    A `WaafiPayCredentialsRecord` that needs no `WaafiPay Credentials` doc: its passwords are
+    put straight into the decrypted secrets of this worker.
+    """
+    record = WaafiPayCredentialsRecord(
+        name=name,
+        modified="2026-10-18 13:00:00.000000",
+        api_base_url="http://waafipay.test",
+        merchant_uid="M0910291",
+        api_user_id=1000416,
+        store_id="1000297",
+        success_callback_url="http://pos.test/success",
+        failure_callback_url="http://pos.test/failure",
+        connection_pool_size=10,
+        connect_timeout=5,
+        read_timeout=30,
+        circuit_breaker_enabled=0,
+        retry_max_attempts=3,
+        retry_backoff=0,
+        retry_deadline=20,
+        service_policies=[],
+        rate_limit_per_second=0,
+        currencies={"USD"},
+        modes={TEST_MODE_OF_PAYMENT},
+    )
+    record.update(fields)
+    credentials._secrets[(frappe.local.site, record.name, record.modified)] = {"api_key": api_key, "hpp_key": hpp_key}
+    return record
+
+
+def make_credentials(**fields):
+    if not frappe.db.exists("Mode of Payment", TEST_MODE_OF_PAYMENT):
+        frappe.get_doc({"doctype": "Mode of Payment", "mode_of_payment": TEST_MODE_OF_PAYMENT, "type": "Phone"}).insert()
+
+    if frappe.db.exists(credentials.DOCTYPE, TEST_CREDENTIALS):
+        return frappe.get_doc(credentials.DOCTYPE, TEST_CREDENTIALS)
+
+    return frappe.get_doc({
+        "doctype": credentials.DOCTYPE,
+        "credential_name": TEST_CREDENTIALS,
+        "environment": "Sandbox",
+        "api_base_url": "http://waafipay.test",
+        "merchant_uid": "M0910291",
+        "api_user_id": 1000416,
+        "api_key": "test-api-key",
+        "hpp_key": "test-hpp-key",
+        "waafipay_modes": [{"mode_of_payment": TEST_MODE_OF_PAYMENT}],
+        "supported_currencies": [{"currency": "USD"}],
+        **fields,
+    }).insert()
+
+
+class TestCredentials(FrappeTestCase):
+    def setUp(self):
+        self.doc = make_credentials()
+        clear_credentials_cache()
+
+    def tearDown(self):
+        clear_credentials_cache()
+
+    def test_record_is_cached(self):
+        record = get_credentials_record(TEST_CREDENTIALS)
+
+        self.assertEqual(record.merchant_uid, "M0910291")
+        self.assertEqual(record.currencies, {"USD"})
+        self.assertEqual(record.modes, {TEST_MODE_OF_PAYMENT})
+        # secrets are never cached in Redis
+        self.assertNotIn("api_key", record)
+        self.assertIs(get_credentials_record(TEST_CREDENTIALS), record)
+
+        # the next request reads it from Redis
+        frappe.local.waafipay_credentials = {}
+        with patch.object(credentials, "_build_record") as build_record:
+            self.assertEqual(get_credentials_record(TEST_CREDENTIALS), record)
+
+        build_record.assert_not_called()
+
+    def test_passwords_are_decrypted_once(self):
+        record = get_credentials_record(TEST_CREDENTIALS)
+
+        with patch.object(credentials, "get_decrypted_password", wraps=credentials.get_decrypted_password) as decrypt:
+            self.assertEqual(record.get_password("api_key"), "test-api-key")
+            self.assertEqual(record.get_password("hpp_key"), "test-hpp-key")
+            calls = decrypt.call_count
+            record.get_password("api_key")
+
+        self.assertEqual(decrypt.call_count, calls)
+
+    def test_update_clears_the_cache(self):
+        old = get_credentials_record(TEST_CREDENTIALS)
+        old.get_password()
+
+        self.doc.merchant_uid = "M0910292"
+        self.doc.api_key = "new-api-key"
+        self.doc.save()
+
+        record = get_credentials_record(TEST_CREDENTIALS)
+        self.assertEqual(record.merchant_uid, "M0910292")
+        self.assertEqual(record.get_password(), "new-api-key")
+        # the secrets of the old version are dropped
+        self.assertNotIn((frappe.local.site, old.name, old.modified), credentials._secrets)
+
+    def test_secrets_are_kept_per_site(self):
+        record = make_credentials_record(name="_Test WaafiPay Other Site")
+
+        with patch.object(frappe.local, "site", "other.test"):
+            credentials._secrets[("other.test", record.name, record.modified)] = {"api_key": "other-site-key"}
+            self.assertEqual(record.get_password(), "other-site-key")
+
+        self.assertEqual(record.get_password(), "test-api-key")
+
+    def test_missing_credentials(self):
+        self.assertIsNone(get_credentials_record("_Test Missing WaafiPay Credentials"))
+
+    def test_gateway_credentials_are_cached(self):
+        with patch.object(credentials, "_get_credentials_name", return_value=TEST_CREDENTIALS) as get_name:
+            self.assertEqual(get_gateway_credentials("_Test Gateway - USD").name, TEST_CREDENTIALS)
+            self.assertEqual(get_gateway_credentials("_Test Gateway - USD").name, TEST_CREDENTIALS)
+
+        get_name.assert_called_once_with("_Test Gateway - USD")
+
+    def test_gateway_account_lookup(self):
+        accounts = {
+            "by_name": {
+                "_Test Gateway - USD": {"name": "_Test Gateway - USD", "payment_gateway": "_Test Gateway"},
+                "_Test Gateway - SOS": {"name": "_Test Gateway - SOS", "payment_gateway": "_Test Gateway"},
+            },
+            "by_currency": {"USD": "_Test Gateway - USD", "SOS": "_Test Gateway - SOS"},
+            "default": "_Test Gateway - USD",
+        }
+
+        with patch.object(credentials, "_build_gateway_accounts", return_value=accounts) as build:
+            self.assertEqual(get_gateway_account("_Test Gateway - SOS").name, "_Test Gateway - SOS")
+            self.assertEqual(get_gateway_account(currency="SOS").name, "_Test Gateway - SOS")
+            self.assertEqual(get_gateway_account(default=True).name, "_Test Gateway - USD")
+            self.assertIsNone(get_gateway_account(currency="EUR"))
+
+        build.assert_called_once()
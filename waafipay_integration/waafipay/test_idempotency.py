@@ -0,0 +1,87 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import waafipay_client
+from waafipay_integration.waafipay.idempotency import (
+    CALLBACK_KEY,
+    PENDING_TTL,
+    claim_callback,
+    get_idempotency_key,
+    record_callback_outcome,
+    release_callback,
+)
+
+
+class TestIdempotency(FrappeTestCase):
+    def setUp(self):
+        self.key = f"ref:TEST-{frappe.generate_hash(length=10)}"
+
+    def tearDown(self):
+        release_callback(self.key)
+
+    def test_idempotency_key_prefers_payment_request(self):
+        self.assertEqual(
+            get_idempotency_key({"params": {"referenceId": "PR-1", "transactionId": "T-1"}}), "ref:PR-1"
+        )
+        self.assertEqual(get_idempotency_key({"transactionId": "T-1"}), "txn:T-1")
+        self.assertIsNone(get_idempotency_key({"params": "not a dict"}))
+
+    def test_claim_and_release(self):
+        self.assertEqual(claim_callback(self.key), (True, None))
+        # a redelivery while the first one is in flight
+        self.assertEqual(claim_callback(self.key), (False, {"status": "Processing"}))
+
+        release_callback(self.key)
+        self.assertEqual(claim_callback(self.key), (True, None))
+
+    def test_pending_claim_expires_quickly(self):
+        claim_callback(self.key)
+
+        cache = frappe.cache()
+        ttl = cache.ttl(cache.make_key(CALLBACK_KEY.format(key=self.key)))
+        self.assertTrue(0 < ttl <= PENDING_TTL)
+
+    def test_stored_outcome_backs_up_redis(self):
+        log = frappe.get_doc({"doctype": "WaafiPay Log", "status": "Success"}).insert(ignore_permissions=True)
+        outcome = {"status": "Success", "log": log.name, "reference_id": self.key[4:]}
+
+        claim_callback(self.key)
+        record_callback_outcome(self.key, outcome, log=log.name, transaction_id="T-1")
+        self.assertEqual(frappe.db.get_value("WaafiPay Processed Callback", self.key, "transaction_id"), "T-1")
+
+        # the Redis key is gone (expired, or the outcome never reached it)
+        release_callback(self.key)
+        self.assertEqual(claim_callback(self.key), (False, outcome))
+
+    def test_duplicate_callback_is_answered_from_the_store(self):
+        callback = {"responseCode": "2001", "params": {"referenceId": self.key[4:], "transactionId": "T-1"}}
+        outcome = {"status": "Success", "log": None, "reference_id": self.key[4:]}
+
+        with patch.object(waafipay_client, "process_payment_received", return_value=outcome) as process:
+            self.assertEqual(waafipay_client.handle_payment_received(callback), outcome)
+            # the first delivery is still in flight
+            self.assertEqual(waafipay_client.handle_payment_received(callback), {"status": "Processing"})
+
+            release_callback(self.key)
+            self.assertEqual(waafipay_client.handle_payment_received(callback), outcome)
+
+        process.assert_called_once()
+
+    def test_failed_callback_can_be_retried(self):
+        callback = {"responseCode": "2001", "params": {"referenceId": self.key[4:]}}
+
+        with patch.object(waafipay_client, "process_payment_received", return_value={"status": "Failed"}) as process:
+            waafipay_client.handle_payment_received(callback)
+            waafipay_client.handle_payment_received(callback)
+
+        self.assertEqual(process.call_count, 2)
+
+    def test_crashed_callback_releases_its_claim(self):
+        callback = {"responseCode": "2001", "params": {"referenceId": self.key[4:]}}
+
+        with patch.object(waafipay_client, "process_payment_received", side_effect=frappe.ValidationError):
+            self.assertRaises(frappe.ValidationError, waafipay_client.handle_payment_received, callback)
+
+        self.assertEqual(claim_callback(self.key), (True, None))
@@ -0,0 +1,119 @@
+import json
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from waafipay_integration.waafipay import inbox
+
+
+def settled_handler(payload):
+    return {"status": "Success", "reference_id": payload.get("referenceId")}
+
+
+def processing_handler(payload):
+    return {"status": "Processing"}
+
+
+def failing_handler(payload):
+    raise frappe.ValidationError("Payment Entry could not be created")
+
+
+class TestInbox(FrappeTestCase):
+    def setUp(self):
+        # process_entry commits; keep everything inside the test transaction
+        for method in ("commit", "rollback"):
+            patcher = patch.object(frappe.db, method)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_entry(self, status="Processing"):
+        return frappe.get_doc({
+            "doctype": inbox.DOCTYPE,
+            "callback_type": "Success",
+            "status": status,
+            "payload": json.dumps({"referenceId": "PR-TEST"}),
+        }).insert(ignore_permissions=True)
+
+    def process(self, entry, handler, max_attempts=3):
+        with patch.dict(inbox.HANDLERS, {"Success": f"{__name__}.{handler.__name__}"}):
+            inbox.process_entry(entry.name, max_attempts)
+
+        return frappe.get_doc(inbox.DOCTYPE, entry.name)
+
+    def test_settled_callback_is_processed(self):
+        entry = self.process(self.make_entry(), settled_handler)
+
+        self.assertEqual(entry.status, "Processed")
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(json.loads(entry.outcome)["reference_id"], "PR-TEST")
+
+    def test_processing_elsewhere_is_retried_with_backoff(self):
+        entry = self.process(self.make_entry(), processing_handler)
+
+        self.assertEqual(entry.status, "Failed")
+        self.assertEqual(entry.attempts, 1)
+        self.assertIn("still being processed", entry.last_error)
+        self.assertGreater(entry.next_attempt_on, now_datetime())
+
+    def test_backoff_doubles_until_dead_letter(self):
+        entry = self.make_entry()
+
+        for attempt, minutes in ((1, 1), (2, 2)):
+            start = now_datetime()
+            entry = self.process(entry, failing_handler)
+            self.assertEqual((entry.status, entry.attempts), ("Failed", attempt))
+            self.assertGreaterEqual(entry.next_attempt_on, add_to_date(start, minutes=minutes, seconds=-1))
+            self.assertLessEqual(entry.next_attempt_on, add_to_date(now_datetime(), minutes=minutes, seconds=1))
+
+        entry = self.process(entry, failing_handler)
+        self.assertEqual((entry.status, entry.attempts), ("Dead Letter", 3))
+        self.assertIsNone(entry.next_attempt_on)
+
+    def test_callback_is_acknowledged_before_processing(self):
+        callback = {"responseCode": "2001", "params": {"referenceId": f"PR-TEST-{frappe.generate_hash(length=10)}"}}
+
+        with patch.object(inbox, "enqueue_consumer") as enqueue_consumer:
+            response = inbox.receive_callback("Success", callback)
+
+        self.assertEqual(response["status"], "Queued")
+        entry = frappe.get_doc(inbox.DOCTYPE, response["inbox"])
+        self.assertEqual((entry.status, entry.idempotency_key), ("Pending", f"ref:{callback['params']['referenceId']}"))
+        self.assertEqual(json.loads(entry.payload), callback)
+        frappe.db.commit.assert_called_once()
+        enqueue_consumer.assert_called_once()
+
+    def test_settled_callback_is_not_queued_again(self):
+        outcome = {"status": "Success", "log": "LOG-1", "reference_id": "PR-TEST"}
+
+        with (
+            patch.object(inbox, "get_callback_outcome", return_value=outcome),
+            patch.object(inbox, "enqueue_consumer") as enqueue_consumer,
+        ):
+            self.assertEqual(inbox.receive_callback("Success", {"responseCode": "2001", "referenceId": "PR-TEST"}), outcome)
+
+        enqueue_consumer.assert_not_called()
+
+    def test_stale_processing_entries_are_recovered(self):
+        stale = self.make_entry()
+        frappe.db.set_value(inbox.DOCTYPE, stale.name, "modified", add_to_date(now_datetime(), hours=-1), update_modified=False)
+        recent = self.make_entry()
+
+        with patch.object(inbox, "enqueue_consumer") as enqueue_consumer:
+            inbox.run()
+
+        self.assertEqual(frappe.db.get_value(inbox.DOCTYPE, stale.name, "status"), "Pending")
+        self.assertEqual(frappe.db.get_value(inbox.DOCTYPE, recent.name, "status"), "Processing")
+        enqueue_consumer.assert_called_once()
+
+    def test_claim_batch_takes_due_entries(self):
+        pending = self.make_entry("Pending")
+        later = self.make_entry("Failed")
+        frappe.db.set_value(inbox.DOCTYPE, later.name, "next_attempt_on", add_to_date(now_datetime(), hours=1))
+
+        names = inbox.claim_batch(1000)
+
+        self.assertIn(pending.name, names)
+        self.assertNotIn(later.name, names)
+        self.assertEqual(frappe.db.get_value(inbox.DOCTYPE, pending.name, "status"), "Processing")
@@ -0,0 +1,83 @@
+import base64
+import gzip
+import json
+import shutil
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import log_retention
+from waafipay_integration.waafipay.log_retention import COMPRESSED_COLUMN, LOG_DOCTYPE
+from waafipay_integration.waafipay_integration.doctype.waafipay_log.test_waafipay_log import make_log
+
+CUTOFF = "2000-02-01"
+PAYLOADS = {
+    "request_payload": json.dumps({"serviceName": "API_PREAUTHORIZE", "serviceParams": {"apiUserId": 1000416}}),
+    "response_data": json.dumps({"responseCode": "2001", "responseMsg": "RCS_SUCCESS", "params": {"state": "APPROVED"}}),
+}
+
+
+def make_old_log(**fields):
+    log = make_log(f"ACC-PRQ-TEST-{frappe.generate_hash(length=10)}", status="Success", **fields)
+    frappe.db.set_value(LOG_DOCTYPE, log.name, "creation", "2000-01-15 10:00:00", update_modified=False)
+    return log
+
+
+def get_compressed(log):
+    Log = frappe.qb.DocType(LOG_DOCTYPE)
+    value = frappe.qb.from_(Log).select(Log.field(COMPRESSED_COLUMN)).where(Log.name == log.name).run()[0][0]
+    return bytes(value) if value is not None else None
+
+
+class TestLogRetention(FrappeTestCase):
+    def setUp(self):
+        patcher = patch.object(frappe.db, "commit")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_payloads_are_stored_as_raw_zlib(self):
+        compressed = log_retention.compress_payloads(PAYLOADS)
+
+        self.assertIsInstance(compressed, bytes)
+        self.assertLess(len(compressed), len(base64.b64encode(compressed)))
+        self.assertEqual(log_retention.decompress_payloads(memoryview(compressed)), PAYLOADS)
+
+    def test_compress_logs(self):
+        log = make_old_log(request=json.loads(PAYLOADS["request_payload"]), response=json.loads(PAYLOADS["response_data"]))
+        empty = make_old_log()
+        frappe.db.set_value(LOG_DOCTYPE, empty.name, {"request_payload": None, "response_data": None})
+        recent = make_log("ACC-PRQ-TEST-RECENT", request={"serviceName": "API_PURCHASE"})
+
+        log_retention.compress_logs(CUTOFF)
+
+        self.assertEqual(frappe.db.get_value(LOG_DOCTYPE, log.name, ["request_payload", "response_data"]), (None, None))
+        self.assertEqual(log_retention.decompress_payloads(get_compressed(log)), PAYLOADS)
+        # nothing to compress
+        self.assertIsNone(get_compressed(empty))
+        self.assertIsNone(get_compressed(recent))
+
+        # the form still shows the payloads
+        doc = frappe.get_doc(LOG_DOCTYPE, log.name)
+        self.assertEqual(doc.request_payload, PAYLOADS["request_payload"])
+        self.assertNotIn(COMPRESSED_COLUMN, doc.__dict__)
+
+    def test_archive_to_file(self):
+        folder = f"waafipay_log_archive_test_{frappe.generate_hash(length=10)}"
+        self.addCleanup(shutil.rmtree, frappe.get_site_path("private", folder), ignore_errors=True)
+
+        compressed = make_old_log(request=json.loads(PAYLOADS["request_payload"]), response=json.loads(PAYLOADS["response_data"]))
+        log_retention.compress_logs(CUTOFF)
+        plain = make_old_log(request={"serviceName": "API_PURCHASE"})
+
+        with patch.object(log_retention, "ARCHIVE_FOLDER", folder):
+            log_retention.archive_logs(CUTOFF, "Compressed File")
+
+        self.assertFalse(frappe.db.exists(LOG_DOCTYPE, {"name": ["in", [compressed.name, plain.name]]}))
+
+        with gzip.open(frappe.get_site_path("private", folder, "200001.jsonl.gz"), "rt") as f:
+            archived = {row["name"]: row for row in map(json.loads, f)}
+
+        self.assertEqual(archived[compressed.name]["request_payload"], PAYLOADS["request_payload"])
+        self.assertNotIn(COMPRESSED_COLUMN, archived[compressed.name])
+        self.assertEqual(json.loads(archived[plain.name]["request_payload"]), {"serviceName": "API_PURCHASE"})
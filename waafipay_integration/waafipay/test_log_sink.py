@@ -0,0 +1,120 @@
+import json
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import log_sink
+from waafipay_integration.waafipay.log_sink import LOG_DOCTYPE, QUEUE_KEY, WRITER_LOCK_KEY, WaafiPayLogSink
+
+PREAUTHORIZE = {
+    "requestId": "R-1",
+    "serviceName": "API_PREAUTHORIZE",
+    "serviceParams": {"transactionInfo": {"referenceId": "ACC-PRQ-TEST", "amount": "5.00", "currency": "USD"}},
+}
+APPROVED = {"responseCode": "2001", "params": {"state": "APPROVED", "transactionId": "T-1"}}
+
+
+class TestLogSink(FrappeTestCase):
+    def setUp(self):
+        self.sink = WaafiPayLogSink()
+        self.settings = frappe._dict(log_writer="On Commit")
+
+        for target, kwargs in (
+            (log_sink, {"attribute": "get_settings", "return_value": self.settings}),
+            # the writer and the rollback path commit on their own
+            (frappe.db, {"attribute": "commit"}),
+            (frappe.db, {"attribute": "rollback"}),
+        ):
+            patcher = patch.object(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        frappe.cache().delete_value([QUEUE_KEY, WRITER_LOCK_KEY])
+
+    def tearDown(self):
+        frappe.cache().delete_value([QUEUE_KEY, WRITER_LOCK_KEY])
+
+    def get_log(self, log):
+        return frappe.db.get_value(LOG_DOCTYPE, log.name, ["status", "service_name", "transaction_id", "error_message"], as_dict=True)
+
+    def test_logs_are_written_once_on_flush(self):
+        log = self.sink.add(status="Initiated", request_payload=PREAUTHORIZE)
+        self.sink.update(log, status="Success", response_data=APPROVED)
+        self.assertFalse(frappe.db.exists(LOG_DOCTYPE, log.name))
+
+        with patch.object(frappe.db, "bulk_insert", wraps=frappe.db.bulk_insert) as bulk_insert:
+            self.sink.flush()
+
+        bulk_insert.assert_called_once()
+        self.assertEqual(
+            self.get_log(log),
+            {"status": "Success", "service_name": "API_PREAUTHORIZE", "transaction_id": "T-1", "error_message": None},
+        )
+        self.assertEqual(json.loads(frappe.db.get_value(LOG_DOCTYPE, log.name, "request_payload")), PREAUTHORIZE)
+
+    def test_flushed_logs_are_updated(self):
+        log = self.sink.add(status="Initiated")
+        self.sink.flush()
+
+        self.sink.update(log, status="Failed", error_message="Timed out")
+        self.assertEqual(self.sink.updates, {log.name: {"status": "Failed", "error_message": "Timed out"}})
+        self.sink.flush()
+
+        self.assertEqual((self.get_log(log).status, self.get_log(log).error_message), ("Failed", "Timed out"))
+
+    def test_creation_keeps_insertion_order(self):
+        logs = [self.sink.add(status="Initiated") for _ in range(5)]
+
+        self.assertTrue(all(a.creation < b.creation for a, b in zip(logs, logs[1:])))
+
+    def test_logs_survive_a_rollback(self):
+        log = self.sink.add(status="Failed", error_message="Payment not approved")
+
+        self.sink.flush_after_rollback()
+
+        self.assertEqual(self.get_log(log).status, "Failed")
+        frappe.db.commit.assert_called_once()
+
+    def test_background_writer_keeps_the_order(self):
+        self.settings.log_writer = "Background"
+
+        with patch.object(frappe, "enqueue") as enqueue:
+            log = self.sink.add(status="Initiated", request_payload=PREAUTHORIZE)
+            self.sink.flush()
+            self.sink.update(log, status="Success", response_data=APPROVED)
+            self.sink.flush()
+
+        self.assertEqual(enqueue.call_args.kwargs["job_id"], log_sink.WRITER_JOB_ID)
+        self.assertTrue(enqueue.call_args.kwargs["deduplicate"])
+        self.assertEqual(frappe.cache().llen(QUEUE_KEY), 2)
+        self.assertFalse(frappe.db.exists(LOG_DOCTYPE, log.name))
+
+        self.assertEqual(log_sink.drain_log_queue(), 2)
+
+        self.assertEqual(self.get_log(log).status, "Success")
+        self.assertEqual(self.get_log(log).transaction_id, "T-1")
+        self.assertEqual(frappe.cache().llen(QUEUE_KEY), 0)
+
+    def test_one_writer_at_a_time(self):
+        with patch.object(frappe, "enqueue"):
+            log_sink.queue_logs([])
+        frappe.cache().set(frappe.cache().make_key(WRITER_LOCK_KEY), 1)
+
+        self.assertIsNone(log_sink.drain_log_queue())
+        self.assertEqual(frappe.cache().llen(QUEUE_KEY), 1)
+
+    def test_failed_batch_does_not_block_the_queue(self):
+        with patch.object(frappe, "enqueue"):
+            log_sink.queue_logs([{"name": "bad"}])
+            log_sink.queue_logs([{"name": "good"}])
+
+        with (
+            patch.object(log_sink, "write_logs", side_effect=[frappe.ValidationError("bad row"), None]) as write_logs,
+            patch.object(frappe, "log_error") as log_error,
+        ):
+            self.assertEqual(log_sink.drain_log_queue(), 2)
+
+        self.assertEqual([call.args[0] for call in write_logs.call_args_list], [[{"name": "bad"}], [{"name": "good"}]])
+        self.assertEqual(log_error.call_args.args[1], "WaafiPay Log Write Failed")
+        self.assertEqual(frappe.cache().llen(QUEUE_KEY), 0)
@@ -0,0 +1,115 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import metrics
+from waafipay_integration.waafipay.metrics import METRIC_NAME, increment, record, render_metrics, set_labels, span, trace, traced
+
+SERIES = 'operation="preauthorize",phase="total",credential="WaafiPay",service="API_PREAUTHORIZE",response_code="2001"'
+
+
+class TestMetrics(FrappeTestCase):
+    def setUp(self):
+        suffix = frappe.generate_hash(length=10)
+        for attribute in ("METRICS_KEY", "COUNTERS_KEY"):
+            patcher = patch.object(metrics, attribute, f"{getattr(metrics, attribute)}_test_{suffix}")
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        cache = frappe.cache()
+        cache.delete(cache.make_key(metrics.METRICS_KEY), cache.make_key(metrics.COUNTERS_KEY))
+
+    def get_lines(self):
+        return render_metrics().splitlines()
+
+    def test_histogram_buckets_are_cumulative(self):
+        labels = {"credential": "WaafiPay", "service": "API_PREAUTHORIZE", "response_code": "2001"}
+        record("preauthorize", [("total", 0.015625)], **labels)
+        record("preauthorize", [("total", 0.25)], **labels)
+        record("preauthorize", [("total", 60)], **labels)
+
+        lines = self.get_lines()
+
+        self.assertIn(f"# TYPE {METRIC_NAME} histogram", lines)
+        self.assertIn(f'{METRIC_NAME}_bucket{{{SERIES},le="0.01"}} 0', lines)
+        self.assertIn(f'{METRIC_NAME}_bucket{{{SERIES},le="0.025"}} 1', lines)
+        self.assertIn(f'{METRIC_NAME}_bucket{{{SERIES},le="0.5"}} 2', lines)
+        self.assertIn(f'{METRIC_NAME}_bucket{{{SERIES},le="30"}} 2', lines)
+        self.assertIn(f'{METRIC_NAME}_bucket{{{SERIES},le="+Inf"}} 3', lines)
+        self.assertIn(f"{METRIC_NAME}_count{{{SERIES}}} 3", lines)
+        self.assertIn(f"{METRIC_NAME}_sum{{{SERIES}}} 60.265625", lines)
+
+    def test_traced_calls_record_their_phases(self):
+        @traced("preauthorize")
+        def preauthorize():
+            set_labels(credential="WaafiPay", service="API_PREAUTHORIZE", response_code=None)
+            with span("http"):
+                pass
+            # recorded as an operation of its own
+            commit()
+
+        @traced("preauthorize_commit")
+        def commit():
+            with span("http"):
+                pass
+
+        preauthorize()
+
+        counts = [line for line in self.get_lines() if line.startswith(f"{METRIC_NAME}_count")]
+        self.assertEqual(
+            counts,
+            [
+                f'{METRIC_NAME}_count{{operation="preauthorize",phase="http",credential="WaafiPay",service="API_PREAUTHORIZE",response_code=""}} 1',
+                f'{METRIC_NAME}_count{{operation="preauthorize",phase="total",credential="WaafiPay",service="API_PREAUTHORIZE",response_code=""}} 1',
+                f'{METRIC_NAME}_count{{operation="preauthorize_commit",phase="http",credential="",service="",response_code=""}} 1',
+                f'{METRIC_NAME}_count{{operation="preauthorize_commit",phase="total",credential="",service="",response_code=""}} 1',
+            ],
+        )
+        self.assertIsNone(metrics.current_trace())
+
+    def test_spans_outside_a_trace_are_ignored(self):
+        with span("http"):
+            set_labels(credential="WaafiPay")
+
+        self.assertFalse([line for line in self.get_lines() if not line.startswith("#")])
+
+    def test_phases_are_recorded_when_the_call_fails(self):
+        with self.assertRaises(frappe.ValidationError):
+            with trace("preauthorize"):
+                frappe.throw("Payment not approved")
+
+        self.assertIn(
+            f'{METRIC_NAME}_count{{operation="preauthorize",phase="total",credential="",service="",response_code=""}} 1',
+            self.get_lines(),
+        )
+
+    def test_redis_errors_never_fail_a_payment(self):
+        with patch.object(frappe.cache(), "pipeline", side_effect=ConnectionError("Redis is down")):
+            record("preauthorize", [("total", 0.1)])
+
+        with patch.object(frappe.cache(), "hincrbyfloat", side_effect=ConnectionError("Redis is down")):
+            increment("waafipay_callbacks_total")
+
+    def test_counters(self):
+        increment("waafipay_callbacks_total", status="Success")
+        increment("waafipay_callbacks_total", 2, status="Success")
+        increment("waafipay_callbacks_total", status='say "hi"')
+
+        lines = self.get_lines()
+
+        self.assertIn("# TYPE waafipay_callbacks_total counter", lines)
+        self.assertIn('waafipay_callbacks_total{status="Success"} 3', lines)
+        self.assertIn('waafipay_callbacks_total{status="say \\"hi\\""} 1', lines)
+
+    def test_scrape_endpoint(self):
+        record("preauthorize", [("total", 0.1)])
+
+        response = metrics.get_metrics()
+        self.assertEqual(response.content_type, metrics.CONTENT_TYPE)
+        self.assertIn(f"{METRIC_NAME}_count", response.get_data(as_text=True))
+
+        frappe.set_user("Guest")
+        self.addCleanup(frappe.set_user, "Administrator")
+        self.assertRaises(frappe.PermissionError, metrics.get_metrics)
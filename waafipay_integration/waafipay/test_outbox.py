@@ -0,0 +1,156 @@
+import asyncio
+from unittest.mock import patch
+
+import frappe
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from frappe.model.document import Document
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import add_to_date, now_datetime
+
+from waafipay_integration.waafipay import outbox
+from waafipay_integration.waafipay.test_async_client import MockGateway
+from waafipay_integration.waafipay.test_credentials import make_credentials_record
+
+LINK = "https://pay.waafipay.test/hpp/1"
+
+
+class TestOutbox(FrappeTestCase):
+    def setUp(self):
+        self.credentials = make_credentials_record()
+
+        # dispatching commits; keep everything inside the test transaction
+        for target, attribute, kwargs in (
+            (frappe.db, "commit", {}),
+            (outbox, "get_credentials", {"return_value": self.credentials}),
+            (outbox, "make_log", {"return_value": frappe._dict(name="LOG-TEST")}),
+            (outbox, "update_log", {}),
+            (outbox, "notify", {}),
+        ):
+            patcher = patch.object(target, attribute, **kwargs)
+            self.addCleanup(patcher.stop)
+            setattr(self, attribute, patcher.start())
+
+    def make_entry(self, status="Pending", payment_request=None):
+        return frappe.get_doc({
+            "doctype": outbox.DOCTYPE,
+            "payment_request": payment_request or f"ACC-PRQ-TEST-{frappe.generate_hash(length=10)}",
+            "payment_gateway_account": "_Test Gateway - USD",
+            "status": status,
+        }).insert(ignore_permissions=True, ignore_links=True)
+
+    def get_entry(self, entry):
+        return frappe.get_doc(outbox.DOCTYPE, entry.name)
+
+    def make_pr(self, entry):
+        return frappe._dict(name=entry.payment_request, docstatus=1, grand_total=5, currency="USD", reference_name="ACC-SINV-TEST")
+
+    def test_intent_is_dispatched_after_commit(self):
+        doc = frappe._dict(
+            name=f"ACC-PRQ-TEST-{frappe.generate_hash(length=10)}",
+            create_payment_request=1,
+            payment_gateway_account="_Test Gateway - USD",
+            flags=frappe._dict(),
+        )
+
+        # the Payment Request is only a stand-in
+        with patch.object(frappe, "enqueue") as enqueue, patch.object(Document, "_validate_links"):
+            outbox.enqueue_payment_link(doc)
+
+            doc.flags.only_get_payment_link = True
+            outbox.enqueue_payment_link(doc)
+
+        enqueue.assert_called_once()
+        self.assertTrue(enqueue.call_args.kwargs["enqueue_after_commit"])
+        self.assertTrue(enqueue.call_args.kwargs["deduplicate"])
+        self.assertEqual(
+            frappe.get_all(outbox.DOCTYPE, filters={"payment_request": doc.name}, pluck="status"), ["Pending"]
+        )
+
+    def test_link_is_stored(self):
+        entry = self.make_entry("Processing")
+        pr = self.make_pr(entry)
+
+        with patch.object(frappe.db, "set_value", wraps=frappe.db.set_value) as set_value:
+            outbox.apply_link_response(entry, pr, {}, {"responseCode": "2001", "params": {"hppUrl": LINK}})
+
+        set_value.assert_any_call("Payment Request", pr.name, "waafipay_payment_link", LINK, update_modified=False)
+        entry = self.get_entry(entry)
+        self.assertEqual((entry.status, entry.attempts, entry.payment_link), ("Processed", 1, LINK))
+        self.notify.assert_called_once_with(pr.name, payment_link=LINK)
+
+    def test_failures_back_off_until_dead_letter(self):
+        entry = self.make_entry("Processing")
+        pr = self.make_pr(entry)
+
+        for attempt, minutes in ((1, 1), (2, 2)):
+            start = now_datetime()
+            outbox.apply_link_response(entry, pr, {}, {"responseCode": "5310", "responseMsg": "Invalid hppKey"}, max_attempts=3)
+            entry = self.get_entry(entry)
+            self.assertEqual((entry.status, entry.attempts), ("Failed", attempt))
+            self.assertGreaterEqual(entry.next_attempt_on, add_to_date(start, minutes=minutes, seconds=-1))
+            self.notify.assert_not_called()
+
+        outbox.apply_link_response(entry, pr, {}, TimeoutError(), max_attempts=3)
+        entry = self.get_entry(entry)
+        self.assertEqual((entry.status, entry.attempts, entry.last_error), ("Dead Letter", 3, "TimeoutError"))
+        self.notify.assert_called_once_with(pr.name, error="TimeoutError")
+
+    def test_unsubmitted_requests_are_not_sent(self):
+        entry = self.make_entry("Processing")
+
+        with patch.object(outbox, "request_links") as request_links:
+            outbox.dispatch_batch([entry])
+
+        request_links.assert_not_called()
+        self.assertEqual(self.get_entry(entry).status, "Dead Letter")
+
+    def test_links_are_requested_concurrently(self):
+        gateway = MockGateway(
+            respond=lambda payload, attempt: (
+                400
+                if payload["serviceParams"]["transactionInfo"]["referenceId"] == "ACC-PRQ-TEST-1"
+                else {"responseCode": "2001", "params": {"hppUrl": LINK}}
+            ),
+            delay=0.05,
+        )
+        items = [(frappe._dict(name=f"OUTBOX-{i}"), self.make_pr(frappe._dict(payment_request=f"ACC-PRQ-TEST-{i}"))) for i in range(4)]
+
+        async def request_links():
+            app = web.Application()
+            app.router.add_post("/asm", gateway.handle)
+            async with TestServer(app) as server:
+                credentials = make_credentials_record(api_base_url=str(server.make_url("")))
+                return await outbox.request_links([(credentials, items)], 2)
+
+        results = asyncio.run(request_links())
+
+        self.assertEqual([entry.name for entry, pr, payload, response in results], [f"OUTBOX-{i}" for i in range(4)])
+        self.assertEqual(gateway.max_in_flight, 2)
+        self.assertEqual(results[0][3]["params"]["hppUrl"], LINK)
+        # the failing row keeps its own error
+        self.assertIsInstance(results[1][3], Exception)
+        self.assertEqual(results[1][2]["serviceParams"]["transactionInfo"]["referenceId"], "ACC-PRQ-TEST-1")
+
+    def test_claim_batch_takes_due_entries(self):
+        pending = self.make_entry()
+        later = self.make_entry("Failed")
+        frappe.db.set_value(outbox.DOCTYPE, later.name, "next_attempt_on", add_to_date(now_datetime(), hours=1))
+
+        names = [entry.name for entry in outbox.claim_batch(1000)]
+
+        self.assertIn(pending.name, names)
+        self.assertNotIn(later.name, names)
+        self.assertEqual(self.get_entry(pending).status, "Processing")
+
+    def test_stale_processing_entries_are_recovered(self):
+        stale = self.make_entry("Processing")
+        frappe.db.set_value(outbox.DOCTYPE, stale.name, "modified", add_to_date(now_datetime(), hours=-1), update_modified=False)
+        recent = self.make_entry("Processing")
+
+        with patch.object(outbox, "enqueue_dispatcher") as enqueue_dispatcher:
+            outbox.run()
+
+        self.assertEqual(self.get_entry(stale).status, "Pending")
+        self.assertEqual(self.get_entry(recent).status, "Processing")
+        enqueue_dispatcher.assert_called_once()
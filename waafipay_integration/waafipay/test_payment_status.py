@@ -0,0 +1,67 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import payment_status
+from waafipay_integration.waafipay.payment_status import (
+    REALTIME_EVENT,
+    STATUS_KEY,
+    get_payment_queue,
+    get_payment_status,
+    set_payment_status,
+)
+
+
+class TestPaymentStatus(FrappeTestCase):
+    def setUp(self):
+        self.payment_request = f"ACC-PRQ-TEST-{frappe.generate_hash(length=10)}"
+
+        for target, attribute, kwargs in (
+            (frappe, "publish_realtime", {}),
+            (frappe.db, "get_value", {"return_value": ("POS Invoice", "ACC-PSINV-TEST")}),
+        ):
+            patcher = patch.object(target, attribute, **kwargs)
+            self.addCleanup(patcher.stop)
+            setattr(self, attribute, patcher.start())
+
+    def tearDown(self):
+        frappe.cache().delete_value(f"{STATUS_KEY}:{self.payment_request}")
+
+    def test_transitions_are_pushed_to_the_invoice_room(self):
+        set_payment_status(self.payment_request, "Preauthorized", transaction_id="T-1")
+        state = set_payment_status(self.payment_request, "Paid", after_commit=True)
+
+        self.assertEqual(state["status"], "Paid")
+        # details of earlier transitions are kept
+        self.assertEqual(state["transaction_id"], "T-1")
+        self.assertEqual(get_payment_status(self.payment_request), state)
+
+        self.assertEqual(self.publish_realtime.call_count, 2)
+        args, kwargs = self.publish_realtime.call_args
+        self.assertEqual(args, (REALTIME_EVENT, state))
+        self.assertEqual(
+            kwargs, {"doctype": "POS Invoice", "docname": "ACC-PSINV-TEST", "after_commit": True}
+        )
+        self.assertFalse(self.publish_realtime.call_args_list[0].kwargs["after_commit"])
+
+    def test_invoice_is_looked_up_once(self):
+        set_payment_status(self.payment_request, "Queued")
+        set_payment_status(self.payment_request, "Processing")
+
+        self.get_value.assert_called_once()
+
+    def test_unknown_payment_request_is_not_published(self):
+        self.get_value.return_value = None
+
+        state = set_payment_status(self.payment_request, "Failed", message="Payment not approved")
+
+        self.assertEqual(state["message"], "Payment not approved")
+        self.publish_realtime.assert_not_called()
+
+    def test_payment_queue(self):
+        with patch.object(payment_status, "get_queues_timeout", return_value={"default": 300, "waafipay": 300}):
+            self.assertEqual(get_payment_queue(), "waafipay")
+
+        with patch.object(payment_status, "get_queues_timeout", return_value={"default": 300}):
+            self.assertEqual(get_payment_queue(), "default")
@@ -0,0 +1,98 @@
+import asyncio
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import rate_limit
+from waafipay_integration.waafipay.rate_limit import BACKGROUND, INTERACTIVE, RateLimitedError, RateLimiter
+from waafipay_integration.waafipay.test_credentials import make_credentials_record
+
+
+class TestRateLimit(FrappeTestCase):
+    def setUp(self):
+        self.merchant_uid = f"TEST-{frappe.generate_hash(length=10)}"
+
+        patcher = patch.object(rate_limit, "increment")
+        self.increment = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        frappe.cache().delete(RateLimiter(self.merchant_uid, 1).key)
+
+    def make_limiter(self, rate=1, burst=4, **kwargs):
+        return RateLimiter(self.merchant_uid, rate, burst=burst, **kwargs)
+
+    def get_metrics(self):
+        return [call.args[0] for call in self.increment.call_args_list]
+
+    def test_bucket_allows_a_burst(self):
+        limiter = self.make_limiter()
+
+        self.assertEqual([limiter.try_acquire() for _ in range(4)], [0] * 4)
+        # one token a second
+        self.assertGreater(limiter.try_acquire(), 0.5)
+
+    def test_background_leaves_the_reserve_to_interactive_calls(self):
+        background = self.make_limiter(priority=BACKGROUND, reserve=50)
+        interactive = self.make_limiter(priority=INTERACTIVE, reserve=50)
+
+        self.assertEqual([background.try_acquire() for _ in range(2)], [0, 0])
+        self.assertGreater(background.try_acquire(), 0)
+
+        self.assertEqual([interactive.try_acquire() for _ in range(2)], [0, 0])
+        self.assertGreater(interactive.try_acquire(), 0)
+
+    def test_merchant_bucket_is_shared(self):
+        self.make_limiter(burst=1).try_acquire()
+
+        self.assertGreater(self.make_limiter(burst=1).try_acquire(), 0)
+        self.assertEqual(RateLimiter(f"{self.merchant_uid}-OTHER", 1, burst=1).try_acquire(), 0)
+        frappe.cache().delete(RateLimiter(f"{self.merchant_uid}-OTHER", 1).key)
+
+    def test_callers_wait_for_a_token(self):
+        limiter = self.make_limiter(rate=100, burst=1, max_wait=1)
+
+        limiter.acquire()
+        self.assertEqual(self.get_metrics(), [])
+
+        limiter.acquire()
+        self.assertEqual(
+            self.get_metrics(), ["waafipay_rate_limit_throttled_total", "waafipay_rate_limit_wait_seconds_total"]
+        )
+        self.assertEqual(self.increment.call_args.kwargs, {"merchant": self.merchant_uid, "lane": INTERACTIVE})
+
+    def test_wait_is_bounded(self):
+        limiter = self.make_limiter(burst=1, max_wait=0.1)
+        limiter.acquire()
+
+        self.assertRaises(RateLimitedError, limiter.acquire)
+        self.assertEqual(self.get_metrics(), ["waafipay_rate_limit_rejected_total"])
+
+    def test_async_callers_wait_for_a_token(self):
+        limiter = self.make_limiter(rate=100, burst=1, max_wait=1)
+
+        async def acquire_twice():
+            await limiter.acquire_async()
+            await limiter.acquire_async()
+
+        asyncio.run(acquire_twice())
+        self.assertIn("waafipay_rate_limit_throttled_total", self.get_metrics())
+
+    def test_for_credentials(self):
+        self.assertIsNone(RateLimiter.for_credentials(make_credentials_record()))
+
+        credentials = make_credentials_record(
+            merchant_uid=self.merchant_uid,
+            rate_limit_per_second=5,
+            rate_limit_burst=0,
+            rate_limit_reserve=20,
+            rate_limit_max_wait=3,
+            rate_limit_background_max_wait=60,
+        )
+
+        interactive = RateLimiter.for_credentials(credentials)
+        self.assertEqual((interactive.burst, interactive.reserve, interactive.max_wait), (5, 0, 3))
+
+        background = RateLimiter.for_credentials(credentials, BACKGROUND)
+        self.assertEqual((background.reserve, background.max_wait), (1, 60))
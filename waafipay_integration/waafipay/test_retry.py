@@ -0,0 +1,126 @@
+from unittest.mock import MagicMock, patch
+
+import frappe
+import requests
+from frappe.tests.utils import FrappeTestCase
+from urllib3.exceptions import MaxRetryError, NameResolutionError, NewConnectionError, ProtocolError
+
+from waafipay_integration.waafipay import waafipay_client
+from waafipay_integration.waafipay.retry import CUSTOMER_WAIT_TIMEOUT, RetryPolicy, was_sent
+from waafipay_integration.waafipay.test_credentials import make_credentials_record
+from waafipay_integration.waafipay.waafipay_client import WaafiPayClient
+
+
+def connect_error(reason):
+    """A `requests.ConnectionError` as raised by the adapter when urllib3 gives up on `reason`."""
+    return requests.ConnectionError(MaxRetryError(None, "/asm", reason))
+
+
+def make_response(status_code, data=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = frappe.as_json(data or {}).encode()
+    return response
+
+
+REFUSED = connect_error(NewConnectionError(None, "Failed to establish a new connection: [Errno 111] Connection refused"))
+RESET = requests.ConnectionError(ProtocolError("Connection aborted.", ConnectionResetError(104, "Connection reset by peer")))
+
+
+class TestRetry(FrappeTestCase):
+    def test_retry_policy_of_customer_wait_services(self):
+        credentials = frappe._dict(connect_timeout=5, read_timeout=30, retry_deadline=20, service_policies=[])
+
+        policy = RetryPolicy.for_service(credentials, "API_PREAUTHORIZE")
+        self.assertEqual(policy.read_timeout, CUSTOMER_WAIT_TIMEOUT)
+        self.assertEqual(policy.deadline, 5 + CUSTOMER_WAIT_TIMEOUT)
+        self.assertFalse(policy.idempotent)
+        # only retried when the gateway cannot have processed the request
+        self.assertTrue(policy.is_retryable(sent=False))
+        self.assertTrue(policy.is_retryable(429))
+        self.assertFalse(policy.is_retryable(502))
+        self.assertFalse(policy.is_retryable())
+
+        policy = RetryPolicy.for_service(credentials, "API_PREAUTHORIZE_COMMIT")
+        self.assertEqual((policy.read_timeout, policy.deadline), (30, 20))
+        self.assertTrue(policy.is_retryable(502))
+        self.assertTrue(policy.is_retryable())
+
+    def test_retry_policy_row_overrides(self):
+        credentials = frappe._dict(
+            connect_timeout=5,
+            read_timeout=30,
+            retry_deadline=20,
+            service_policies=[{"service_name": "API_PURCHASE", "read_timeout": 90, "deadline": 100, "max_attempts": 1}],
+        )
+
+        policy = RetryPolicy.for_service(credentials, "API_PURCHASE")
+        self.assertEqual((policy.read_timeout, policy.deadline, policy.max_attempts), (90, 100, 1))
+
+    def test_connect_phase_errors_are_not_sent(self):
+        self.assertFalse(was_sent(requests.ConnectTimeout()))
+        self.assertFalse(was_sent(REFUSED))
+        self.assertFalse(was_sent(connect_error(NameResolutionError("waafipay.test", None, "Name or service not known"))))
+        self.assertFalse(was_sent(requests.exceptions.SSLError()))
+
+        self.assertTrue(was_sent(RESET))
+        self.assertTrue(was_sent(requests.ReadTimeout()))
+
+
+class TestClientRetries(FrappeTestCase):
+    def setUp(self):
+        self.client = WaafiPayClient(make_credentials_record())
+        self.session = MagicMock()
+
+        for target, attribute, kwargs in (
+            (waafipay_client, "get_credentials_session", {"return_value": self.session}),
+            (waafipay_client, "update_log", {}),
+        ):
+            patcher = patch.object(target, attribute, **kwargs)
+            self.addCleanup(patcher.stop)
+            setattr(self, attribute, patcher.start())
+
+    def get_payloads(self):
+        return [call.kwargs["json"] for call in self.session.post.call_args_list]
+
+    def test_transient_errors_are_retried_with_the_same_payload(self):
+        self.session.post.side_effect = [make_response(502), RESET, make_response(200, {"responseCode": "2001"})]
+        log = frappe._dict()
+
+        self.assertEqual(self.client.send_request(self.client.build_commit_payload("T-1"), log=log), {"responseCode": "2001"})
+
+        payloads = self.get_payloads()
+        self.assertEqual(len(payloads), 3)
+        self.assertEqual({payload["requestId"] for payload in payloads}, {payloads[0]["requestId"]})
+
+        fields = self.update_log.call_args.kwargs
+        self.assertEqual(fields["attempts"], 3)
+        self.assertEqual(fields["retry_errors"].splitlines()[0], "Attempt 1: HTTP 502")
+
+    def test_refused_connections_are_retried_for_customer_wait_services(self):
+        self.session.post.side_effect = [REFUSED, make_response(200, {"responseCode": "2001"})]
+
+        self.client.send_request(self.client.build_preauthorize_payload("252610000001", 5, "USD"))
+
+        self.assertEqual(len(self.get_payloads()), 2)
+
+    def test_customer_is_never_prompted_twice(self):
+        for error in (RESET, requests.ReadTimeout()):
+            self.session.post.reset_mock()
+            self.session.post.side_effect = [error, make_response(200, {"responseCode": "2001"})]
+
+            self.assertRaises(type(error), self.client.send_request, self.client.build_purchase_payload("252610000001", 5, "USD"))
+            self.assertEqual(len(self.get_payloads()), 1)
+
+        self.session.post.reset_mock()
+        self.session.post.side_effect = [make_response(502)]
+        self.assertRaises(requests.HTTPError, self.client.send_request, self.client.build_purchase_payload("252610000001", 5, "USD"))
+        self.assertEqual(len(self.get_payloads()), 1)
+
+    def test_attempts_are_capped(self):
+        self.session.post.side_effect = [make_response(503)] * 5
+
+        response = self.client.post(self.client.build_commit_payload("T-1"))
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.get_payloads()), 3)
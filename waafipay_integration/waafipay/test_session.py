@@ -0,0 +1,70 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import session
+
+
+class TestSession(FrappeTestCase):
+    def setUp(self):
+        for registry in (session._sessions, session._stats):
+            patcher = patch.dict(registry)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        session._sessions.clear()
+        session._stats.update(hits=0, misses=0, rebuilds=0)
+
+    def test_session_is_reused(self):
+        first = session.get_session("WaafiPay", "http://waafipay.test", version="1")
+        second = session.get_session("WaafiPay", "http://waafipay.test", version="1")
+
+        self.assertIs(first, second)
+        self.assertEqual(session._stats, {"hits": 1, "misses": 1, "rebuilds": 0})
+
+    def test_pool_size(self):
+        pooled = session.get_session("WaafiPay", "http://waafipay.test", pool_size=25)
+
+        adapter = pooled.get_adapter("https://api.waafipay.com/asm")
+        self.assertEqual(adapter._pool_maxsize, 25)
+        self.assertEqual(pooled.headers["Connection"], "keep-alive")
+
+    def test_edited_credentials_rebuild_session(self):
+        old = session.get_session("WaafiPay", "http://waafipay.test", version="1")
+
+        with patch.object(old, "close") as close:
+            new = session.get_session("WaafiPay", "http://waafipay.test", version="2")
+
+        self.assertIsNot(old, new)
+        self.assertEqual(session._stats["rebuilds"], 1)
+        # another thread may still be sending through the old one
+        close.assert_not_called()
+
+    def test_sessions_are_keyed_by_site(self):
+        this_site = session.get_session("WaafiPay", "http://waafipay.test")
+
+        with patch.object(frappe.local, "site", "other.test"):
+            other_site = session.get_session("WaafiPay", "http://waafipay.test")
+            self.assertEqual(len(session.get_session_stats()["sessions"]), 1)
+
+        self.assertIsNot(this_site, other_site)
+
+        session.clear_sessions("WaafiPay")
+        self.assertEqual(list(session._sessions), [("other.test", "WaafiPay", "http://waafipay.test")])
+
+    def test_clear_sessions_of_one_credentials(self):
+        session.get_session("WaafiPay", "http://waafipay.test")
+        session.get_session("WaafiPay Sandbox", "http://waafipay.test")
+
+        session.clear_sessions("WaafiPay Sandbox")
+
+        self.assertEqual([name for site, name, base_url in session._sessions], ["WaafiPay"])
+
+    def test_base_url(self):
+        credentials = frappe._dict(api_base_url="https://sandbox.waafipay.net/")
+        self.assertEqual(session.get_base_url(credentials), "https://sandbox.waafipay.net")
+        self.assertEqual(session.get_base_url(frappe._dict()), session.DEFAULT_BASE_URL)
+
+        with patch.dict(frappe.conf, {"waafipay_api_base_url": "http://127.0.0.1:8765"}):
+            self.assertEqual(session.get_base_url(credentials), "http://127.0.0.1:8765")
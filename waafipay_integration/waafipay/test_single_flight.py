@@ -0,0 +1,97 @@
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import single_flight as single_flight_module
+from waafipay_integration.waafipay.single_flight import LOCK_KEY, RESULT_KEY, get_payment_flight_key, single_flight
+
+
+class TestSingleFlight(FrappeTestCase):
+    def setUp(self):
+        self.key = f"TEST-{frappe.generate_hash(length=10)}"
+        self.cache = frappe.cache()
+        self.lock_key = self.cache.make_key(LOCK_KEY.format(key=self.key))
+        self.result_key = self.cache.make_key(RESULT_KEY.format(key=self.key))
+        self.fn = MagicMock(return_value={"name": "ACC-PRQ-TEST"})
+
+        patcher = patch.object(single_flight_module, "POLL_INTERVAL", 0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        frappe.db.after_commit.reset()
+        frappe.db.after_rollback.reset()
+        self.cache.delete(self.lock_key, self.result_key)
+
+    def test_result_is_published_after_commit(self):
+        self.assertEqual(single_flight(self.key, self.fn), {"name": "ACC-PRQ-TEST"})
+        # nobody may see the Payment Request before it is committed
+        self.assertIsNone(self.cache.get(self.result_key))
+        self.assertTrue(self.cache.exists(self.lock_key))
+
+        frappe.db.after_commit.run()
+
+        self.assertFalse(self.cache.exists(self.lock_key))
+        self.assertEqual(single_flight(self.key, self.fn), {"name": "ACC-PRQ-TEST"})
+        self.fn.assert_called_once()
+
+    def test_rollback_only_releases_the_lock(self):
+        single_flight(self.key, self.fn)
+        frappe.db.after_commit.reset()
+
+        frappe.db.after_rollback.run()
+
+        self.assertFalse(self.cache.exists(self.lock_key))
+        single_flight(self.key, self.fn)
+        self.assertEqual(self.fn.call_count, 2)
+
+    def test_errors_are_passed_to_waiting_callers(self):
+        self.fn.side_effect = frappe.ValidationError("Payment not approved")
+
+        self.assertRaises(frappe.ValidationError, single_flight, self.key, self.fn)
+        with self.assertRaises(frappe.ValidationError) as error:
+            single_flight(self.key, self.fn)
+
+        self.assertEqual(str(error.exception), "Payment not approved")
+        self.fn.assert_called_once()
+
+    def test_callers_wait_for_the_running_call(self):
+        self.cache.set(self.lock_key, "other worker")
+        timer = threading.Timer(
+            0.1, self.cache.set, args=(self.result_key, frappe.as_json({"result": {"name": "ACC-PRQ-OTHER"}}))
+        )
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        self.assertEqual(single_flight(self.key, self.fn), {"name": "ACC-PRQ-OTHER"})
+        self.fn.assert_not_called()
+
+    def test_wait_is_bounded(self):
+        self.cache.set(self.lock_key, "other worker")
+
+        start = time.monotonic()
+        self.assertRaises(frappe.ValidationError, single_flight, self.key, self.fn, max_wait=0.2)
+
+        self.assertLess(time.monotonic() - start, 1)
+        self.fn.assert_not_called()
+
+    def test_dead_lock_holder_is_not_waited_for(self):
+        start = time.monotonic()
+        self.assertRaises(
+            frappe.ValidationError, single_flight_module._wait_for_result, self.cache, self.lock_key, self.result_key, 5
+        )
+
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_payment_flight_key(self):
+        self.assertEqual(
+            get_payment_flight_key("ACC-SINV-TEST", 5, "252610000001"),
+            get_payment_flight_key("ACC-SINV-TEST", "5.00", "252610000001"),
+        )
+        self.assertNotEqual(
+            get_payment_flight_key("ACC-SINV-TEST", 5, "252610000001"),
+            get_payment_flight_key("ACC-SINV-TEST", 5, "252610000002"),
+        )
@@ -0,0 +1,79 @@
+import json
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import split_tender
+
+
+def fake_send_all(responses):
+    """Stand-in for `split_tender.send_all`: `responses` maps (payload builder, phone number) to a response or error."""
+
+    def send_all(lines, build_payload):
+        for line in list(lines):
+            response = responses.get((build_payload.__name__, line.phone_number), {"responseCode": "2001"})
+            if isinstance(response, str):
+                yield line, None, response
+            else:
+                yield line, response, None
+
+    return send_all
+
+
+class TestSplitTender(FrappeTestCase):
+    def setUp(self):
+        credentials = frappe._dict(name="WaafiPay", currencies=["USD"])
+        for target, kwargs in (
+            ("get_credentials", {"return_value": credentials}),
+            ("set_payment_status", {}),
+        ):
+            patcher = patch.object(split_tender, target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = patch.object(frappe, "log_error")
+        self.log_error = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.lines = [
+            {"payment_request": None, "payment_gateway_account": "WaafiPay", "phone_number": phone, "amount": 5, "currency": "USD"}
+            for phone in ("252610000001", "252610000002")
+        ]
+
+    def process(self, responses=None):
+        preauthorized = {
+            ("build_preauthorize_payload", line["phone_number"]): {
+                "responseCode": "2001",
+                "params": {"state": "APPROVED", "transactionId": f"T-{line['phone_number']}"},
+            }
+            for line in self.lines
+        }
+        with patch.object(split_tender, "send_all", fake_send_all({**preauthorized, **(responses or {})})):
+            return split_tender.process_split_tender(self.lines, "ACC-SINV-TEST")
+
+    def test_all_lines_committed(self):
+        status, lines = self.process()
+
+        self.assertEqual(status, "Paid")
+        self.assertEqual([line.status for line in lines], ["Committed", "Committed"])
+        self.log_error.assert_not_called()
+
+    def test_preauthorize_failure_cancels_the_others(self):
+        status, lines = self.process({("build_preauthorize_payload", "252610000002"): "Connection refused"})
+
+        self.assertEqual(status, "Failed")
+        self.assertEqual([line.status for line in lines], ["Cancelled", "Failed"])
+        self.log_error.assert_not_called()
+
+    def test_commit_failure_reports_committed_lines(self):
+        status, lines = self.process(
+            {("build_commit_payload", "252610000002"): {"responseCode": "5206", "responseMsg": "Commit failed"}}
+        )
+
+        self.assertEqual(status, "Failed")
+        self.assertEqual([line.status for line in lines], ["Committed", "Failed"])
+
+        details, title = self.log_error.call_args.args
+        self.assertEqual(title, "WaafiPay Split Tender Partially Committed")
+        self.assertEqual([line["phone_number"] for line in json.loads(details)["committed"]], ["252610000001"])
@@ -0,0 +1,73 @@
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import sweeper
+from waafipay_integration.waafipay_integration.doctype.waafipay_log.test_waafipay_log import get_status, make_log
+
+
+class TestSweeper(FrappeTestCase):
+    def setUp(self):
+        self.pr = frappe._dict(name=f"PR-TEST-{frappe.generate_hash(length=10)}")
+        self.stats = frappe._dict(checked=0, settled=0, failed=0, pending=0, errors=0)
+
+        patcher = patch.object(sweeper, "set_payment_status")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def apply(self, response, logs=()):
+        sweeper.apply_transaction_info(self.pr, response, [log.name for log in logs], self.stats)
+
+    def test_failed_transaction_fails_payment_request(self):
+        log = make_log(self.pr.name, status="Initiated")
+
+        with patch.object(frappe.db, "set_value") as set_value:
+            self.apply({"responseCode": "2001", "responseMsg": "Expired", "params": {"state": "EXPIRED"}}, [log])
+
+        set_value.assert_called_once_with("Payment Request", self.pr.name, "status", "Failed")
+        self.assertEqual(get_status(log), "Failed")
+        self.assertEqual((self.stats.checked, self.stats.failed), (1, 1))
+
+    def test_approved_transaction_settles_like_a_callback(self):
+        log = make_log(self.pr.name, status="Initiated")
+        response = {"responseCode": "2001", "params": {"state": "APPROVED", "transactionId": "T-1", "txAmount": "5"}}
+
+        with patch.object(sweeper, "handle_payment_received", return_value={"status": "Success"}) as handle:
+            self.apply(response, [log])
+
+        callback = handle.call_args.args[0]
+        self.assertEqual(callback["params"]["referenceId"], self.pr.name)
+        self.assertEqual(callback["params"]["transactionId"], "T-1")
+        self.assertEqual(get_status(log), "Success")
+        self.assertEqual(self.stats.settled, 1)
+
+    def test_unknown_outcome_is_left_for_the_next_run(self):
+        log = make_log(self.pr.name, status="Initiated")
+
+        self.apply({"responseCode": "5310", "responseMsg": "Transaction not found"}, [log])
+        self.apply({"responseCode": "2001", "params": {"state": "INITIATED"}}, [log])
+        self.apply(TimeoutError("timed out"), [log])
+
+        self.assertEqual(get_status(log), "Initiated")
+        self.assertEqual((self.stats.checked, self.stats.pending, self.stats.errors), (3, 2, 1))
+
+    def test_paid_payment_request_only_closes_logs(self):
+        log = make_log(self.pr.name, status="Initiated")
+        payment_requests = [frappe._dict(name=self.pr.name, status="Paid", payment_gateway_account="_Test Gateway - USD")]
+
+        with (
+            patch.object(frappe, "get_all", return_value=payment_requests),
+            patch.object(sweeper, "check_transactions", return_value=[]) as check_transactions,
+            patch.object(frappe.db, "commit"),
+        ):
+            sweeper.sweep_batch({self.pr.name: [log.name]}, 10, self.stats)
+
+        check_transactions.assert_called_once_with([], 10)
+        self.assertEqual(get_status(log), "Success")
+
+    def test_approved_response(self):
+        self.assertTrue(sweeper.is_approved({"responseCode": "2001", "params": {"state": "RCS_SUCCESS"}}))
+        self.assertFalse(sweeper.is_approved({"responseCode": "2001", "params": {"state": "DECLINED"}}))
+        self.assertFalse(sweeper.is_approved({"responseCode": "5310"}))
+        self.assertFalse(sweeper.is_approved(TimeoutError("timed out")))
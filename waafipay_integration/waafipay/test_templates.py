@@ -0,0 +1,86 @@
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay import templates
+from waafipay_integration.waafipay.templates import clear_template_cache, get_compiled_template, render_template
+
+MESSAGE = "<p>Pay {{ doc.grand_total }} for {{ doc.name }}: {{ payment_url }}</p>"
+CONTEXT = {"doc": frappe._dict(name="ACC-SINV-TEST", grand_total=5), "payment_url": "https://pay.test/1"}
+
+
+class TestTemplates(FrappeTestCase):
+    def setUp(self):
+        clear_template_cache()
+        self.addCleanup(clear_template_cache)
+
+        patcher = patch.object(templates, "increment")
+        self.increment = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def render(self, source=MESSAGE, **kwargs):
+        return render_template(source, CONTEXT, **kwargs)
+
+    def test_renders_like_frappe(self):
+        self.assertEqual(self.render(), "<p>Pay 5 for ACC-SINV-TEST: https://pay.test/1</p>")
+        self.assertEqual(self.render(), frappe.render_template(MESSAGE, CONTEXT))
+        self.assertEqual(self.render("Plain text"), "Plain text")
+        self.assertEqual(self.render(None), "")
+
+    def test_sources_are_compiled_once(self):
+        for _ in range(3):
+            self.render()
+
+        self.increment.assert_called_once_with("waafipay_template_compiled_total")
+
+        # an edited message is a new source
+        self.render(MESSAGE.replace("Pay", "Please pay"))
+        self.assertEqual(self.increment.call_count, 2)
+
+    def test_one_off_sources_are_not_cached(self):
+        self.render(cache=False)
+        self.render(cache=False)
+
+        self.increment.assert_not_called()
+        self.assertEqual(len(templates._templates), 0)
+
+    def test_cache_is_bounded(self):
+        with patch.object(templates, "MAX_TEMPLATES", 2):
+            first = get_compiled_template("{{ 1 }}")
+            get_compiled_template("{{ 2 }}")
+            get_compiled_template("{{ 1 }}")
+            get_compiled_template("{{ 3 }}")
+
+            # the least recently used source is dropped
+            self.assertIs(get_compiled_template("{{ 1 }}"), first)
+            self.assertEqual(len(templates._templates), 2)
+            self.assertEqual(self.increment.call_count, 3)
+
+    def test_templates_are_cached_per_language(self):
+        get_compiled_template(MESSAGE)
+        with patch.object(frappe.local, "lang", "so"):
+            get_compiled_template(MESSAGE)
+
+        self.assertEqual(self.increment.call_count, 2)
+
+    def test_unsafe_or_broken_templates_are_refused(self):
+        self.assertRaises(frappe.ValidationError, self.render, "{{ doc.__class__ }}")
+        self.assertRaises(frappe.ValidationError, self.render, "{{ doc.name ")
+
+    def test_gateway_message_change_clears_the_cache(self):
+        self.render()
+        doc = MagicMock()
+
+        doc.has_value_changed.return_value = False
+        templates.on_gateway_account_change(doc, "on_update")
+        self.assertEqual(len(templates._templates), 1)
+
+        doc.has_value_changed.return_value = True
+        templates.on_gateway_account_change(doc, "on_update")
+        self.assertEqual(len(templates._templates), 0)
+
+        self.render()
+        doc.has_value_changed.return_value = False
+        templates.on_gateway_account_change(doc, "on_trash")
+        self.assertEqual(len(templates._templates), 0)
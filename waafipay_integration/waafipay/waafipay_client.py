@@ -1,69 +1,246 @@
 import frappe
 from frappe.utils import flt
-import requests
 import uuid
 import datetime
-import json
+import itertools
+import time
+
+import requests
+
+from waafipay_integration.waafipay.circuit_breaker import CircuitBreaker, CircuitOpenError
+from waafipay_integration.waafipay.credentials import get_credentials_record, get_gateway_credentials
+from waafipay_integration.waafipay.idempotency import (
+    claim_callback,
+    get_idempotency_key,
+    record_callback_outcome,
+    release_callback,
+)
+from waafipay_integration.waafipay.inbox import receive_callback, use_inbox
+from waafipay_integration.waafipay.log_sink import make_log, update_log
+from waafipay_integration.waafipay.metrics import set_labels, span, traced
+from waafipay_integration.waafipay.payment_status import set_payment_status
+from waafipay_integration.waafipay.rate_limit import BACKGROUND, INTERACTIVE, RateLimitedError, RateLimiter
+from waafipay_integration.waafipay.retry import RETRY_EXCEPTIONS, RetryPolicy, was_sent
+from waafipay_integration.waafipay.session import HEADERS, get_base_url, get_credentials_session
 
 
 class WaafiPayClient:
-    def __init__(self, credentials_name):
-        self.settings = frappe.get_doc("WaafiPay Credentials", credentials_name)
+    def __init__(self, credentials, priority=INTERACTIVE):
+        if isinstance(credentials, str):
+            with span("credentials"):
+                credentials = get_credentials_record(credentials)
+
+        if not credentials:
+            frappe.throw("WaafiPay Credentials not found")
+
+        self.settings = credentials
         self.merchant_uid = self.settings.merchant_uid
         self.api_user_id = self.settings.api_user_id
-        self.api_key = self.settings.get_password("api_key")
-        self.base_url = self.settings.api_base_url or "https://api.waafipay.com"
-        self.supported_currencies = [row.currency for row in self.settings.supported_currencies]
+        with span("decrypt"):
+            self.api_key = self.settings.get_password("api_key")
+        self.base_url = get_base_url(self.settings)
+        self.supported_currencies = self.settings.currencies
+        self.breaker = CircuitBreaker.for_credentials(self.settings)
+        # interactive POS calls may use the capacity background work has to leave free
+        self.priority = priority
+        self.rate_limiter = RateLimiter.for_credentials(self.settings, priority)
+
+    def validate_currency(self, currency):
+        if currency not in self.supported_currencies:
+            frappe.throw(f"Currency '{currency}' is not supported by this gateway.")
 
-    def _generate_common_payload(self):
+    def build_payload(self, service_name, service_params):
         return {
+            "schemaVersion": "1.0",
             "requestId": str(uuid.uuid4()),
             "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "channelName": "WEB",
+            "serviceName": service_name,
+            "serviceParams": service_params,
+        }
+
+    def build_preauthorize_payload(self, phone_number, amount, currency, invoice_id=None, reference_id=None, description=None):
+        return self._build_wallet_payload("API_PREAUTHORIZE", phone_number, amount, currency, invoice_id, reference_id, description)
+
+    def build_purchase_payload(self, phone_number, amount, currency, invoice_id=None, reference_id=None, description=None):
+        return self._build_wallet_payload("API_PURCHASE", phone_number, amount, currency, invoice_id, reference_id, description)
+
+    def _build_wallet_payload(self, service_name, phone_number, amount, currency, invoice_id, reference_id, description):
+        return self.build_payload(service_name, {
             "merchantUid": self.merchant_uid,
             "apiUserId": self.api_user_id,
             "apiKey": self.api_key,
-        }
+            "paymentMethod": "MWALLET_ACCOUNT",
+            "payerInfo": {
+                "accountNo": phone_number
+            },
+            "transactionInfo": {
+                "invoiceId": invoice_id or f"INV-{str(uuid.uuid4())[:8]}",
+                "referenceId": reference_id or invoice_id or str(uuid.uuid4()),
+                "amount": f"{flt(amount, 2):.2f}",
+                "currency": currency,
+                "description": description or f"Payment for Sales Invoice {invoice_id}",
+            }
+        })
 
-    def preauthorize_payment(self, phone_number, amount, currency, invoice_id=None):
-        if currency not in self.supported_currencies:
-            frappe.throw(f"Currency '{currency}' is not supported by this gateway.")
+    def build_commit_payload(self, transaction_id, description=None):
+        return self.build_payload("API_PREAUTHORIZE_COMMIT", {
+            "merchantUid": self.merchant_uid,
+            "apiUserId": self.api_user_id,
+            "apiKey": self.api_key,
+            "transactionId": transaction_id,
+            "description": description or f"Order #{transaction_id} committed",
+        })
 
-        payload = {
-            "schemaVersion": "1.0",
-            "requestId": str(uuid.uuid4()),
-            "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-            "channelName": "WEB",
-            "serviceName": "API_PREAUTHORIZE",
-            "serviceParams": {
-                "merchantUid": self.merchant_uid,
-                "apiUserId": self.api_user_id,
-                "apiKey": self.api_key,
-                "paymentMethod": "MWALLET_ACCOUNT",
-                "payerInfo": {
-                    "accountNo": phone_number
-                },
-                "transactionInfo": {
-                    "invoiceId": invoice_id or f"INV-{str(uuid.uuid4())[:8]}",
-                    "referenceId": invoice_id or str(uuid.uuid4()),
-                    "amount": f"{amount:.2f}",
-                    "currency": currency,
-                    "description": f"Payment for Sales Invoice {invoice_id}",
-                }
+    def build_cancel_payload(self, transaction_id, description=None):
+        return self.build_payload("API_PREAUTHORIZE_CANCEL", {
+            "merchantUid": self.merchant_uid,
+            "apiUserId": self.api_user_id,
+            "apiKey": self.api_key,
+            "transactionId": transaction_id,
+            "description": description or f"Order #{transaction_id} cancelled",
+        })
+
+    def build_hpp_payload(self, reference_id, amount, currency, description):
+        return self.build_payload("HPP_PURCHASE", {
+            "merchantUid": self.merchant_uid,
+            "storeId": self.settings.store_id,
+            "hppKey": self._get_hpp_key(),
+            "paymentMethod": "MWALLET_ACCOUNT",
+            "hppSuccessCallbackUrl": self.settings.success_callback_url,
+            "hppFailureCallbackUrl": self.settings.failure_callback_url,
+            "hppRespDataFormat": 1,
+            "transactionInfo": {
+                "referenceId": reference_id,
+                "amount": flt(amount),
+                "currency": currency,
+                "description": description,
             }
-        }
+        })
+
+    def build_transaction_info_payload(self, reference_id):
+        return self.build_payload("HPP_GETTRANINFO", {
+            "merchantUid": self.merchant_uid,
+            "storeId": self.settings.store_id,
+            "hppKey": self._get_hpp_key(),
+            "referenceId": reference_id,
+        })
 
-        if invoice_id:
-            payload["serviceParams"]["transactionInfo"]["invoiceId"] = invoice_id
+    def _get_hpp_key(self):
+        with span("decrypt"):
+            return self.settings.get_password("hpp_key")
 
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-        response = requests.post(f"{self.base_url}/asm", json=payload, headers=headers)
+    def preauthorize_payment(self, phone_number, amount, currency, invoice_id=None):
+        self.validate_currency(currency)
+        return self.send_request(self.build_preauthorize_payload(phone_number, amount, currency, invoice_id))
+
+    def purchase(self, phone_number, amount, currency, invoice_id=None):
+        self.validate_currency(currency)
+        return self.send_request(self.build_purchase_payload(phone_number, amount, currency, invoice_id))
+
+    def commit_authorized_payment(self, transaction_id, description=None):
+        return self.send_request(self.build_commit_payload(transaction_id, description))
+
+    def cancel_authorized_payment(self, transaction_id, description=None):
+        return self.send_request(self.build_cancel_payload(transaction_id, description))
+
+    def get_transaction_info(self, reference_id):
+        return self.send_request(self.build_transaction_info_payload(reference_id))
+
+    def get_retry_policy(self, service_name):
+        return RetryPolicy.for_service(self.settings, service_name)
+
+    def post(self, payload, log=None):
+        """
+        POST `payload` to `/asm`, retrying transient failures within the service's `RetryPolicy`.
+
+        Every attempt sends the very same payload, so `requestId` and `referenceId` stay
+        stable. Services that are not idempotent (preauthorize, purchase) are not sent again
+        once the request may have reached the gateway, so the customer is never prompted twice.
+        """
+        service_name = payload.get("serviceName")
+        set_labels(credential=self.settings.name, service=service_name)
+
+        policy = self.get_retry_policy(service_name)
+        deadline = policy.start()
+        start = time.monotonic()
+        errors = []
+
+        try:
+            for attempt in itertools.count(1):
+                response = error = None
+                try:
+                    response = self._post_once(payload, policy.timeout(deadline))
+                except RETRY_EXCEPTIONS as e:
+                    error = e
+                    if not policy.is_retryable(sent=was_sent(e)):
+                        raise
+                else:
+                    if not policy.is_retryable(response.status_code):
+                        return response
+
+                errors.append(f"Attempt {attempt}: {error or f'HTTP {response.status_code}'}")
+
+                delay = policy.get_delay(attempt)
+                if not policy.should_retry(attempt, deadline, delay):
+                    if error:
+                        raise error
+                    return response
+
+                with span("backoff"):
+                    time.sleep(delay)
+        finally:
+            if log is not None:
+                update_log(
+                    log,
+                    credential=self.settings.name,
+                    latency=(time.monotonic() - start) * 1000,
+                    attempts=attempt,
+                    retry_errors="\n".join(errors) or None,
+                )
+
+    def _post_once(self, payload, timeout):
+        try:
+            probe = self.breaker.before_call()
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+        except CircuitOpenError:
+            set_labels(response_code="circuit_open")
+            raise
+        except RateLimitedError:
+            set_labels(response_code="rate_limited")
+            raise
+
+        session = get_credentials_session(self.settings)
+        start = time.monotonic()
+        try:
+            with span("gateway"):
+                response = session.post(f"{self.base_url}/asm", json=payload, headers=HEADERS, timeout=timeout)
+        except requests.RequestException:
+            set_labels(response_code="error")
+            self.breaker.record_failure(probe)
+            raise
+
+        elapsed = time.monotonic() - start
+        if response.status_code >= 500:
+            self.breaker.record_failure(probe)
+        else:
+            self.breaker.record_success(elapsed, probe, payload.get("serviceName"))
+
+        if not response.ok:
+            set_labels(response_code=f"http_{response.status_code}")
+
+        return response
+
+    def send_request(self, payload, log=None):
+        response = self.post(payload, log=log)
         response.raise_for_status()
-        return response.json()
+        data = response.json()
+        set_labels(response_code=data.get("responseCode"))
+        return data
 
 
+@traced("generate_payment_link")
 def generate_payment_link(doc, method=None):
     if not doc.create_payment_request:
         return
@@ -80,53 +257,26 @@ def generate_payment_link(doc, method=None):
     if getattr(doc, "flags", None) and getattr(doc.flags, "only_get_payment_link", False):
         return
 
-    payload = {
-        "schemaVersion": "1.0",
-        "requestId": str(uuid.uuid4()),
-        "timestamp": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-        "channelName": "WEB",
-        "serviceName": "HPP_PURCHASE",
-        "serviceParams": {
-            "merchantUid": credentials.merchant_uid,
-            "storeId": credentials.store_id,
-            "hppKey": credentials.get_password("hpp_key"),
-            "paymentMethod": "MWALLET_ACCOUNT",
-            "hppSuccessCallbackUrl": credentials.success_callback_url,
-            "hppFailureCallbackUrl": credentials.failure_callback_url,
-            "hppRespDataFormat": 1,
-            "transactionInfo": {
-                "referenceId": doc.name,
-                "amount": flt(doc.grand_total),
-                "currency": doc.currency,
-                "description": f"Payment for {doc.grand_total} {doc.currency} for {doc.reference_name}"
-            }
-        }
-    }
+    client = WaafiPayClient(credentials, priority=BACKGROUND)
+    payload = client.build_hpp_payload(
+        doc.name,
+        doc.grand_total,
+        doc.currency,
+        f"Payment for {doc.grand_total} {doc.currency} for {doc.reference_name}",
+    )
 
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json"
-    }
-
-    response = requests.post(f"{credentials.api_base_url}/asm", json=payload, headers=headers)
-
-    waafipay_log = frappe.new_doc("WaafiPay Log")
-    waafipay_log.update({
-        "status": "Initiated",
-        "request_payload": frappe.as_json(payload),
-        "response_data": frappe.as_json(response.json()),
-    })
-    waafipay_log.flags.ignore_permissions = True
-    waafipay_log.save()
+    waafipay_log = make_log(status="Initiated", reference_id=doc.name, request_payload=payload)
+    response = client.post(payload, log=waafipay_log)
+    update_log(waafipay_log, response_data=response.json())
 
     if response.status_code == 200:
         res_json = response.json()
+        set_labels(response_code=res_json.get("responseCode"))
         if res_json.get("responseCode") == "2001":
             doc.waafipay_payment_link = res_json["params"].get("hppUrl") or res_json["params"].get("directPaymentLink")
             doc.db_update()
 
-            waafipay_log.status = "Success"
-            waafipay_log.db_update()
+            update_log(waafipay_log, status="Success")
         else:
             frappe.log_error(
                 frappe.as_json({
@@ -136,8 +286,7 @@ def generate_payment_link(doc, method=None):
                 "WaafiPay Link Generation Failed"
             )
 
-            waafipay_log.status = "Failed"
-            waafipay_log.db_update()
+            update_log(waafipay_log, status="Failed", error_message=res_json.get("responseMsg"))
     else:
         frappe.log_error(response.text, "WaafiPay Link Generation HTTP Error")
     response.raise_for_status()
@@ -145,15 +294,8 @@ def generate_payment_link(doc, method=None):
 
 
 def get_credentials(payment_gateway_account):
-    payment_gateway = frappe.get_value("Payment Gateway Account", payment_gateway_account, "payment_gateway")
-
-    if payment_gateway:
-        gateway_controller = frappe.get_value("Payment Gateway", payment_gateway, "gateway_controller")
-
-        if gateway_controller:
-            return frappe.get_doc("WaafiPay Credentials", gateway_controller)
-
-    return None
+    with span("credentials"):
+        return get_gateway_credentials(payment_gateway_account)
 
 
 @frappe.whitelist(allow_guest=True)
@@ -162,42 +304,77 @@ def callback(**kwargs):
 
 # Success callback
 @frappe.whitelist(allow_guest=True)
+@traced("payment_received")
 def payment_received(**kwargs):
+    if use_inbox():
+        return receive_callback("Success", kwargs)
 
-    waafipay_log = None
+    return handle_payment_received(kwargs)
 
+
+def handle_payment_received(kwargs):
+    # provider retries of an already settled callback are answered from the idempotency store
+    key = get_idempotency_key(kwargs) if kwargs.get("responseCode") == "2001" else None
+    if key:
+        claimed, outcome = claim_callback(key)
+        if not claimed:
+            return outcome
+
+    try:
+        outcome = process_payment_received(kwargs)
+    except Exception:
+        if key:
+            release_callback(key)
+        raise
+
+    if key:
+        if outcome.get("status") == "Success":
+            params = kwargs.get("params") if isinstance(kwargs.get("params"), dict) else {}
+            record_callback_outcome(
+                key,
+                outcome,
+                log=outcome.get("log"),
+                transaction_id=params.get("transactionId") or kwargs.get("transactionId"),
+            )
+        else:
+            # let a later retry of a failed callback try again
+            release_callback(key)
+
+    return outcome
+
+
+@traced("process_payment_received")
+def process_payment_received(kwargs):
+    set_labels(response_code=kwargs.get("responseCode"))
     if kwargs.get("responseCode") == "2001":
-        waafipay_log = frappe.new_doc("WaafiPay Log")
-        waafipay_log.flags.ignore_permissions = True
         # create waafipay log
-        waafipay_log.update({
-            "status": "Initiated",
-            "request_payload": frappe.as_json(kwargs),
-            "response_data": frappe.as_json(kwargs),
-        })
-        waafipay_log.save()
+        waafipay_log = make_log(
+            status="Initiated",
+            request_payload=kwargs,
+            response_data=kwargs,
+        )
 
         payment_request = kwargs.get("params").get("referenceId") if kwargs.get("params") else None
         if not payment_request:
             payment_request = kwargs.get("referenceId")
-        
+
+        update_log(waafipay_log, reference_id=payment_request)
+
         if payment_request:
             if frappe.db.exists("Payment Request", payment_request):
                 try:
                     payment_request = frappe.get_doc("Payment Request", payment_request)
                     try:
-                        payment_request.create_payment_entry()
+                        with span("payment_entry"):
+                            payment_request.create_payment_entry()
                     except Exception as e:
-                        waafipay_log.status = "Failed"
-                        waafipay_log.error_message = e
-                        waafipay_log.db_update()
+                        update_log(waafipay_log, status="Failed", error_message=e)
+                        set_payment_status(payment_request.name, "Failed", message=str(e))
                     else:
-                        waafipay_log.status = "Success"
-                        waafipay_log.db_update()
+                        update_log(waafipay_log, status="Success")
+                        set_payment_status(payment_request.name, "Paid", after_commit=True)
                 except Exception as e:
-                    waafipay_log.status = "Failed"
-                    waafipay_log.error_message = e
-                    waafipay_log.db_update()
+                    update_log(waafipay_log, status="Failed", error_message=e)
         else:
             # If no Payment Request but we have a transaction ID (from preauthorization), attempt to commit it
             transaction_id = kwargs.get("params", {}).get("transactionId") or kwargs.get("transactionId")
@@ -207,91 +384,78 @@ def payment_received(**kwargs):
                     commit_response = client.commit_authorized_payment(transaction_id)
 
                     if commit_response.get("responseCode") == "2001":
-                        waafipay_log.status = "Success"
-                        waafipay_log.db_update()
+                        update_log(waafipay_log, status="Success")
 
                         # Attempt to find and submit related Payment Request
                         payment_request_doc = frappe.get_doc("Payment Request", payment_request)
                         payment_request_doc.flags.ignore_permissions = True
                         try:
-                            payment_request_doc.create_payment_entry()
+                            with span("payment_entry"):
+                                payment_request_doc.create_payment_entry()
                         except Exception as e:
-                            waafipay_log.status = "Failed"
-                            waafipay_log.error_message = str(e)
-                            waafipay_log.db_update()
+                            update_log(waafipay_log, status="Failed", error_message=e)
                 except Exception as e:
-                    waafipay_log.status = "Failed"
-                    waafipay_log.error_message = str(e)
-                    waafipay_log.db_update()
+                    update_log(waafipay_log, status="Failed", error_message=e)
             else:
-                waafipay_log.status = "Failed"
-                waafipay_log.error_message = f"Payment Request {payment_request} not found"
-                waafipay_log.db_update()
+                update_log(waafipay_log, status="Failed", error_message=f"Payment Request {payment_request} not found")
 
     else:
-        if not waafipay_log:
-            waafipay_log = frappe.new_doc("WaafiPay Log")
-            waafipay_log.flags.ignore_permissions = True
-
-        waafipay_log.update({
-            "status": "Failed",
-            "request_payload": frappe.as_json(kwargs),
-            "response_data": frappe.as_json(kwargs),
-            "error_message": kwargs.get("responseMsg"),
-        })
-        waafipay_log.save()
+        waafipay_log = make_log(
+            status="Failed",
+            request_payload=kwargs,
+            response_data=kwargs,
+            error_message=kwargs.get("responseMsg"),
+        )
+
+    return {
+        "status": waafipay_log.status,
+        "log": waafipay_log.name,
+        "reference_id": waafipay_log.reference_id,
+    }
 
 
 
-@frappe.whitelist(allow_guest=True)
+@frappe.whitelist()
 def try_again(log_name):
-    log = frappe.get_doc("WaafiPay Log", log_name)
-    log.flags.ignore_permissions = True
-
-    if not log.request_payload:
-        frappe.throw("No request payload found")
+    from waafipay_integration.waafipay.bulk_retry import retry_chunk
 
-    if not log.response_data:
-        frappe.throw("No response data found")
+    frappe.only_for("System Manager")
 
-    # cmd = log.response_data.get("cmd")
-    response_data = json.loads(log.response_data)
-    reference_id = response_data.get("referenceId")
+    results = retry_chunk([log_name])
+    if not results:
+        frappe.throw(f"WaafiPay Log {log_name} not found")
 
-    # if not cmd:
-    #     frappe.throw("Command not found")
+    if results[0]["status"] == "Failed":
+        frappe.throw(results[0]["message"])
 
-    # if not reference_id:
-    #     frappe.throw("Reference ID not found")
-
-    payment_request = frappe.get_doc("Payment Request", reference_id)
-    payment_request.flags.ignore_permissions = True
-
-    try:
-        payment_request.create_payment_entry()
-    except Exception as e:
-        frappe.throw(e)
-    else:
-        log.status = "Success"
-        log.db_update()
+    return results[0]
 
 
 # Failure callback
 @frappe.whitelist(allow_guest=True)
 def failure_callback(**kwargs):
-    
-    # # create waafipay log
-    waafipay_log = frappe.new_doc("WaafiPay Log")
-    waafipay_log.update({
-        "status": "Failed",
-        "request_payload": frappe.as_json(kwargs),
-        "response_data": frappe.as_json(kwargs),
-        "error_message": kwargs.get("responseMsg"),
-    })
-    waafipay_log.flags.ignore_permissions = True
-    waafipay_log.save()
+    if use_inbox():
+        receive_callback("Failure", kwargs)
+    else:
+        handle_failure_callback(kwargs)
 
     frappe.local.response["type"] = "redirect"
     frappe.local.response["location"] = "/waafipay-payment-failure"
 
+
+def handle_failure_callback(kwargs):
+    # # create waafipay log
+    waafipay_log = make_log(
+        status="Failed",
+        request_payload=kwargs,
+        response_data=kwargs,
+        error_message=kwargs.get("responseMsg"),
+    )
+
+    payment_request = (kwargs.get("params") or {}).get("referenceId") or kwargs.get("referenceId")
+    if payment_request and frappe.db.exists("Payment Request", payment_request):
+        set_payment_status(payment_request, "Failed", message=kwargs.get("responseMsg"))
+
+    return {"status": "Failed", "log": waafipay_log.name}
+
     
\ No newline at end of file
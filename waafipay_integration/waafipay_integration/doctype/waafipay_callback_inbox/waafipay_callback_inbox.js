@@ -0,0 +1,18 @@
+// Copyright (c) 2026, Miguel Higuera and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('WaafiPay Callback Inbox', {
+	refresh: function(frm) {
+		if (frm.doc.status == "Failed" || frm.doc.status == "Dead Letter") {
+			frm.add_custom_button(__("Requeue"), function() {
+				frappe.call({
+					method: "waafipay_integration.waafipay.inbox.requeue",
+					args: { names: [frm.doc.name] },
+					callback: function() {
+						frm.reload_doc();
+					}
+				});
+			}).addClass("btn-primary");
+		}
+	},
+});
@@ -2,7 +2,43 @@
 // For license information, please see license.txt
 
 frappe.ui.form.on('WaafiPay Credentials', {
-	// refresh: function(frm) {
+	refresh: function(frm) {
+		if (!frm.is_new()) {
+			frm.trigger("show_circuit_state");
+		}
+	},
+	show_circuit_state: function(frm) {
+		frappe.call({
+			method: "waafipay_integration.waafipay.circuit_breaker.get_circuit_state",
+			args: { credentials: frm.doc.name },
+			callback: function(r) {
+				const state = r.message;
+				if (!state || !state.enabled) {
+					return;
+				}
 
-	// }
+				const colors = { "Closed": "green", "Half-Open": "orange", "Open": "red" };
+				frm.dashboard.set_headline_alert(
+					state.state == "Open"
+						? __("Circuit breaker is <b>Open</b>: calls to {0} fail fast for {1} more seconds.", [state.base_url, state.retry_in])
+						: state.state == "Half-Open"
+							? __("Circuit breaker is <b>Half-Open</b>: probe requests are checking {0}.", [state.base_url])
+							: __("Circuit breaker is <b>Closed</b> ({0} of {1} failures in the last minute).", [state.failures, state.failure_threshold]),
+					colors[state.state]
+				);
+
+				if (state.state != "Closed") {
+					frm.add_custom_button(__("Reset Circuit Breaker"), function() {
+						frappe.call({
+							method: "waafipay_integration.waafipay.circuit_breaker.reset_circuit",
+							args: { credentials: frm.doc.name },
+							callback: function() {
+								frm.reload_doc();
+							}
+						});
+					});
+				}
+			}
+		});
+	},
 });
@@ -1,13 +1,28 @@
 # Copyright (c) 2025, Miguel Higuera and contributors
 # For license information, please see license.txt
 
-import json
 import frappe
 from frappe.model.document import Document
 from waafipay_integration.waafipay.waafipay_client import WaafiPayClient
+from waafipay_integration.waafipay.credentials import clear_credentials_cache
+from waafipay_integration.waafipay.log_sink import make_log, update_log
+from waafipay_integration.waafipay.metrics import span, traced
+from waafipay_integration.waafipay.session import clear_sessions
 
 
 class WaafiPayCredentials(Document):
+    def on_update(self):
+        clear_credentials_cache(self.name)
+        clear_sessions(self.name)
+
+    def on_trash(self):
+        clear_credentials_cache(self.name)
+        clear_sessions(self.name)
+
+    def after_rename(self, old, new, merge=False):
+        clear_credentials_cache()
+        clear_sessions(old)
+
     def validate_transaction_currency(self, currency):
         # Get supported currencies from the supported_currencies table
         supported_currencies = [row.currency for row in self.supported_currencies]
@@ -15,6 +30,7 @@ class WaafiPayCredentials(Document):
         if currency not in supported_currencies:
             frappe.throw(f"Currency {currency} not supported by WaafiPay")
 
+    @traced("request_for_payment")
     def request_for_payment(self, **kwargs):
         """
         Eject when is pressed the button Request in POS
@@ -22,7 +38,8 @@ class WaafiPayCredentials(Document):
         """
         sales_invoice = kwargs.get("payment_reference")
 
-        invoice_doc = self.get_sales_invoice(sales_invoice)
+        with span("invoice"):
+            invoice_doc = self.get_sales_invoice(sales_invoice)
 
         self.validate_transaction_currency(invoice_doc.currency)
 
@@ -31,7 +48,8 @@ class WaafiPayCredentials(Document):
         phone_number = None
         # Get customer phone number
         if invoice_doc.customer:
-            customer = frappe.get_doc("Customer", invoice_doc.customer)
+            with span("customer"):
+                customer = frappe.get_doc("Customer", invoice_doc.customer)
             phone_number = customer.mobile_no or customer.phone_no
 
         if not phone_number:
@@ -58,43 +76,26 @@ class WaafiPayCredentials(Document):
         )
 
         # Prepare payload according to WaafiPay docs
-        payload = client._generate_common_payload()
-        payload.update({
-            "serviceName": "API_PREAUTHORIZE",
-            "serviceParams": {
-                "merchantUid": client.merchant_uid,
-                "apiUserId": client.api_user_id,
-                "apiKey": client.api_key,
-                "paymentMethod": "MWALLET_ACCOUNT",
-                "payerInfo": {
-                    "accountNo": phone_number
-                },
-                "transactionInfo": {
-                    "referenceId": log_doc.name,
-                    "invoiceId": invoice_doc.name,
-                    "amount": f"{amount:.2f}",
-                    "currency": invoice_doc.currency,
-                    "description": f"Payment for Sales Invoice {invoice_doc.name} via WaafiPay"
-                }
-            }
-        })
-
-        log_doc.request_payload = frappe.as_json(payload)
-        log_doc.save(ignore_permissions=True)
+        payload = client.build_preauthorize_payload(
+            phone_number,
+            amount,
+            invoice_doc.currency,
+            invoice_id=invoice_doc.name,
+            reference_id=log_doc.name,
+            description=f"Payment for Sales Invoice {invoice_doc.name} via WaafiPay",
+        )
+
+        update_log(log_doc, request_payload=payload)
 
         # Send payment
         try:
-            response = client.preauthorize_payment(phone_number, amount, invoice_doc.currency, invoice_doc.name)
+            response = client.send_request(payload, log=log_doc)
         except Exception as e:
-            log_doc.status = "Failed"
-            log_doc.response_data = frappe.as_json({"error": str(e)})
-            log_doc.save(ignore_permissions=True)
+            update_log(log_doc, status="Failed", response_data={"error": str(e)})
             frappe.throw(f"WaafiPay payment request failed: {e}")
 
         status = "Success" if response.get("responseCode") == "2001" else "Failed"
-        log_doc.status = status
-        log_doc.response_data = frappe.as_json(response)
-        log_doc.save(ignore_permissions=True)
+        update_log(log_doc, status=status, response_data=response)
 
         # Save reference in invoice
         invoice_doc.db_set("waafipay_reference_id", response.get("referenceId", ""), update_modified=False)
@@ -108,7 +109,8 @@ class WaafiPayCredentials(Document):
                     "mode_of_payment": waafipay_payment.mode_of_payment,
                     "amount": 0.0,
                 })
-                invoice_doc.submit()
+                with span("invoice_submit"):
+                    invoice_doc.submit()
             except Exception as e:
                 frappe.throw(f"Error submitting invoice: {e}")
             else:
@@ -122,34 +124,15 @@ class WaafiPayCredentials(Document):
         }
 
     def create_waafipay_log(self, **kwargs):
-        doc = frappe.new_doc("WaafiPay Log")
-        request_payload = kwargs.get("request_payload")
-        response_data = kwargs.get("response_data")
-
-        if request_payload is None:
-            request_payload_str = None
-        elif isinstance(request_payload, str):
-            request_payload_str = request_payload
-        else:
-            request_payload_str = json.dumps(request_payload)
-
-        if response_data is None:
-            response_data_str = None
-        elif isinstance(response_data, str):
-            response_data_str = response_data
-        else:
-            response_data_str = json.dumps(response_data)
-
-        doc.update({
-            "status": kwargs.get("status"),
-            "request_payload": request_payload_str,
-            "response_data": response_data_str,
-            "sales_invoice": kwargs.get("sales_invoice"),
-            "mode_of_payment": kwargs.get("mode_of_payment"),
-            "reference_id": doc.name,
-        })
-        doc.save()
-        return doc
+        log = make_log(
+            status=kwargs.get("status"),
+            request_payload=kwargs.get("request_payload"),
+            response_data=kwargs.get("response_data"),
+            sales_invoice=kwargs.get("sales_invoice"),
+            mode_of_payment=kwargs.get("mode_of_payment"),
+        )
+        update_log(log, reference_id=log.name)
+        return log
 
     def get_sales_invoice(self, sales_invoice):
         doctype = "Sales Invoice"
@@ -164,17 +147,10 @@ class WaafiPayCredentials(Document):
         client = WaafiPayClient(self.name)
 
         # Prepare payload according to WaafiPay docs
-        payload = client._generate_common_payload()
-        payload.update({
-            "serviceName": "API_PREAUTHORIZE_COMMIT",
-            "serviceParams": {
-                "merchantUid": client.merchant_uid,
-                "apiUserId": client.api_user_id,
-                "apiKey": client.api_key,
-                "transactionId": transaction_id,
-                "description": description or f"Commit of transaction {transaction_id}"
-            }
-        })
+        payload = client.build_commit_payload(
+            transaction_id,
+            description or f"Commit of transaction {transaction_id}",
+        )
 
         # Log the commit attempt
         log_doc = self.create_waafipay_log(
@@ -184,16 +160,12 @@ class WaafiPayCredentials(Document):
         )
 
         try:
-            response = client.send_request(payload)
+            response = client.send_request(payload, log=log_doc)
         except Exception as e:
-            log_doc.status = "Commit Failed"
-            log_doc.response_data = frappe.as_json({"error": str(e)})
-            log_doc.save(ignore_permissions=True)
+            update_log(log_doc, status="Commit Failed", response_data={"error": str(e)})
             frappe.throw(f"WaafiPay commit request failed: {e}")
 
         status = "Success" if response.get("responseCode") == "2001" else "Failed"
-        log_doc.status = status
-        log_doc.response_data = frappe.as_json(response)
-        log_doc.save(ignore_permissions=True)
+        update_log(log_doc, status=status, response_data=response)
 
         return response
@@ -0,0 +1,8 @@
+// Copyright (c) 2026, Miguel Higuera and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('WaafiPay Integration Settings', {
+	// refresh: function(frm) {
+
+	// }
+});
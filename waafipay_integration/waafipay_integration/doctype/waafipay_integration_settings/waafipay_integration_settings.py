@@ -0,0 +1,12 @@
+# Copyright (c) 2026, Miguel Higuera and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+class WaafiPayIntegrationSettings(Document):
+	pass
+
+
+def get_settings():
+	return frappe.get_cached_doc("WaafiPay Integration Settings")
@@ -0,0 +1,12 @@
+# Copyright (c) 2026, Miguel Higuera and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+class WaafiPayLinkOutbox(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("WaafiPay Link Outbox", ["status", "creation"])
@@ -1,9 +1,85 @@
 # Copyright (c) 2025, Miguel Higuera and Contributors
 # See license.txt
 
-# import frappe
+import json
+from unittest.mock import patch
+
+import frappe
 from frappe.tests.utils import FrappeTestCase
 
+from waafipay_integration.patches.v0_1 import backfill_waafipay_log_columns
+from waafipay_integration.waafipay.log_sink import extract_log_fields
+from waafipay_integration.waafipay_integration.doctype.waafipay_log.waafipay_log import find_logs, on_doctype_update
+
+PREAUTHORIZE = {
+	"requestId": "R-1",
+	"serviceName": "API_PREAUTHORIZE",
+	"serviceParams": {"transactionInfo": {"referenceId": "ACC-PRQ-TEST", "amount": "5.00", "currency": "USD"}},
+}
+APPROVED = {"responseCode": "2001", "params": {"state": "APPROVED", "transactionId": "T-1", "txAmount": "5.0"}}
+
+
+def make_log(reference_id, status="Failed", response=None, request=None):
+	return frappe.get_doc({
+		"doctype": "WaafiPay Log",
+		"status": status,
+		"reference_id": reference_id,
+		"request_payload": json.dumps(request or {}),
+		"response_data": json.dumps(response or {}),
+	}).insert(ignore_permissions=True)
+
+
+def get_status(log):
+	return frappe.db.get_value("WaafiPay Log", log.name, "status")
+
 
 class TestWaafiPayLog(FrappeTestCase):
-	pass
+	def test_structured_columns(self):
+		self.assertEqual(
+			extract_log_fields(PREAUTHORIZE, APPROVED),
+			{
+				"request_id": "R-1",
+				"service_name": "API_PREAUTHORIZE",
+				"reference_id": "ACC-PRQ-TEST",
+				"amount": 5.0,
+				"currency": "USD",
+				"response_code": "2001",
+				"state": "APPROVED",
+				"transaction_id": "T-1",
+			},
+		)
+		# a callback only has the response side
+		self.assertEqual(
+			extract_log_fields(None, {"responseCode": "2001", "params": {"referenceId": "ACC-PRQ-TEST", "transactionId": "T-2"}}),
+			{"response_code": "2001", "reference_id": "ACC-PRQ-TEST", "transaction_id": "T-2"},
+		)
+		self.assertEqual(extract_log_fields("not json", ["not", "a", "dict"]), {})
+
+	def test_find_logs_by_indexed_columns(self):
+		reference_id = f"ACC-PRQ-TEST-{frappe.generate_hash(length=10)}"
+		failed = make_log(reference_id)
+		make_log(reference_id, status="Success")
+		make_log(f"{reference_id}-OTHER")
+
+		self.assertEqual(len(find_logs(reference_id=reference_id)), 2)
+		self.assertEqual([log.name for log in find_logs(reference_id=reference_id, status="Failed")], [failed.name])
+		self.assertEqual(len(find_logs(reference_id=[reference_id, f"{reference_id}-OTHER"])), 3)
+		# the JSON payloads are never scanned
+		self.assertRaises(frappe.ValidationError, find_logs, from_date="2026-01-01")
+
+	def test_status_creation_index(self):
+		on_doctype_update()
+
+		self.assertTrue(frappe.db.has_index("tabWaafiPay Log", "status_creation_index"))
+
+	def test_backfill_patch(self):
+		log = make_log(None, request=PREAUTHORIZE, response=APPROVED)
+		frappe.db.set_value("WaafiPay Log", log.name, {"service_name": None, "transaction_id": None, "reference_id": "ACC-PRQ-KEPT"})
+
+		with patch.object(frappe.db, "commit"):
+			backfill_waafipay_log_columns.execute()
+
+		self.assertEqual(
+			frappe.db.get_value("WaafiPay Log", log.name, ["service_name", "transaction_id", "reference_id"]),
+			("API_PREAUTHORIZE", "T-1", "ACC-PRQ-KEPT"),
+		)
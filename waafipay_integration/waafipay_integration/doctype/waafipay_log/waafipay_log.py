@@ -1,8 +1,103 @@
 # Copyright (c) 2025, Miguel Higuera and contributors
 # For license information, please see license.txt
 
-# import frappe
+import frappe
 from frappe.model.document import Document
 
+from waafipay_integration.waafipay.log_retention import COMPRESSED_COLUMN, add_compressed_column, decompress_payloads
+
+LOG_LIST_FIELDS = [
+	"name",
+	"creation",
+	"status",
+	"service_name",
+	"reference_id",
+	"transaction_id",
+	"request_id",
+	"response_code",
+	"state",
+	"amount",
+	"currency",
+	"credential",
+	"sales_invoice",
+	"latency",
+]
+INDEXED_FILTERS = ("reference_id", "transaction_id", "status", "sales_invoice")
+
 class WaafiPayLog(Document):
-	pass
+	def load_from_db(self):
+		super().load_from_db()
+
+		# payloads of old logs are kept compressed by the retention job
+		if compressed := self.__dict__.pop(COMPRESSED_COLUMN, None):
+			for fieldname, value in decompress_payloads(compressed).items():
+				if not self.get(fieldname):
+					self.set(fieldname, value)
+
+
+def on_doctype_update():
+	frappe.db.add_index("WaafiPay Log", ["status", "creation"])
+	add_compressed_column()
+
+
+def find_logs(
+	reference_id=None,
+	transaction_id=None,
+	status=None,
+	sales_invoice=None,
+	from_date=None,
+	to_date=None,
+	fields=None,
+	limit=100,
+):
+	"""Look up logs through the indexed columns instead of scanning the JSON payloads."""
+	filters = {}
+	for fieldname, value in (
+		("reference_id", reference_id),
+		("transaction_id", transaction_id),
+		("status", status),
+		("sales_invoice", sales_invoice),
+	):
+		if value:
+			filters[fieldname] = ["in", value] if isinstance(value, (list, tuple)) else value
+
+	if not filters:
+		frappe.throw(f"Filter on at least one of {', '.join(INDEXED_FILTERS)}")
+
+	if from_date and to_date:
+		filters["creation"] = ["between", [from_date, to_date]]
+	elif from_date:
+		filters["creation"] = [">=", from_date]
+	elif to_date:
+		filters["creation"] = ["<=", to_date]
+
+	return frappe.get_all(
+		"WaafiPay Log",
+		filters=filters,
+		fields=fields or LOG_LIST_FIELDS,
+		order_by="creation desc",
+		limit=limit,
+	)
+
+
+@frappe.whitelist()
+def get_logs(
+	reference_id=None,
+	transaction_id=None,
+	status=None,
+	sales_invoice=None,
+	from_date=None,
+	to_date=None,
+	limit=100,
+):
+	frappe.has_permission("WaafiPay Log", throw=True)
+
+	return find_logs(
+		reference_id=reference_id,
+		transaction_id=transaction_id,
+		status=status,
+		sales_invoice=sales_invoice,
+		from_date=from_date,
+		to_date=to_date,
+		limit=min(int(limit), 1000),
+	)
@@ -8,4 +8,62 @@ frappe.listview_settings["WaafiPay Log"] = {
 			return [__("Error"), "red", "status,=,Error"];
 		}
 	},
+	onload: function (listview) {
+		listview.page.add_actions_menu_item(__("Try Again"), function () {
+			const names = listview.get_checked_items(true);
+			if (!names.length) {
+				return;
+			}
+
+			frappe.call({
+				method: "waafipay_integration.waafipay.bulk_retry.retry_logs",
+				args: { names: names },
+				freeze: true,
+				callback: function (r) {
+					if (r.message) {
+						track_bulk_retry(listview, r.message.batch, r.message.total);
+					}
+				},
+			});
+		});
+	},
 };
+
+function track_bulk_retry(listview, batch, total) {
+	const title = __("Retrying WaafiPay Logs");
+	const failed = [];
+
+	frappe.show_progress(title, 0, total, __("Queued"));
+
+	const handler = function (data) {
+		if (data.batch !== batch) {
+			return;
+		}
+
+		data.results.forEach(function (result) {
+			if (result.status === "Failed") {
+				failed.push(`${result.log}: ${result.message || ""}`);
+			}
+		});
+
+		frappe.show_progress(title, data.done, data.total, __("{0} of {1} logs processed", [data.done, data.total]));
+
+		if (data.done >= data.total) {
+			frappe.realtime.off("waafipay_bulk_retry_progress", handler);
+			frappe.hide_progress();
+			listview.refresh();
+
+			if (failed.length) {
+				frappe.msgprint({
+					title: __("{0} logs could not be retried", [failed.length]),
+					message: failed.map(frappe.utils.escape_html).join("<br>"),
+					indicator: "red",
+				});
+			} else {
+				frappe.show_alert({ message: __("{0} logs retried", [data.total]), indicator: "green" });
+			}
+		}
+	};
+
+	frappe.realtime.on("waafipay_bulk_retry_progress", handler);
+}
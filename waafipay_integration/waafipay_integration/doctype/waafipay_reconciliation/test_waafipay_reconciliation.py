@@ -0,0 +1,103 @@
+# Copyright (c) 2026, Miguel Higuera and Contributors
+# See license.txt
+
+import os
+import random
+import tempfile
+
+from frappe.tests.utils import FrappeTestCase
+
+from waafipay_integration.waafipay.reconciliation import (
+	AMOUNT_MISMATCH,
+	CANCEL_SERVICE,
+	MATCHED,
+	MISSING_ON_OUR_SIDE,
+	MISSING_ON_THEIR_SIDE,
+	collapse_logs,
+	external_sort,
+	merge_join,
+	sum_by_key,
+)
+
+
+def their_row(key, amount, row_number=2):
+	return [key, row_number, key, None, amount, {}]
+
+
+def our_row(key, amount, service_name="API_PREAUTHORIZE_COMMIT", log="LOG-1"):
+	return [key, log, key, None, amount, service_name]
+
+
+class TestWaafiPayReconciliation(FrappeTestCase):
+	def test_external_sort_in_memory(self):
+		rows = [[key, i] for i, key in enumerate(["c", "a", "b"])]
+
+		with tempfile.TemporaryDirectory() as folder:
+			result = list(external_sort(iter(rows), os.path.join(folder, "run")))
+			self.assertEqual(os.listdir(folder), [])
+
+		self.assertEqual([row[0] for row in result], ["a", "b", "c"])
+
+	def test_external_sort_spills_runs(self):
+		keys = [f"TX{i:05d}" for i in range(250)]
+		shuffled = keys[:]
+		random.Random(7).shuffle(shuffled)
+
+		with tempfile.TemporaryDirectory() as folder:
+			result = list(external_sort(([key, 1.5] for key in shuffled), os.path.join(folder, "run"), chunk_size=40))
+			# 250 rows in chunks of 40 make 7 sorted runs on disk
+			self.assertEqual(len(os.listdir(folder)), 7)
+
+		self.assertEqual([row[0] for row in result], keys)
+		self.assertTrue(all(row[1] == 1.5 for row in result))
+
+	def test_sum_by_key(self):
+		rows = [their_row("A", 10, 2), their_row("A", -0.5, 3), their_row("B", 4, 4)]
+
+		result = list(sum_by_key(iter(rows)))
+
+		self.assertEqual([(row[0], row[1], row[4]) for row in result], [("A", 2, 9.5), ("B", 4, 4)])
+
+	def test_collapse_logs(self):
+		rows = [
+			# preauthorize without amount, then the commit that carries it
+			our_row("A", 0, "API_PREAUTHORIZE", "LOG-1"),
+			our_row("A", 10, "API_PREAUTHORIZE_COMMIT", "LOG-2"),
+			# cancelled: no money moved
+			our_row("B", 5, "API_PREAUTHORIZE", "LOG-3"),
+			our_row("B", 0, CANCEL_SERVICE, "LOG-4"),
+			# only a payment link was generated
+			our_row("C", 7, "HPP_PURCHASE", "LOG-5"),
+			our_row("D", 3, "API_PURCHASE", "LOG-6"),
+		]
+
+		result = list(collapse_logs(iter(rows)))
+
+		self.assertEqual([(row[0], row[1]) for row in result], [("A", "LOG-2"), ("D", "LOG-6")])
+
+	def test_merge_join_buckets(self):
+		theirs = iter([their_row("A", 10), their_row("B", 5), their_row("C", 8), their_row("E", 1)])
+		ours = iter([our_row("A", 10.005), our_row("B", 6), our_row("D", 2), our_row("E", 1)])
+
+		result = [(bucket, (their or our)[0]) for bucket, their, our in merge_join(theirs, ours, tolerance=0.01)]
+
+		self.assertEqual(
+			result,
+			[
+				(MATCHED, "A"),
+				(AMOUNT_MISMATCH, "B"),
+				(MISSING_ON_OUR_SIDE, "C"),
+				(MISSING_ON_THEIR_SIDE, "D"),
+				(MATCHED, "E"),
+			],
+		)
+
+	def test_merge_join_drains_either_side(self):
+		self.assertEqual(
+			[bucket for bucket, their, our in merge_join(iter([their_row("A", 1), their_row("B", 1)]), iter([]))],
+			[MISSING_ON_OUR_SIDE, MISSING_ON_OUR_SIDE],
+		)
+		self.assertEqual(
+			[bucket for bucket, their, our in merge_join(iter([]), iter([our_row("A", 1)]))],
+			[MISSING_ON_THEIR_SIDE],
+		)
@@ -0,0 +1,47 @@
+// Copyright (c) 2026, Miguel Higuera and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('WaafiPay Reconciliation', {
+	setup: function(frm) {
+		frappe.realtime.on("waafipay_reconciliation_progress", function(data) {
+			if (data.reconciliation !== frm.doc.name) {
+				return;
+			}
+
+			if (data.stage === "Completed" || data.stage === "Failed") {
+				frm.dashboard.hide_progress();
+				frm.reload_doc();
+				return;
+			}
+
+			frm.dashboard.show_progress(
+				__("Reconciliation"),
+				data.percent || 0,
+				__("{0}: {1} rows", [__(data.stage), format_number(data.rows || 0, null, 0)])
+			);
+		});
+	},
+
+	refresh: function(frm) {
+		if (!frm.is_new() && !["Queued", "Running"].includes(frm.doc.status)) {
+			frm.add_custom_button(frm.doc.status === "Draft" ? __("Start Reconciliation") : __("Run Again"), function() {
+				frappe.call({
+					method: "waafipay_integration.waafipay.reconciliation.start_reconciliation",
+					args: { name: frm.doc.name },
+					freeze: true,
+					callback: function() {
+						frm.reload_doc();
+					}
+				});
+			}).addClass("btn-primary");
+		}
+
+		if (frm.doc.status === "Completed") {
+			["Matched", "Amount Mismatch", "Missing on Our Side", "Missing on Their Side"].forEach(function(bucket) {
+				frm.add_custom_button(__(bucket), function() {
+					frappe.set_route("List", "WaafiPay Reconciliation Entry", { reconciliation: frm.doc.name, bucket: bucket });
+				}, __("View Entries"));
+			});
+		}
+	},
+});
@@ -0,0 +1,15 @@
+# Copyright (c) 2026, Miguel Higuera and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from frappe.utils import getdate
+
+class WaafiPayReconciliation(Document):
+	def validate(self):
+		if getdate(self.from_date) > getdate(self.to_date):
+			frappe.throw(_("From Date cannot be after To Date"))
+
+	def on_trash(self):
+		frappe.db.delete("WaafiPay Reconciliation Entry", {"reconciliation": self.name})